@@ -22,6 +22,10 @@ relies on information found in the .ali files generated by the Ada compiler.
 The output of this script can be viewed either as textual output in the
 GPS Messages window (which you can then save to a text file, or through a
 graphical tree widget, which you can dynamically manipulate.
+
+The dependencies are computed in the background, and the results for each
+project are output as soon as they are known. The computation can be
+interrupted from the Tasks view.
 """
 
 #
@@ -31,6 +35,7 @@ graphical tree widget, which you can dynamically manipulate.
 from GPS import Console, EditorBuffer, File, Preference, Project, XMLViewer
 from gps_utils import interactive
 import traceback
+import workflows
 import re
 import os
 
@@ -59,6 +64,9 @@ show_single_file = True
 # between two projects. Otherwise, we show all file dependencies. Setting this
 # to False will make the computation much slower though
 
+sources_per_step = 20
+# Number of source files analyzed before GPS gets a chance to process events
+
 
 class Output:
 
@@ -170,49 +178,63 @@ class XMLOutput:
         self.xml = ""
 
 
-def compute_project_dependencies(output):
+def compute_project_dependencies(task, output):
+    """A workflow that computes the dependencies of all projects, and
+       sends them to output one project at a time"""
     try:
-        depends_on = dict()
-        current_deps = dict()
-        for p in Project.root().dependencies(recursive=True):
-            current_deps[p] = [cur for cur in p.dependencies(recursive=False)]
-            tmp = dict()
-            previous = p
-            for s in p.sources(recursive=False):
+        projects = list(Project.root().dependencies(recursive=True))
+
+        # Which project each source belongs to, so that we do not need to
+        # query it for each dependency
+        sources = dict()
+        project_of = dict()
+        for p in projects:
+            sources[p] = p.sources(recursive=False)
+            for s in sources[p]:
+                project_of[s] = p
+
+        no_source_projects = set(
+            s.strip().lower() for s in
+            Preference("Plugins/dependencies/no_src_prj").get().split(",")
+        )
+
+        total = sum(len(files) for files in sources.values())
+        done = 0
+
+        for p in projects:
+            depends_on = dict()   # project -> [(file, depends_on)]
+            for s in sources[p]:
                 for imp in s.imports(include_implicit=True,
                                      include_system=False):
-                    ip = imp.project(default_to_root=False)
+                    try:
+                        ip = project_of[imp]
+                    except KeyError:
+                        ip = project_of[imp] = imp.project(
+                            default_to_root=False)
+
                     if ip and ip != p:
-                        if show_single_file:
-                            if ip != previous:
-                                tmp[ip] = [(s, imp)]
-                        else:
-                            try:
-                                tmp[ip].append((s, imp))
-                            except KeyError:
-                                tmp[ip] = [(s, imp)]
-                        previous = ip
-            depends_on[p] = tmp
-
-        no_source_projects = [
-            s.strip().lower() for s in
-            Preference("Plugins/dependencies/no_src_prj").get().split(",")
-        ]
+                        if ip not in depends_on:
+                            depends_on[ip] = [(s, imp)]
+                        elif not show_single_file:
+                            depends_on[ip].append((s, imp))
+
+                done += 1
+                if done % sources_per_step == 0:
+                    task.set_progress(done, total)
+                    yield None   # let GPS process events
+
+            current_deps = p.dependencies(recursive=False)
+            current = set(current_deps)
 
-        for p in depends_on:
             output.set_current_project(p)
-            for dep in depends_on[p]:
-                output.add_dependency(dep, newdep=dep not in current_deps[p])
-                for reason in depends_on[p][dep]:
+            for dep in depends_on:
+                output.add_dependency(dep, newdep=dep not in current)
+                for reason in depends_on[dep]:
                     output.explain_dependency(reason[0], reason[1])
 
-                try:
-                    current_deps[p].remove(dep)
-                except ValueError:
-                    pass
-
-            for dep in current_deps[p]:
-                if dep.name().lower() not in no_source_projects:
+            for dep in current_deps:
+                if dep not in depends_on \
+                        and dep.name().lower() not in no_source_projects:
                     output.add_dependency(dep, newdep=False, removed=True)
 
         output.close()
@@ -227,7 +249,8 @@ def check_project_dependencies_to_console():
     Check whether there are dependencies between the project files that are
     in fact not needed. Output is displayed in the Messages window.
     """
-    compute_project_dependencies(Output())
+    workflows.task_workflow("project dependencies",
+                            compute_project_dependencies, output=Output())
 
 
 @interactive(name='check project dependencies to xml',
@@ -237,4 +260,5 @@ def check_project_dependencies_to_xml():
     Check whether there are dependencies between the project files that are
     in fact not needed. Output is displayed in a tree.
     """
-    compute_project_dependencies(XMLOutput())
+    workflows.task_workflow("project dependencies",
+                            compute_project_dependencies, output=XMLOutput())
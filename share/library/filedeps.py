@@ -10,6 +10,11 @@ Once it has been activated, select the new menu
 and in the dialog that appears enter the two source files you are interested
 in. This will then list in the console why the first file depends on the
 second (for instance "file1" depends on "file2", which depends on "file3")
+
+The dependencies computed by the cross-references engine are kept in memory
+until the cross-references are updated, so that successive queries are
+fast. The function dependent_files can also be used from the python
+console to list all the files that depend on a given file.
 """
 
 #############################################################################
@@ -18,60 +23,133 @@ second (for instance "file1" depends on "file2", which depends on "file3")
 
 import GPS
 import os.path
+from collections import deque
 from gps_utils import interactive
 
 
+def is_body(file):
+    """Whether FILE is an Ada body"""
+    ext = os.path.splitext(file.path)
+    return ext[1] == ".adb" or (ext[1] == ".ada" and ext[0][-2:] == ".2")
+
+
+def is_spec(file):
+    """Whether FILE is an Ada spec"""
+    ext = os.path.splitext(file.path)
+    return ext[1] == ".ads" or (ext[1] == ".ada" and ext[0][-2:] == ".1")
+
+
+class Import_Graph(object):
+    """The files imported by each file, and the files importing it, as
+       computed by the cross-references engine. They are computed on
+       demand, and discarded when the cross-references are updated."""
+
+    def __init__(self):
+        self.clear()
+        GPS.Hook("xref_updated").add(self.clear)
+
+    def clear(self, *args):
+        self.__imports = {}       # (file, include_implicit) -> [File]
+        self.__imported_by = {}   # file -> [File]
+
+    def imports(self, file, include_implicit):
+        """The files that FILE depends on"""
+        key = (file, include_implicit)
+        result = self.__imports.get(key)
+        if result is None:
+            result = [f for f in file.imports(
+                include_implicit=include_implicit, include_system=False) if f]
+
+            # imports does not list the dependency from body to spec, so we
+            # add it explicitly.
+            if is_body(file) and file.other_file() != file:
+                result.append(file.other_file())
+
+            self.__imports[key] = result
+        return result
+
+    def imported_by(self, file):
+        """The files that depend on FILE"""
+        result = self.__imported_by.get(file)
+        if result is None:
+            result = [f for f in file.imported_by(include_system=False) if f]
+
+            # A body depends on its spec
+            if is_spec(file) and file.other_file() != file:
+                result.append(file.other_file())
+
+            self.__imported_by[file] = result
+        return result
+
+    def shortest_path(self, from_file, to_file, include_implicit):
+        """Return the shortest list of files from FROM_FILE to TO_FILE,
+           where each file depends on the next one, or None if FROM_FILE
+           does not depend on TO_FILE"""
+        # We do the computation starting from from_file, since it is more
+        # efficient to compute "imported" files than "importing files".
+        # This is a breadth-first search, so the first path found is one
+        # of the shortest.
+
+        parents = {from_file: None}
+        to_analyze = deque([from_file])
+
+        while to_analyze:
+            file = to_analyze.popleft()
+            if file == to_file:
+                path = []
+                while file is not None:
+                    path.append(file)
+                    file = parents[file]
+                path.reverse()
+                return path
+
+            for f in self.imports(file, include_implicit):
+                if f not in parents:
+                    parents[f] = file
+                    to_analyze.append(f)
+
+        return None
+
+    def dependents(self, file):
+        """Return the set of files that depend, directly or not, on FILE"""
+        result = set()
+        to_analyze = deque([file])
+        while to_analyze:
+            for f in self.imported_by(to_analyze.popleft()):
+                if f not in result and f != file:
+                    result.add(f)
+                    to_analyze.append(f)
+        return result
+
+
+graph = Import_Graph()
+
+
 def internal_dependency_path(from_file, to_file, include_implicit):
-    # We do the computation starting from to_file, since it is more efficient
-    # to compute "imported" files than "importing files". Since we want to
-    # compute the path itself, do not do a recursive search.
-    deps = dict()
-
-    # List of files to analyze. This is a list of tuples, the first element of
-    # which is the name of the file to analyze, and the second is the name of
-    # the parent that put it in the list
-    to_analyze = [(from_file, None)]
-
-    while len(to_analyze) != 0:
-        (file, because_of) = to_analyze.pop()
-        imports = file.imports(include_implicit=include_implicit,
-                               include_system=False)
-
-        # imports does not list the dependency from body to spec, so we add it
-        # explicitly if from_file is a body.
-
-        ext = os.path.splitext(from_file.path)
-        if ext[1] == ".adb" or (ext[1] == ".ada" and ext[0][-2:] == ".2"):
-            imports.append(from_file.other_file())
-
-        deps[file] = because_of
-        if file == to_file:
-            break
-
-        for f in imports:
-            if f and f not in deps:
-                to_analyze.append((f, file))
-
-    target = to_file
-    result = ""
-    targets = []
-
-    while target:
-        targets.append(target)
-        result = " -> " + target.path + "\n" + result
-        if target not in deps:
-            result = "No dependency between these two files"
-            break
-        target = deps[target]
-    return (result, targets)
+    path = graph.shortest_path(from_file, to_file, include_implicit)
+    if path is None:
+        return ("No dependency between these two files", [to_file])
+
+    result = "".join(" -> " + f.path + "\n" for f in path)
+    path.reverse()   # from to_file to from_file
+    return (result, path)
+
+
+def dependent_files(file):
+    """Return the list of files that depend, directly or indirectly, on
+       FILE, sorted by name. FILE must be an instance of GPS.File, or a
+       file name."""
+    if not isinstance(file, GPS.File):
+        file = GPS.File(file)
+    return sorted(graph.dependents(file), key=lambda f: f.path)
 
 
 def dependency_path(from_file, to_file, fill_location=False, title=""):
     """Shows why modifying to_file implies that from_file needs to be
        recompiled. This information is computed from the cross-references
        database, and requires your application to have been compiled
-       properly. This function does not attempt to compute the shortest
-       dependency path, and just returns the first one it finds.
+       properly. This function returns one of the shortest dependency
+       paths.
        FROM_FILE and TO_FILE must be instances of GPS.File.
        If FILL_LOCATION is True, then the locations view will also be
        filled."""
@@ -95,6 +173,7 @@ def dependency_path(from_file, to_file, fill_location=False, title=""):
                                                      include_implicit=True)
 
     if fill_location and result != "No dependency between these two files":
+        added = False
         target = targets.pop()
 
         # Fill the locations view with the result
@@ -22,9 +22,11 @@ they might show references to entities even though these entities are in fact
 no longer used (which means GPS will not correctly report all cases of unused
 entities).
 
-Executing this script blocks the whole GPS interface, so it is normal that
-GPS becomes unresponsive. Depending of the size of your project, this can
-take a while to execute.
+The search runs in the background, one source file at a time, and the
+unused entities are added to the Locations window as they are found. Its
+progress is shown in the Tasks view, where it can also be interrupted.
+When possible, the entities of each file are checked with a single query
+to the cross-reference database, rather than one query per entity.
 Note that you can save the contents of the Locations window, after execution,
 through the GPS.Locations.dump() method in the python console.
 """
@@ -34,8 +36,11 @@ through the GPS.Locations.dump() method in the python console.
 #############################################################################
 
 from GPS import Preference, Project, Console, Editor, File, Locations, \
-    EditorBuffer, MDI
+    EditorBuffer, MDI, Entity, Logger, xref_db
 from gps_utils import interactive
+import os
+import sqlite3
+import workflows
 
 xmlada_projects = [
     "xmlada_sax", "xmlada_dom", "xmlada_schema", "xmlada_unicode",
@@ -52,8 +57,8 @@ Preference("Plugins/unused_entities/ignoreprj").create(
     ",".join(xmlada_projects + aws_projects))
 
 
-def EntityIterator(where):
-    """Return all entities from WHERE"""
+def SourcesIterator(where):
+    """Return all source files from WHERE"""
     if not where:
         ignore_projects = [s.strip().lower() for s in Preference(
             "Plugins/unused_entities/ignoreprj").get().split(",")]
@@ -63,14 +68,18 @@ def EntityIterator(where):
                 Console().write(
                     "Searching unused entities in project " + p.name() + "\n")
                 for s in p.sources():
-                    for e in s.entities(local=True):
-                        yield e
+                    yield s
     elif isinstance(where, Project):
         for s in where.sources():
-            for e in s.entities(local=True):
-                yield e
+            yield s
     elif isinstance(where, File):
-        for e in where.entities(local=True):
+        yield where
+
+
+def EntityIterator(where):
+    """Return all entities from WHERE"""
+    for s in SourcesIterator(where):
+        for e in s.entities(local=True):
             yield e
 
 
@@ -113,22 +122,128 @@ def UnusedIterator(where, globals_only):
             yield e
 
 
+# The entities declared in a file that are never referenced, except by their
+# declaration, body or labels (see is_unused)
+UNUSED_QUERY = """
+SELECT e.name, e.decl_line, e.decl_column FROM entities e, files f
+WHERE e.decl_file = f.id AND f.path = ? %s
+AND NOT EXISTS (
+   SELECT 1 FROM entity_refs r, reference_kinds k
+   WHERE r.entity = e.id AND r.kind = k.id
+   AND k.display NOT IN ('declaration', 'body', 'label'))
+ORDER BY e.decl_line, e.decl_column
+"""
+
+
+def open_xref_db():
+    """Return a connection to the cross-reference database, or None if it
+       cannot be queried directly"""
+    # Connecting would create an empty database
+    if not os.path.isfile(xref_db()):
+        return None
+
+    try:
+        db = sqlite3.connect(xref_db(), timeout=10)
+        tables = set(row[0] for row in db.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'"))
+        if tables.issuperset(
+                ('entities', 'files', 'entity_refs', 'reference_kinds')):
+            return db
+        db.close()
+    except sqlite3.Error as e:
+        Logger("UNUSED_ENTITIES").log("Cannot query xref database: %s" % e)
+    return None
+
+
+def UnusedInFile(db, file, globals_only):
+    """Return (name, line, column) for all unused entities declared in FILE,
+       computed with a single query to the database DB"""
+    rows = db.execute(
+        UNUSED_QUERY % ("AND e.is_global = 1" if globals_only else ""),
+        (file.path, )).fetchall()
+
+    for name, line, column in rows:
+        # Primitive operations might be called through dispatching
+        try:
+            if Entity(name, file, line, column).primitive_of():
+                continue
+        except Exception:
+            pass
+        yield (name, line, column)
+
+
+def unused_entities_workflow(task, where, globals_only):
+    """A workflow that adds the unused entities from WHERE to the locations
+       window, one file at a time"""
+    global current_task
+
+    files = list(SourcesIterator(where))
+    use_db = True
+
+    for idx, f in enumerate(files):
+        task.set_progress(idx, len(files))
+        found = None
+
+        # An interrupted task is never resumed, and its generator is not
+        # closed either: do not keep the database open across the yield
+        if use_db:
+            db = open_xref_db()
+            if db is None:
+                use_db = False
+            else:
+                try:
+                    found = list(UnusedInFile(db, f, globals_only))
+                except sqlite3.Error as e:
+                    Logger("UNUSED_ENTITIES").log(
+                        "Cannot query xref database: %s" % e)
+                    use_db = False
+                finally:
+                    db.close()
+
+        if found is None:
+            found = [(e.name(), e.declaration().line(),
+                      e.declaration().column())
+                     for e in UnusedIterator(f, globals_only=globals_only)]
+
+        for name, line, column in found:
+            Locations.add(category="Unused entity",
+                          file=f,
+                          line=line,
+                          column=column,
+                          message="unused entity " + name,
+                          highlight="Unused_Entities",
+                          length=len(name))
+
+        yield None   # let GPS process events, or interrupt the task
+
+    Console().write("Done searching for unused entities\n")
+    if current_task is task:
+        current_task = None
+
+
+current_task = None
+
+
 def show_unused_entities(where, globals_only):
-    """List all unused global entities from WHERE in the locations window"""
+    """List all unused global entities from WHERE in the locations window.
+       This is done in the background, and can be interrupted from the Tasks
+       view."""
+    global current_task
+
+    # current_task is still set when it was interrupted from the Tasks view
+    if current_task is not None:
+        try:
+            current_task.interrupt()
+        except Exception:
+            pass   # already interrupted
+
     Editor.register_highlighting("Unused_Entities", "blue")
     Locations.remove_category("Unused entity")
     MDI.get("Messages").raise_window()
 
-    for e in UnusedIterator(where, globals_only=globals_only):
-        Locations.add(category="Unused entity",
-                      file=e.declaration().file(),
-                      line=e.declaration().line(),
-                      column=e.declaration().column(),
-                      message="unused entity " + e.name(),
-                      highlight="Unused_Entities",
-                      length=len(e.name()))
-
-    Console().write("Done searching for unused entities\n")
+    current_task = workflows.task_workflow(
+        "unused entities", unused_entities_workflow,
+        where=where, globals_only=globals_only)
 
 
 @interactive(name='show unused entities from file',
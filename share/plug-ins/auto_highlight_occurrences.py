@@ -31,7 +31,10 @@ like "TODO", or special comments for instance.
 import GPS
 # from gps_utils import *
 from gps_utils import hook
-from gps_utils.highlighter import Location_Highlighter, OverlayStyle
+from gps_utils.highlighter import Location_Highlighter, OverlayStyle, \
+    _get_gtk_buffer
+import bisect
+from collections import OrderedDict
 import re
 
 GPS.Preference(
@@ -61,6 +64,59 @@ GPS.Preference(
 MSG_PREFIX = 'dynamic occurrences '
 # Messages created by this plugin have a category that starts with this
 
+WORDS_CACHE_SIZE = 16
+# Number of words whose occurrences are remembered for each buffer
+
+
+class Word_Occurrences(object):
+
+    """
+    The occurrences of a word in the parts of a buffer that have already
+    been scanned. This is only valid until the buffer is modified, so it is
+    discarded as soon as the Gtk buffer changes.
+    """
+
+    def __init__(self, word):
+        self.regexp = re.compile(
+            r"(?<!\w){0}(?!\w)".format(re.escape(word)), re.U)
+        self.ranges = []  # sorted list of the [start, end] offsets scanned
+        self.spans = []   # sorted list of the (start, end) of occurrences
+
+    def find(self, text, offset):
+        """
+        Return the occurrences of the word in text, which starts at offset
+        in the buffer, as a list of (start, end) offsets (both inclusive).
+        The text is only scanned if it was not scanned before.
+
+        :param unicode text: a range of whole lines of the buffer.
+        :param integer offset: the offset of text in the buffer.
+        :rtype: list[(integer, integer)]
+        """
+        end = offset + len(text)
+
+        for s, e in self.ranges:
+            if s <= offset and end <= e:
+                return self.spans[bisect.bisect_left(self.spans, (offset,)):
+                                  bisect.bisect_left(self.spans, (end,))]
+
+        found = [(offset + m.start(), offset + m.end() - 1)
+                 for m in self.regexp.finditer(text)]
+
+        self.spans = sorted(
+            [sp for sp in self.spans if not offset <= sp[0] < end] + found)
+
+        # The newline between two consecutive ranges never contains an
+        # occurrence, so such ranges are merged.
+        ranges = []
+        for s, e in sorted(self.ranges + [(offset, end)]):
+            if ranges and s <= ranges[-1][1] + 1:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], e))
+            else:
+                ranges.append((s, e))
+        self.ranges = ranges
+
+        return found
+
 
 class Current_Entity_Highlighter(Location_Highlighter):
 
@@ -95,6 +151,13 @@ class Current_Entity_Highlighter(Location_Highlighter):
 
         self.current_buffer = None
 
+        # The occurrences of the words highlighted recently, per file
+        self.occurrences = {}
+
+        # The Gtk buffers monitored to invalidate self.occurrences, and the
+        # id of the signal handler, per file
+        self.__watched = {}
+
         self.highlighted_limit = GPS.Preference(
             "Plugins/auto_highlight_occurrences/highlighting_limit").get()
 
@@ -104,8 +167,37 @@ class Current_Entity_Highlighter(Location_Highlighter):
         GPS.Hook("preferences_changed").add(self._on_preferences_changed)
         GPS.Hook("location_changed").add_debounce(self.highlight)
         GPS.Hook("file_closed").add(self.__on_file_closed)
+        GPS.Hook("buffer_edited").add(self.__on_buffer_edited)
+
+    def __on_buffer_edited(self, hook, file):
+        # Only useful when the Gtk buffer cannot be monitored: this hook is
+        # run some time after the buffer was modified.
+        self.occurrences.pop(file, None)
+
+    def __watch(self, buffer):
+        """
+        Discard the occurrences cached for buffer as soon as it is modified.
+        The buffer_edited hook is run too late for this, so a highlighting
+        started right after typing would use obsolete offsets.
+        """
+        file = buffer.file()
+        if file not in self.__watched:
+            gtk_buffer = _get_gtk_buffer(buffer)
+            if gtk_buffer is not None:
+                self.__watched[file] = (
+                    gtk_buffer,
+                    gtk_buffer.connect(
+                        "changed",
+                        lambda b: self.occurrences.pop(file, None)))
 
     def __on_file_closed(self, hook, file):
+        self.occurrences.pop(file, None)
+        watched = self.__watched.pop(file, None)
+        if watched is not None:
+            try:
+                watched[0].disconnect(watched[1])
+            except Exception:
+                pass  # the Gtk buffer was already destroyed
         if self.current_buffer:
             if self.current_buffer.file() == file:
                 self.current_buffer = None
@@ -158,6 +250,24 @@ class Current_Entity_Highlighter(Location_Highlighter):
         else:
             return []   # irrelevant
 
+    def __highlight_word(self, buffer, text, offset):
+        """
+        Highlight the occurrences of the current word in text, which starts
+        at offset in buffer.
+        """
+        self.__watch(buffer)
+        words = self.occurrences.setdefault(buffer.file(), OrderedDict())
+        occurrences = words.pop(self.word, None)
+        if occurrences is None:
+            occurrences = Word_Occurrences(self.word)
+            if len(words) >= WORDS_CACHE_SIZE:
+                words.popitem(last=False)
+        words[self.word] = occurrences
+
+        spans = occurrences.find(text, offset)
+        self.highlighted += len(spans)
+        self.style.apply_batch(buffer, spans)
+
     def process(self, start, end):
         """Called by Background_Highlighter"""
 
@@ -165,51 +275,17 @@ class Current_Entity_Highlighter(Location_Highlighter):
             Location_Highlighter.process(self, start, end)
         else:
             buffer = start.buffer()
-            while start < end:
-
-                # Get the string on the line
-                end_loc = start.end_of_line()
-                s = buffer.get_chars(start, end_loc)  # byte-sequence
-                s = s.decode("utf8")  # make unicode-string
-                s_len = len(s)
-
-                # Find the tokens on the current line
-                index = 0
-                visible_column = 0
-
-                while index < s_len:
-                    if s[index].isalpha():
-                        end_index = index + 1
-
-                        while end_index < s_len and (
-                                s[end_index].isalnum() or s[end_index] == '_'):
-                            end_index += 1
-                        if s[index:end_index] == self.word:
-                            self.highlighted += 1
-                            self.style.apply(
-                                start=GPS.EditorLocation(
-                                    buffer,
-                                    start.line(),
-                                    start.column() + visible_column),
-                                end=GPS.EditorLocation(
-                                    buffer,
-                                    start.line(),
-                                    start.column() +
-                                    visible_column + len(self.word) - 1))
-
-                        visible_column += end_index - index
-                        index = end_index
-
-                    else:
-                        visible_column += 1
-
-                        if s[index] == '\t':
-                            visible_column = (visible_column +
-                                              8 - (visible_column % 8))
-
-                        index += 1
-
-                start = end_loc + 1
+            s = buffer.get_chars(start, end)  # byte-sequence
+            s = s.decode("utf8")  # make unicode-string
+            self.__highlight_word(buffer, s, start.offset())
+
+    def process_lines(self, start, end, lines, offset):
+        """Called by Background_Highlighter"""
+
+        if self.entity:
+            Location_Highlighter.process(self, start, end)
+        else:
+            self.__highlight_word(start.buffer(), u"\n".join(lines), offset)
 
     def highlight(self, *args, **kwargs):
         """
@@ -17,6 +17,7 @@ import json
 import re
 import sys
 import fnmatch
+from multiprocessing.pool import ThreadPool
 
 # We create the actions and menus in XML instead of python to share the same
 # source for GPS and GNATbench (which only understands the XML input for now).
@@ -460,16 +461,15 @@ reg1 = re.compile(r"in instantiation at ([\w\.-]+):[0-9]+")
 reg2 = re.compile(r"in call inlined at ([\w\.-]+):[0-9]+")
 reg3 = re.compile(r"in inherited contract at ([\w\.-]+):[0-9]+")
 
+# The file name at the start of a message "file:line:col: msg". It may
+# contain colons, as in "C:\src\file.adb" on Windows.
+msg_file_reg = re.compile(r"(.*?):[0-9]+:[0-9]+:")
 
-def get_compunit_for_message(msg):
-    """ Return the compilation unit for a given message, so that extra
-    information for the message will be found in the file
-    unit.spark. For generic instantiations, inlined calls and
-    inherited contracts, this corresponds to the last unit in the
-    chain of locations. Otherwise, this is simply the compilation
-    unit where the message is reported."""
 
-    text = msg.get_text()
+def get_compunit_for_text(text, fname):
+    """ Return the compilation unit for a message with the given text,
+    reported in the file fname. See get_compunit_for_message."""
+
     m = re.search(reg1, text)
     if not m:
         m = re.search(reg2, text)
@@ -477,9 +477,38 @@ def get_compunit_for_message(msg):
         m = re.search(reg3, text)
     if m:
         fname = m.group(1)
-    else:
-        fname = os.path.basename(msg.get_file().path)
-    return os.path.splitext(fname)[0]
+    return os.path.splitext(os.path.basename(fname))[0]
+
+
+def get_compunit_for_message(msg):
+    """ Return the compilation unit for a given message, so that extra
+    information for the message will be found in the file
+    unit.spark. For generic instantiations, inlined calls and
+    inherited contracts, this corresponds to the last unit in the
+    chain of locations. Otherwise, this is simply the compilation
+    unit where the message is reported."""
+
+    return get_compunit_for_text(msg.get_text(), msg.get_file().path)
+
+
+MESSAGES_CATEGORY = "Builder results"
+# The category of the messages output by GNATprove
+
+JSON_LOADING_THREADS = 8
+# Maximum number of threads used to load the .spark files
+
+
+def load_json(file):
+    """Return the contents of the JSON file "file", or None if it does not
+       exist or is not valid JSON. This can be called from any thread.
+    """
+    if os.path.isfile(file):
+        with open(file, 'r') as f:
+            try:
+                return json.load(f)
+            except ValueError:
+                pass
+    return None
 
 
 class GNATprove_Parser(tool_output.OutputParser):
@@ -492,10 +521,10 @@ class GNATprove_Parser(tool_output.OutputParser):
        unique for this unit and this message.
        The GNATprove parser strips the extra symbol from the message so that
        it's not visible in GPS, and builds up a mapping
-         msg -> id
-       Once GNATprove is terminated, for each msg which has an entry in this
-       mapping, the parser opens the JSON file "unit.spark".
-       See the :func:`parsejson()` function for the format of this file.
+         msg -> (unit, id)
+       Once GNATprove is terminated, the parser opens the JSON files
+       "unit.spark" of all these units, in parallel.
+       See the :func:`handle_json()` function for the format of this file.
        Once this file is parsed, the GNATprove parser now knows the extra
        information associated to a message, if any. See
        :func:`act_on_extra_info()` to know what is done with this extra
@@ -505,8 +534,8 @@ class GNATprove_Parser(tool_output.OutputParser):
     def __init__(self, child):
         tool_output.OutputParser.__init__(self, child)
         # holds the unit names for which extra info is retrieved
-        self.units_with_extra_info = []
-        # holds the mapping "msg" -> msg_id
+        self.units_with_extra_info = set()
+        # holds the mapping "msg" -> (unit, msg_id)
         self.msg_id = {}
         self.regex = re.compile(r"(.*)\[#([0-9]+)\]$")
         # holds the mapping "unit,msg_id" -> extra_info
@@ -535,7 +564,7 @@ class GNATprove_Parser(tool_output.OutputParser):
         return lines
 
     def handle_entry(self, unit, list):
-        """code do handle one entry of the JSON file. See :func:`parsejson()`
+        """code do handle one entry of the JSON file. See :func:`handle_json()`
            for the details of the format.
         """
 
@@ -544,9 +573,9 @@ class GNATprove_Parser(tool_output.OutputParser):
                 full_id = unit, entry['msg_id']
                 self.extra_info[full_id] = entry
 
-    def parsejson(self, unit, file):
-        """parse the json file "file", which belongs to unit "unit" and fill
-           the "extra_info" mapping for any entry.
+    def handle_json(self, unit, dict):
+        """fill the "extra_info" mapping from the contents "dict" of the json
+           file of unit "unit", or do nothing if dict is None.
            The json file, if it exists and is a valid JSON value, is a dict
            with two entries "flow" and "proof" (both entries may be absent).
            Each entry is mapped to a list of dictionaries. Some of these
@@ -557,16 +586,11 @@ class GNATprove_Parser(tool_output.OutputParser):
            which is later used to act on this extra information for each
            message.
         """
-        if os.path.isfile(file):
-            with open(file, 'r') as f:
-                try:
-                    dict = json.load(f)
-                    if 'flow' in dict:
-                        self.handle_entry(unit, dict['flow'])
-                    if 'proof' in dict:
-                        self.handle_entry(unit, dict['proof'])
-                except ValueError:
-                    pass
+        if dict is not None:
+            if 'flow' in dict:
+                self.handle_entry(unit, dict['flow'])
+            if 'proof' in dict:
+                self.handle_entry(unit, dict['proof'])
 
     def act_on_extra_info(self, m, extra, objdir, command):
         """act on extra info for the message m. More precisely, if the message
@@ -636,10 +660,9 @@ class GNATprove_Parser(tool_output.OutputParser):
                                extra['vc_file'] + "\n")
 
     def on_exit(self, status, command):
-        """When GNATprove has finished, scan through messages to see if extra
-           info has been attached to them. If so, parse the .spark file of
-           the corresponding unit to get the extra info, and act on the extra
-           info"""
+        """When GNATprove has finished, parse the .spark files of the units
+           for which messages had extra info attached, then scan through
+           GNATprove's messages to act on their extra info"""
 
         # Global map that associates messages text to the location of the
         # check. Messages already contain a location but it cannot be trusted
@@ -652,20 +675,30 @@ class GNATprove_Parser(tool_output.OutputParser):
             obj_subdir_name)
 
         map_msg = {}
-        imported_units = set()
-        for m in GPS.Message.list():
-            text = get_comp_text(m)
-            if text in self.msg_id:
-                id = self.msg_id[text]
-                unit = get_compunit_for_message(m)
-                full_id = unit, id
-                if unit not in imported_units:
-                    self.parsejson(unit, os.path.join(objdir, unit + ".spark"))
-                    imported_units.add(unit)
-                extra = {}
-                if full_id in self.extra_info:
-                    extra = self.extra_info[full_id]
-                    self.act_on_extra_info(m, extra, objdir, command)
+
+        # Load the .spark files in parallel: this is mostly I/O and JSON
+        # decoding, and does not use the GPS API.
+        units = sorted(self.units_with_extra_info)
+        if units:
+            pool = ThreadPool(min(len(units), JSON_LOADING_THREADS))
+            try:
+                values = pool.map(
+                    load_json,
+                    [os.path.join(objdir, u + ".spark") for u in units])
+            finally:
+                pool.close()
+                pool.join()
+
+            for unit, dict in zip(units, values):
+                self.handle_json(unit, dict)
+
+        # Only GNATprove's messages can have extra info
+        if self.msg_id:
+            for m in GPS.Message.list(category=MESSAGES_CATEGORY):
+                full_id = self.msg_id.get(get_comp_text(m))
+                if full_id is not None and full_id in self.extra_info:
+                    self.act_on_extra_info(
+                        m, self.extra_info[full_id], objdir, command)
 
         if self.child is not None:
             self.child.on_exit(status, command)
@@ -674,7 +707,7 @@ class GNATprove_Parser(tool_output.OutputParser):
         """for each GNATprove message, check for a msg_id tag of the form
            [#id] where id is a number. If no such tag is found, just pass the
            text on to the next parser. Otherwise, add a mapping
-              msg text -> msg id
+              msg text -> (unit, msg id)
            which will be used later (in on_exit) to associate more info to the
            message
         """
@@ -684,7 +717,12 @@ class GNATprove_Parser(tool_output.OutputParser):
             if m:
                 text = m.group(1)
                 self.pass_output(text, command)
-                self.msg_id[text] = int(m.group(2))
+
+                fm = re.match(msg_file_reg, text)
+                unit = get_compunit_for_text(
+                    text, fm.group(1) if fm else text.split(':', 1)[0])
+                self.msg_id[text] = (unit, int(m.group(2)))
+                self.units_with_extra_info.add(unit)
             else:
                 # the line doesn't have any extra info, go on
                 self.pass_output(line, command)
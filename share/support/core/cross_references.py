@@ -2,6 +2,7 @@
 """
 
 import GPS
+import json
 import os.path
 import tool_output
 import gps_utils
@@ -103,6 +104,15 @@ class Sqlite_Cross_References(object):
         self.gnatinspect_launch_registered = False
         self.gnatinspect_already_running = False
 
+        # Whether the registered launch should reload all files
+        self.full_reload_registered = False
+
+        # The LI files and their timestamps when gnatinspect last completed
+        # successfully (see li_files_timestamps), and when the current
+        # gnatinspect was launched.
+        self.loaded_li_files = None
+        self.launched_li_files = None
+
         # Initialize self.trusted_mode and other preferences
         self.on_preferences_changed(None)
 
@@ -111,21 +121,80 @@ class Sqlite_Cross_References(object):
             lambda *args: self.recompute_xref(quiet=False),
             name="recompute xref info")
 
-    def gnatinspect_completed(self):
+    def manifest_file(self):
+        """ The file where the timestamps of the LI files loaded in the
+            xref database are saved, next to the database.
+        """
+        return GPS.xref_db() + '.manifest'
+
+    def li_files_timestamps(self):
+        """ Return a dict mapping each LI file found in the object
+            directories of the project tree to its timestamp.
+        """
+        result = {}
+        for d in set(GPS.Project.root().object_dirs(recursive=True)):
+            try:
+                names = os.listdir(d)
+            except OSError:
+                continue
+            for name in names:
+                if name.endswith(('.ali', '.gli')):
+                    f = os.path.join(d, name)
+                    try:
+                        result[f] = os.stat(f).st_mtime
+                    except OSError:
+                        pass
+        return result
+
+    def li_files_changed(self):
+        """ Whether some LI files were modified, added or removed since
+            gnatinspect last completed successfully.
+        """
+        if not os.path.exists(GPS.xref_db()):
+            return True
+
+        if self.loaded_li_files is None:
+            try:
+                with open(self.manifest_file()) as f:
+                    self.loaded_li_files = json.load(f)
+            except (IOError, ValueError):
+                return True
+
+        return self.li_files_timestamps() != self.loaded_li_files
+
+    def gnatinspect_completed(self, status=0):
         """ Call this when gnatinspect completed working.
         """
         self.gnatinspect_already_running = False
 
+        if status == 0 and self.launched_li_files is not None:
+            self.loaded_li_files = self.launched_li_files
+            try:
+                with open(self.manifest_file(), 'w') as f:
+                    json.dump(self.loaded_li_files, f)
+            except IOError:
+                GPS.Logger("XREF").log(
+                    "Cannot write %s" % (self.manifest_file(), ))
+        else:
+            self.loaded_li_files = None
+            try:
+                os.remove(self.manifest_file())
+            except OSError:
+                pass
+        self.launched_li_files = None
+
         if self.gnatinspect_launch_registered:
             # Aha, someone had requested a launch of gnatinspect while
             # this one was running. Launch this now.
             self.gnatinspect_launch_registered = False
-            self.recompute_xref()
+            self.recompute_xref(full=self.full_reload_registered)
 
-    def recompute_xref(self, force=False, quiet=True):
+    def recompute_xref(self, force=False, quiet=True, full=True):
         """ Launch recompilation of the cross references.
             if Force is True, run regardless of a running gnatinspect
-            (this flag is used to protect against reentry)"""
+            (this flag is used to protect against reentry)
+            If Full is False, gnatinspect is only run when some LI files
+            changed since it last completed successfully."""
 
         if self.gnatinspect_already_running:
             # We are already running gnatinspect. If someone registers
@@ -133,6 +202,9 @@ class Sqlite_Cross_References(object):
             # and wait for gnatinspect to complete before launching the
             # next one.
 
+            if not self.gnatinspect_launch_registered:
+                self.full_reload_registered = False
+            self.full_reload_registered = self.full_reload_registered or full
             self.gnatinspect_launch_registered = True
             return
 
@@ -147,6 +219,16 @@ class Sqlite_Cross_References(object):
         if not os.path.exists(GPS.Project.root().file().path):
             return
 
+        # gnatinspect loads the whole project before checking the LI files,
+        # which is slow on large projects, so don't run it when no LI file
+        # changed.
+        if not full and not self.li_files_changed():
+            GPS.Logger("XREF").log("No LI file changed, gnatinspect not run")
+            GPS.Hook("xref_updated").run()
+            return
+
+        self.launched_li_files = self.li_files_timestamps()
+
         # We are about to launch gnatinspect
         self.gnatinspect_launch_registered = False
         self.gnatinspect_already_running = True
@@ -171,7 +253,7 @@ class Sqlite_Cross_References(object):
                             "Check Semantic", "Update file XRef",
                             "Update file XRef in background"] or
                 category in ["Makefile", "CodePeer"]):
-            self.recompute_xref()
+            self.recompute_xref(full=False)
 
     def on_project_view_changed(self, hook):
         self.recompute_xref()
@@ -180,7 +262,7 @@ class Sqlite_Cross_References(object):
         self.trusted_mode = GPS.Preference("Prj-Editor-Trusted-Mode").get()
 
     def on_rsync_finished(self, hook):
-        self.recompute_xref()
+        self.recompute_xref(full=False)
 
 
 r = Sqlite_Cross_References()
@@ -194,7 +276,7 @@ class GnatInspect_OnExit_Hook(tool_output.OutputParser):
             GPS.Logger("XREF").log(
                 "gnatinspect returned with status %s" % status)
 
-        r.gnatinspect_completed()
+        r.gnatinspect_completed(status)
 
         if not r.gnatinspect_already_running:
             GPS.Hook("xref_updated").run()
@@ -4,6 +4,7 @@ files.
 """
 
 import GPS
+import re
 import time
 import traceback
 
@@ -14,6 +15,37 @@ except Exception:
     gobject_available = 0
 
 
+def merge_spans(spans):
+    """
+    Sort a list of (start, end) spans, and merge the ones that overlap or
+    are adjacent. Both bounds of a span are inclusive.
+
+    :param list[(int, int)] spans: the spans to merge.
+    :rtype: list[(int, int)]
+    """
+    result = []
+    for start, end in sorted(spans):
+        if result and start <= result[-1][1] + 1:
+            if end > result[-1][1]:
+                result[-1] = (result[-1][0], end)
+        else:
+            result.append((start, end))
+    return result
+
+
+def _get_gtk_buffer(buffer):
+    """
+    Return the Gtk.TextBuffer of buffer, or None if it is not available.
+
+    :param GPS.EditorBuffer buffer: the editor buffer.
+    """
+    try:
+        from pygps import get_gtk_buffer
+        return get_gtk_buffer(buffer)
+    except Exception:
+        return None
+
+
 class OverlayStyle(object):
 
     """
@@ -108,6 +140,25 @@ class OverlayStyle(object):
                 over.ts = self._style_ts
             return over
 
+    def __apply_message(self, buffer, over, start, end):
+        """
+        Highlight part of the buffer with a message.
+        """
+        msg = GPS.Message(
+            category=self.name,
+            file=buffer.file(),
+            line=start.line(),
+            column=start.column(),  # index in python starts at 0
+            text="",
+            show_on_editor_side=True,
+            show_in_locations=False)
+
+        if self.whole_line:
+            msg.set_style(over)
+        else:
+            msg.set_style(over, end.column() - start.column() + 1)
+        self._messages.append(msg)
+
     def apply(self, start, end):
         """
         Apply the highlighting to part of the buffer.
@@ -119,24 +170,53 @@ class OverlayStyle(object):
         over = self.__create_style(buffer)
 
         if self.use_messages():
-            msg = GPS.Message(
-                category=self.name,
-                file=buffer.file(),
-                line=start.line(),
-                column=start.column(),  # index in python starts at 0
-                text="",
-                show_on_editor_side=True,
-                show_in_locations=False)
-
-            if self.whole_line:
-                msg.set_style(over)
-            else:
-                msg.set_style(over, end.column() - start.column() + 1)
-            self._messages.append(msg)
-
+            self.__apply_message(buffer, over, start, end)
         else:
             buffer.apply_overlay(over, start, end)
 
+    def apply_batch(self, buffer, spans):
+        """
+        Apply the highlighting to several parts of the buffer at once.
+        Overlapping and adjacent spans are merged first.
+
+        When the style uses an overlay, the whole batch is applied directly
+        on the underlying Gtk.TextBuffer, instead of going through a
+        `GPS.EditorLocation` pair and a call to
+        `GPS.EditorBuffer.apply_overlay` for each span.
+
+        :param GPS.EditorBuffer buffer: the buffer to highlight.
+        :param spans: a list of (start_offset, end_offset), the offsets of
+           the first and last characters of each highlighted region (see
+           `GPS.EditorLocation.offset`).
+        """
+        spans = merge_spans(spans)
+        if not spans:
+            return
+
+        over = self.__create_style(buffer)
+
+        if not self.use_messages():
+            gtk_buffer = _get_gtk_buffer(buffer)
+            tag = (gtk_buffer.get_tag_table().lookup(self.name)
+                   if gtk_buffer is not None and self.name else None)
+
+            if tag is not None:
+                start_iter = gtk_buffer.get_start_iter()
+                end_iter = gtk_buffer.get_start_iter()
+                for start, end in spans:
+                    start_iter.set_offset(start)
+                    end_iter.set_offset(end + 1)
+                    gtk_buffer.apply_tag(tag, start_iter, end_iter)
+                return
+
+        origin = buffer.beginning_of_buffer()
+        for start, end in spans:
+            if self.use_messages():
+                self.__apply_message(
+                    buffer, over, origin + start, origin + end)
+            else:
+                buffer.apply_overlay(over, origin + start, origin + end)
+
     def remove(self, start, end=None):
         """
         Remove the highlighting in whole or part of the buffer.
@@ -189,27 +269,49 @@ class Background_Highlighter(object):
         e.start_highlight(buffer1)   # start highlighting a first buffer
         e.start_highlight(buffer2)   # start highlighting a second buffer
 
+    The number of lines processed in each batch is adapted to the time
+    taken by process(), so that each batch fits in tick_budget_ms. When
+    several highlighters are running, they share the budget of the
+    coordinator instead. Once a buffer has been processed, statistics are
+    logged to the HIGHLIGHTER.STATS trace.
+
     :param OverlayStyle style: style to use for highlighting.
     """
     # Interval in milliseconds between two batches.
     # This is only used when gobject is not available
     timeout_ms = 40
 
-    # Number of lines to process at each iteration
+    # Number of lines to process at the first iteration. The number of lines
+    # processed at the next iterations is adapted so that each of them fits
+    # in tick_budget_ms.
     batch_size = 20
 
+    # Time budget of each iteration, in milliseconds. If 0, batch_size lines
+    # are always processed at each iteration.
+    tick_budget_ms = 4
+
+    # Bounds of the number of lines processed at each iteration
+    min_batch_size = 1
+    max_batch_size = 5000
+
     # If True, highlighting is always done in the
     # foreground. This is for testsuite purposes
     synchronous = False
 
     def __init__(self, style):
-        self.__source_id = None  # The gtk source_id used for background
-        # or the GPS.Timeout instance
+        self.__source_id = None  # The GPS.Timeout instance used for
+        # background highlighting when gobject is not available
+        self.__coordinated = False  # Whether run by the coordinator
         self.__buffers = []      # The list of buffers to highlight
         self.terminated = False
         self.highlighted = 0
         self.highlighted_limit = 0
 
+        # Current number of lines processed at each iteration, and statistics
+        # for the buffer being processed
+        self.__batch_size = self.batch_size
+        self.__reset_stats()
+
         self.style = style
         GPS.Hook("before_exit_action_hook").add(self.__before_exit)
         GPS.Hook("file_closed").add(self.__on_file_closed)
@@ -220,6 +322,7 @@ class Background_Highlighter(object):
 
     def __del__(self):
         self.__source_id = None  # Don't try to kill the idle, GPS is quitting
+        self.__coordinated = False
         self.stop_highlight()
         GPS.Hook("before_exit_action_hook").remove(self.__before_exit)
         GPS.Hook("file_closed").remove(self.__on_file_closed)
@@ -234,6 +337,7 @@ class Background_Highlighter(object):
         """
         self.terminated = True
         self.__source_id = None  # Don't try to kill the idle, GPS is quitting
+        self.__coordinated = False
         self.stop_highlight()
         return True
 
@@ -305,10 +409,10 @@ class Background_Highlighter(object):
                 while self.__do_highlight():
                     pass
 
-            elif self.__source_id is None:
+            elif self.__source_id is None and not self.__coordinated:
                 if gobject_available:
-                    self.__source_id = GLib.idle_add(
-                        self.__do_highlight)  # , priority=GLib.PRIORITY_LOW)
+                    self.__coordinated = True
+                    coordinator.add(self)
                 else:
                     self.__source_id = GPS.Timeout(
                         self.timeout_ms, self.__do_highlight)
@@ -348,19 +452,26 @@ class Background_Highlighter(object):
         """
 
         if buffer is not None:
-            for b in self.__buffers:
+            for idx, b in enumerate(self.__buffers):
                 if b[0] == buffer:
+                    # The statistics are those of the first buffer
+                    if idx == 0:
+                        self.__log_stats(buffer)
                     self.__buffers.remove(b)
                     return
 
-        elif self.__source_id:
-            if gobject_available:
-                GLib.source_remove(self.__source_id)
+        elif self.__source_id or self.__coordinated:
+            if self.__coordinated:
+                coordinator.remove(self)
+                self.__coordinated = False
             else:
                 self.__source_id.remove()
-            self.__source_id = None
+                self.__source_id = None
 
+            if self.__buffers:
+                self.__log_stats(self.__buffers[0][0])
             self.__buffers = []
+            self.__reset_stats()
 
     def remove_highlight(self, buffer=None):
         """
@@ -374,6 +485,54 @@ class Background_Highlighter(object):
         if buffer is not None and self.style is not None:
             self.style.remove(buffer)
 
+    def __reset_stats(self):
+        """
+        Reset the statistics on the processing of the current buffer
+        """
+        self.__stats_lines = 0
+        self.__stats_ticks = 0
+        self.__stats_time = 0.0
+
+    def __record_tick(self, nb_lines, elapsed, budget_ms=None):
+        """
+        Record that nb_lines were processed in elapsed seconds during one
+        iteration, and adapt the number of lines for the next iteration so
+        that it fits in tick_budget_ms, or in budget_ms if that is smaller.
+        """
+        self.__stats_lines += nb_lines
+        self.__stats_ticks += 1
+        self.__stats_time += elapsed
+
+        if self.tick_budget_ms and nb_lines > 0:
+            budget = self.tick_budget_ms
+            if budget_ms:
+                budget = min(budget, budget_ms)
+            target = nb_lines * budget / max(elapsed * 1000.0, 0.001)
+
+            # Only move halfway towards the target, so that a single slow
+            # or fast iteration does not change the batch size too much
+            self.__batch_size = int(max(
+                self.min_batch_size,
+                min(self.max_batch_size, (self.__batch_size + target) / 2)))
+
+    def __log_stats(self, buffer):
+        """
+        Log the statistics on the processing of buffer, and reset them
+        """
+        logger = GPS.Logger("HIGHLIGHTER.STATS")
+        if logger.active and self.__stats_ticks:
+            logger.log(
+                "%s on %s: %d lines in %d ticks, %.1f ms (%.0f lines/s),"
+                " batch size %d" % (
+                    self.__class__.__name__,
+                    buffer.file().base_name(),
+                    self.__stats_lines,
+                    self.__stats_ticks,
+                    self.__stats_time * 1000.0,
+                    self.__stats_lines / max(self.__stats_time, 0.000001),
+                    self.__batch_size))
+        self.__reset_stats()
+
     def process(self, start, end):
         """
         Called to highlight the given range of editor. When this is called,
@@ -384,11 +543,76 @@ class Background_Highlighter(object):
         """
         pass
 
+    def process_lines(self, start, end, lines, offset):
+        """
+        Same as process, but also receives the text of the range, which was
+        fetched once for all the highlighters processing the same lines.
+        Highlighters that need the text of the range should override this
+        function to avoid fetching it again. By default, this calls process.
+
+        :param GPS.EditorLocation start: start of region to process.
+        :param GPS.EditorLocation end: end of region to process.
+        :param list[unicode] lines: the text of each line of the region,
+           without the newline characters.
+        :param integer offset: the offset of the start of the region in the
+           buffer (see `GPS.EditorLocation.offset`).
+        """
+        self.process(start, end)
+
+    def _next_batch(self):
+        """
+        Return the buffer and the first and last lines of the range that
+        will be processed at the next iteration, or None.
+
+        :rtype: (GPS.EditorBuffer, integer, integer)|None
+        """
+        if self.terminated or not self.__buffers:
+            return None
+
+        (buffer, min_line, max_line,
+         start_line, end_line, backward, _) = self.__buffers[0]
+
+        if min_line >= start_line and (backward or max_line >= end_line):
+            return (buffer, max(start_line, min_line - self.__batch_size),
+                    min_line)
+        elif max_line < end_line:
+            return (buffer, max_line,
+                    min(end_line - 1, max_line + self.__batch_size))
+        else:
+            return None
+
+    def _highlight_batch(self, lines, budget_ms):
+        """
+        Run one iteration, using the text fetched by the coordinator.
+
+        :param lines: a tuple (first_line, lines, offset) describing the
+           text of the range returned by _next_batch, or None if it could
+           not be fetched.
+        :param float budget_ms: the share of the coordinator's time budget
+           given to self at each iteration.
+        :return: whether to keep processing.
+        """
+        return self.__do_highlight(lines=lines, budget_ms=budget_ms)
+
+    def __process(self, start, end, first_line, last_line, lines):
+        """
+        Process the given range, with process_lines if its text was fetched
+        by the coordinator, or with process otherwise.
+        """
+        if lines is not None and lines[0] == first_line and \
+                len(lines[1]) == last_line - first_line + 1:
+            self.process_lines(start, end, lines[1], lines[2])
+        else:
+            self.process(start, end)
+
     def __do_highlight(self, *args, **kwargs):
         """
         The function called at regular intervals, and that computes
         the range of lines to highlight.
         """
+        lines = kwargs.get("lines", None)
+        budget_ms = kwargs.get("budget_ms", None)
+
         if self.terminated:
             return False
 
@@ -402,9 +626,11 @@ class Background_Highlighter(object):
              self.highlighted) = self.__buffers[0]
 
             changed = False
+            tick_start = time.time()
+            nb_lines = 0
 
             if min_line >= start_line and (backward or max_line >= end_line):
-                from_line = max(start_line, min_line - self.batch_size)
+                from_line = max(start_line, min_line - self.__batch_size)
 
                 f = buffer.at(from_line, 1)
 
@@ -414,7 +640,8 @@ class Background_Highlighter(object):
                     if self.style:
                         self.style.remove(f, e)
 
-                    self.process(f, e)
+                    self.__process(f, e, from_line, min_line, lines)
+                    nb_lines = min_line - from_line + 1
 
                 min_line = from_line - 1
                 if max_line < end_line:
@@ -422,7 +649,7 @@ class Background_Highlighter(object):
                 changed = True
 
             elif max_line < end_line:
-                to_line = min(end_line - 1, max_line + self.batch_size)
+                to_line = min(end_line - 1, max_line + self.__batch_size)
 
                 # It is possible that the buffer has been changed so that one
                 # of the locations is now invalid, so we just protect.
@@ -435,7 +662,8 @@ class Background_Highlighter(object):
 
                         if self.style:
                             self.style.remove(f, e)
-                        self.process(f, e)
+                        self.__process(f, e, max_line, to_line, lines)
+                        nb_lines = to_line - max_line + 1
 
                     max_line = to_line + 1
                     if min_line >= start_line:
@@ -444,12 +672,17 @@ class Background_Highlighter(object):
                 except Exception:
                     pass
 
+            if changed:
+                self.__record_tick(
+                    nb_lines, time.time() - tick_start, budget_ms)
+
             if changed and (self.highlighted_limit == 0 or
                             self.highlighted < self.highlighted_limit):
                 self.__buffers[0] = (
                     buffer, min_line, max_line, start_line, end_line,
                     backward, self.highlighted)
             else:
+                self.__log_stats(buffer)
                 self.__buffers.pop(0)
                 if self.__buffers:
                     self.on_start_buffer(self.__buffers[0][0])
@@ -463,6 +696,144 @@ class Background_Highlighter(object):
             return False
 
 
+class Highlighters_Coordinator(object):
+
+    """
+    Runs the iterations of all the background highlighters in a single
+    idle callback. At each iteration, the text of the lines that a
+    highlighter is about to process is fetched just before it runs, and
+    given to it through Background_Highlighter.process_lines. The
+    following highlighters of the same buffer reuse that text when it
+    covers their own range.
+
+    All the highlighters share tick_budget_ms, which includes the time
+    spent fetching the text. Each gets an equal share to size its batches.
+    Once the budget is spent, the remaining highlighters wait for the next
+    iteration, where they run first.
+    """
+
+    # Time budget of each iteration, in milliseconds, for all the
+    # highlighters together
+    tick_budget_ms = 4
+
+    def __init__(self):
+        self.__highlighters = []
+        self.__source_id = None
+        self.__in_idle = False
+
+    def add(self, highlighter):
+        """
+        Start running the iterations of highlighter.
+
+        :param Background_Highlighter highlighter: the highlighter.
+        """
+        if highlighter not in self.__highlighters:
+            self.__highlighters.append(highlighter)
+
+        if self.__source_id is None:
+            self.__source_id = GLib.idle_add(self.__on_idle)
+
+    def remove(self, highlighter):
+        """
+        Stop running the iterations of highlighter.
+
+        :param Background_Highlighter highlighter: the highlighter.
+        """
+        if highlighter in self.__highlighters:
+            self.__highlighters.remove(highlighter)
+
+        if not self.__highlighters and self.__source_id is not None \
+                and not self.__in_idle:
+            GLib.source_remove(self.__source_id)
+            self.__source_id = None
+
+    def __fetch_lines(self, highlighter, fetched):
+        """
+        Fetch the text of the range highlighter will process at this
+        iteration. The text already fetched for other highlighters during
+        this iteration is reused when it covers that range.
+
+        :param list fetched: the ranges fetched so far during this
+           iteration, as tuples (buffer, first_line, lines, offsets). The
+           range fetched for highlighter is added to it.
+        :return: a tuple (first_line, lines, offset), or None.
+        """
+        batch = highlighter._next_batch()
+        if batch is None:
+            return None
+
+        buffer, first, last = batch
+        for b, f, lines, offsets in fetched:
+            if b == buffer and f <= first and last < f + len(lines):
+                return (first, lines[first - f:last - f + 1],
+                        offsets[first - f])
+
+        try:
+            start = buffer.at(first, 1)
+            offset = start.offset()
+
+            # Folded lines are processed separately
+            if first > 1 and offset == 0:
+                return None
+
+            text = buffer.get_chars(start, buffer.at(last, 1).end_of_line())
+            text = text.decode("utf-8")
+        except Exception:
+            return None
+
+        lines = text.split("\n")
+        if text.endswith("\n"):
+            lines.pop()
+        if len(lines) != last - first + 1:
+            return None
+
+        offsets = [offset]
+        for line in lines:
+            offsets.append(offsets[-1] + len(line) + 1)
+
+        fetched.append((buffer, first, lines, offsets))
+        return (first, lines, offset)
+
+    def __on_idle(self):
+        self.__in_idle = True
+        try:
+            highlighters = list(self.__highlighters)
+            deadline = time.time() + self.tick_budget_ms / 1000.0
+            share = self.tick_budget_ms / float(len(highlighters) or 1)
+            fetched = []
+
+            done = []
+            for h in highlighters:
+                if done and time.time() >= deadline:
+                    break
+                done.append(h)
+                if h not in self.__highlighters:
+                    continue
+
+                # Fetching the text is part of the highlighter's share
+                start = time.time()
+                lines = self.__fetch_lines(h, fetched)
+                budget = share - (time.time() - start) * 1000.0
+                if not h._highlight_batch(lines, max(budget, 0.001)):
+                    self.remove(h)
+
+            # The highlighters that did not run go first next time
+            self.__highlighters = (
+                [h for h in self.__highlighters if h not in done] +
+                [h for h in done if h in self.__highlighters])
+        finally:
+            self.__in_idle = False
+
+        if not self.__highlighters:
+            self.__source_id = None
+            return False
+        return True
+
+
+coordinator = Highlighters_Coordinator()
+# The coordinator of all background highlighters
+
+
 class On_The_Fly_Highlighter(Background_Highlighter):
 
     """
@@ -680,22 +1051,35 @@ class Regexp_Highlighter(On_The_Fly_Highlighter):
        is done on small sections of the editor at a time, and it might
        not detect cases where the regular expression would match across
        sections.
+       Note that this uses the syntax of Python's re module (in multiline
+       mode), and no longer that of the editor's search. The two agree on
+       the usual constructs, but might differ on less common ones.
     :param OverlayStyle style: the style to apply.
+    :param bool case_sensitive: whether the search is case sensitive. As
+       with the editor's search, it is case insensitive by default.
     """
 
-    def __init__(self, regexp, style, context_lines=0):
+    def __init__(self, regexp, style, context_lines=0, case_sensitive=False):
         self.regexp = regexp
+        self.flags = re.M | re.U | (0 if case_sensitive else re.I)
         On_The_Fly_Highlighter.__init__(
             self, context_lines=context_lines, style=style)
 
+    def __highlight_text(self, buffer, text, offset):
+        spans = []
+        for m in re.finditer(self.regexp, text, self.flags):
+            if m.end() > m.start():
+                spans.append((offset + m.start(), offset + m.end() - 1))
+
+        self.style.apply_batch(buffer, spans)
+
     def process(self, start, end):
-        while True:
-            start = start.search(
-                self.regexp, regexp=True, dialog_on_failure=False)
-            if not start or start[0] > end:
-                return
-            self.style.apply(start[0], start[1] - 1)
-            start = start[1] + 1
+        buffer = start.buffer()
+        text = buffer.get_chars(start, end).decode("utf-8")
+        self.__highlight_text(buffer, text, start.offset())
+
+    def process_lines(self, start, end, lines, offset):
+        self.__highlight_text(start.buffer(), u"\n".join(lines), offset)
 
 
 class Text_Highlighter(On_The_Fly_Highlighter):
@@ -719,12 +1103,21 @@ class Text_Highlighter(On_The_Fly_Highlighter):
         On_The_Fly_Highlighter.__init__(
             self, context_lines=context_lines, style=style)
 
+    def __highlight_text(self, buffer, text, offset):
+        pattern = re.escape(self.text)
+        if self.whole_word:
+            pattern = r"\b{0}\b".format(pattern)
+
+        spans = [(offset + m.start(), offset + m.end() - 1)
+                 for m in re.finditer(pattern, text, re.I | re.U)
+                 if m.end() > m.start()]
+
+        self.style.apply_batch(buffer, spans)
+
     def process(self, start, end):
-        while True:
-            start = start.search(
-                self.text, regexp=False, dialog_on_failure=False,
-                whole_word=self.whole_word)
-            if not start or start[0] > end:
-                return
-            self.style.apply(start[0], start[1] - 1)
-            start = start[1] + 1
+        buffer = start.buffer()
+        text = buffer.get_chars(start, end).decode("utf-8")
+        self.__highlight_text(buffer, text, start.offset())
+
+    def process_lines(self, start, end, lines, offset):
+        self.__highlight_text(start.buffer(), u"\n".join(lines), offset)
@@ -0,0 +1,620 @@
+"""
+Benchmarks for the highlighter engine, that can be run outside of GPS::
+
+    python share/support/languages/highlighter/benchmark.py
+    python share/support/languages/highlighter/benchmark.py --dispatch
+    python share/support/languages/highlighter/benchmark.py --tags
+    python share/support/languages/highlighter/benchmark.py --check
+
+When the GPS module is not available, minimal stand-ins are installed for
+the GPS specific modules that the highlighters import, so that the
+highlighters shipped with GPS can be loaded and measured from the command
+line. The highlighters are run on a stand-in for Gtk.TextBuffer.
+
+For each language and corpus size, the default benchmark reports the time
+needed to highlight the whole buffer, the latency of the rehighlighting
+done synchronously after a keystroke, and the peak size of the
+HighlighterStacks of the buffer.
+
+With --tags, the tags are also applied to the buffer after each keystroke,
+the same way the editors do (synchronous rehighlighting of the visible
+lines, then background highlighting until the stacks converge), with and
+without the cache of the tags applied on each line. The stand-in buffer
+counts the calls to apply and remove tags.
+
+With --check, the tags of every character are recorded instead, and after
+each keystroke they are compared with those of a full rehighlighting of the
+same text. The process exits with a non-zero status if they differ.
+"""
+
+import argparse
+import bisect
+import os
+import random
+import sys
+import time
+import types
+
+# The highlighters shipped with GPS, by language
+LANGUAGES = {
+    "python": "python_highlighter",
+    "c": "c_highlighter",
+    "css": "css_highlighter",
+    "fortran 90": "fortran_highlighter",
+}
+
+# Number of lines rehighlighted synchronously after a keystroke, which is
+# about the size of the visible range of an editor.
+VISIBLE_LINES = 60
+
+# The characters typed to simulate keystrokes. Some of them open or close
+# regions, so that the highlighting does not always converge immediately.
+KEYSTROKES = u"a1 (\"'#!/*\n"
+
+# Small samples of source code, repeated to build the benchmark corpora
+SAMPLES = {
+    "python": '''
+class Point(object):
+    """
+    A point in the plane. TODO: support 3D points
+    """
+
+    def __init__(self, x=0, y=0.5):
+        self.x = x  # NOTE: abscissa
+        self.y = y
+        self.label = 'p{0}'.format(len(str(x)))
+
+    def __repr__(self):
+        return "<Point {0} {1}>\\n".format(self.x, self.y)
+''',
+    "c": '''
+#include <stdio.h>
+#define MAX_POINTS 1024
+
+/* A point in the plane.
+   TODO: support 3D points */
+struct point {
+    int x;
+    float y;  // NOTE: ordinate
+};
+
+static int count_points (const char *name, char sep)
+{
+    int n = 0;
+    if (sep == '\\t') {
+        printf ("%s: %d points\\n", name, MAX_POINTS);
+    }
+    return n + 12;
+}
+''',
+    "css": '''
+/* Colors of the editor. TODO: dark variant */
+GtkTextView, .gps-editor #main-view {
+    color: #ffaa00;
+    background-color: rgba(0, 0, 0, 0);
+    border: 1px solid white;
+    font-family: 'Monospace';
+    padding: 2px 4em;
+}
+''',
+    "fortran 90": '''
+! Compute the norm of a vector. TODO: handle NaNs
+program norm
+  implicit none
+  real :: v(3) = (/ 1.0, 2.5, 3.0 /)
+  integer :: i
+  character(len=*), parameter :: fmt = '(A, F8.3)'
+
+  do i = 1, 3
+     if (v(i) < 0.0) then
+        print *, "negative value at ", i  ! NOTE: should not happen
+     end if
+  end do
+  write (*, fmt) 'norm: ', sqrt(sum(v ** 2))
+end program norm
+''',
+}
+
+
+def install_stand_ins():
+    """
+    Install stand-ins for the modules only available inside GPS, if needed.
+    """
+    try:
+        import GPS  # noqa
+        return
+    except ImportError:
+        pass
+
+    class Preference(object):
+        def __init__(self, name):
+            self.name = name
+
+        def create_style(self, *args, **kwargs):
+            pass
+
+        def get(self):
+            return "DEFAULT@#000000@rgba(0,0,0,0)"
+
+    gps = types.ModuleType("GPS")
+    gps.Preference = Preference
+    sys.modules["GPS"] = gps
+
+    modules = types.ModuleType("modules")
+    modules.Module = object
+    sys.modules["modules"] = modules
+
+    theme_handling = types.ModuleType("theme_handling")
+    theme_handling.variant_prefs = {}
+    theme_handling.common_dark = {}
+    theme_handling.common_light = {}
+    theme_handling.Color = str
+    sys.modules["theme_handling"] = theme_handling
+
+
+def load_highlighters(languages=LANGUAGES):
+    """
+    Load the highlighters for languages, and return a dictionary mapping
+    each language to its Highlighter.
+
+    :rtype: dict[str, highlighter.engine.Highlighter]
+    """
+    install_stand_ins()
+    languages_dir = os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__)))
+    if languages_dir not in sys.path:
+        sys.path.insert(0, languages_dir)
+
+    from highlighter.engine import HighlighterModule
+    for module in languages.values():
+        __import__(module)
+
+    return {lang: HighlighterModule.highlighters[lang] for lang in languages}
+
+
+def make_corpus(language, nb_lines):
+    """
+    Return a text of about nb_lines lines, built by repeating the sample of
+    language.
+
+    :rtype: unicode
+    """
+    sample = SAMPLES[language]
+    repeat = nb_lines // sample.count("\n") + 1
+    return u"".join([sample] * repeat)
+
+
+####################################
+# Matcher dispatch micro-benchmark #
+####################################
+
+def dispatch_scan(hl, m):
+    """
+    Find the matcher of m by scanning all the groups of the pattern
+    """
+    i = [j for j in range(1, len(hl.matchers) + 1)
+         if m.span(j) != (-1, -1)][0]
+    return hl.matchers[i - 1]
+
+
+def dispatch_lastindex(hl, m):
+    """
+    Find the matcher of m through the lastindex of the match
+    """
+    return hl.matchers[hl.group_index[m.lastindex]]
+
+
+def tokenize(root, text, dispatch):
+    """
+    Tokenize text the same way the engine does, and return the number of
+    tokens found.
+    """
+    from highlighter.engine import RegionMatcher
+
+    stack = [root]
+    offset = 0
+    count = 0
+
+    while True:
+        hl = stack[-1]
+        for m in hl.pattern.finditer(text, offset):
+            matcher = dispatch(hl, m)
+            count += 1
+            if matcher is None:
+                stack.pop()
+                offset = m.end()
+                break
+            elif isinstance(matcher, RegionMatcher):
+                stack.append(matcher.subhighlighter)
+                offset = m.end()
+                break
+        else:
+            return count
+
+
+def bench_dispatch(nb_lines=20000, repeat=3):
+    """
+    Measure the number of tokens per second of the engine's tokenization
+    loop, with both dispatch strategies.
+    """
+    highlighters = load_highlighters()
+    print("{0:<10} {1:>8} {2:>14} {3:>14} {4:>8}".format(
+        "language", "tokens", "scan tok/s", "lastindex tok/s", "speedup"))
+
+    for lang in sorted(highlighters):
+        root = highlighters[lang].root_highlighter
+        text = make_corpus(lang, nb_lines)
+        rates = []
+        for dispatch in (dispatch_scan, dispatch_lastindex):
+            best = None
+            for _ in range(repeat):
+                t = time.time()
+                count = tokenize(root, text, dispatch)
+                elapsed = time.time() - t
+                best = elapsed if best is None else min(best, elapsed)
+            rates.append(count / best)
+
+        print("{0:<10} {1:>8} {2:>14.0f} {3:>14.0f} {4:>7.2f}x".format(
+            lang, count, rates[0], rates[1], rates[1] / rates[0]))
+
+
+###########################
+# Highlighting benchmarks #
+###########################
+
+class TextIter(object):
+    """
+    Stand-in for Gtk.TextIter, as used by the engine
+    """
+
+    def __init__(self, buf, offset):
+        self.buf = buf
+        self.offset = offset
+
+    def get_offset(self):
+        return self.offset
+
+    def get_line(self):
+        return bisect.bisect_right(self.buf.line_starts, self.offset) - 1
+
+    def backward_char(self):
+        self.offset = max(self.offset - 1, 0)
+
+    def set_offset(self, offset):
+        self.offset = offset
+
+    def copy(self):
+        return TextIter(self.buf, self.offset)
+
+    def forward_line(self):
+        line = self.get_line() + 1
+        if line < len(self.buf.line_starts):
+            self.offset = self.buf.line_starts[line]
+        else:
+            self.offset = len(self.buf.text)
+
+
+class TagTable(object):
+    """
+    Stand-in for Gtk.TextTagTable. Every style is known, so the engine
+    never needs to create tags.
+    """
+
+    def lookup(self, name):
+        return name
+
+
+class TextBuffer(object):
+    """
+    Stand-in for Gtk.TextBuffer, holding the text in a unicode string
+    """
+
+    def __init__(self, text):
+        from highlighter.engine import HighlighterStacks, \
+            HighlighterTagsCache
+
+        self.tag_table = TagTable()
+        self.stacks = HighlighterStacks()
+        self.tags_cache = HighlighterTagsCache()
+        self.dirty_lines = set()
+        self.tag_calls = 0
+        self.set_text(text)
+
+    def set_text(self, text):
+        self.text = text
+        self.line_starts = [0]
+        idx = text.find("\n")
+        while idx != -1:
+            self.line_starts.append(idx + 1)
+            idx = text.find("\n", idx + 1)
+
+    def insert(self, line, column, text):
+        """
+        Insert text at the given location, and update the highlighter stacks
+        the same way the engine does when text is inserted in an editor.
+        """
+        offset = self.line_starts[line] + column
+        self.set_text(self.text[:offset] + text + self.text[offset:])
+        nb_lines = text.count("\n")
+        self.stacks.insert_newlines(nb_lines, line)
+        self.tags_cache.insert_newlines(nb_lines, line)
+        self.dirty_lines = set(
+            l + nb_lines if l > line else l for l in self.dirty_lines)
+
+    def get_tag_table(self):
+        return self.tag_table
+
+    def apply_tag(self, tag, start, end):
+        self.tag_calls += 1
+
+    def remove_tag(self, tag, start, end):
+        self.tag_calls += 1
+
+    def remove_all_tags(self, start, end):
+        self.tag_calls += 1
+
+    def get_start_iter(self):
+        return TextIter(self, 0)
+
+    def get_line_count(self):
+        return len(self.line_starts)
+
+    def get_iter_at_line(self, line):
+        if line >= len(self.line_starts):
+            return self.get_end_iter()
+        return TextIter(self, self.line_starts[line])
+
+    def get_end_iter(self):
+        return TextIter(self, len(self.text))
+
+    def get_text(self, start, end, include_hidden_chars):
+        return self.text[start.offset:end.offset].encode("utf-8")
+
+
+def stacks_size(stacks):
+    """
+    Return an estimate of the memory used by stacks, in bytes.
+
+    :type stacks: highlighter.engine.HighlighterStacks
+    """
+    tuples = {id(s): s for s in stacks.stacks_list}
+    return (sys.getsizeof(stacks.stacks_list) +
+            sum(sys.getsizeof(s) for s in tuples.values()))
+
+
+def percentile(values, p):
+    """
+    :type values: list[float]
+    :type p: float
+    """
+    values = sorted(values)
+    return values[int(round(p * (len(values) - 1)))]
+
+
+def bench_highlighting(sizes, nb_keystrokes, seed=0):
+    """
+    Run the highlighters on corpora of the given sizes, in lines.
+    """
+    highlighters = load_highlighters()
+    rand = random.Random(seed)
+
+    print("{0:<10} {1:>7} {2:>9} {3:>11} {4:>11} {5:>12}".format(
+        "language", "lines", "full (s)", "key p50 ms", "key p99 ms",
+        "stacks (KB)"))
+
+    for lang in sorted(highlighters):
+        highlighter = highlighters[lang]
+        for nb_lines in sizes:
+            buf = TextBuffer(make_corpus(lang, nb_lines))
+
+            t = time.time()
+            highlighter.highlight_info_gen(buf, 0)
+            full_time = time.time() - t
+            peak_size = stacks_size(buf.stacks)
+
+            latencies = []
+            for _ in range(nb_keystrokes):
+                line = rand.randrange(buf.get_line_count())
+                line_len = (buf.get_iter_at_line(line + 1).offset -
+                            buf.line_starts[line])
+                buf.insert(line, rand.randint(0, max(line_len - 1, 0)),
+                           rand.choice(KEYSTROKES))
+
+                t = time.time()
+                highlighter.highlight_info_gen(buf, line,
+                                               line + VISIBLE_LINES)
+                latencies.append(time.time() - t)
+
+            # Keystrokes only insert text, so the stacks can only grow
+            peak_size = max(peak_size, stacks_size(buf.stacks))
+
+            print("{0:<10} {1:>7} {2:>9.3f} {3:>11.3f} {4:>11.3f} "
+                  "{5:>12.1f}".format(
+                      lang, buf.get_line_count(), full_time,
+                      percentile(latencies, 0.5) * 1000,
+                      percentile(latencies, 0.99) * 1000,
+                      peak_size / 1024.0))
+
+
+def make_uncached_tags_cache():
+    """
+    Return a HighlighterTagsCache that never finds any entry, so that the
+    tags of every line are computed and applied again.
+    """
+    from highlighter.engine import HighlighterTagsCache
+
+    class UncachedTagsCache(HighlighterTagsCache):
+        def get(self, index):
+            return None
+
+    return UncachedTagsCache()
+
+
+def bench_tags(sizes, nb_keystrokes, seed=0):
+    """
+    Highlight corpora of the given sizes, in lines, and apply the tags after
+    each simulated keystroke, with and without the cache of tags.
+    """
+    highlighters = load_highlighters()
+
+    print("{0:<10} {1:>7} {2:>8} {3:>11} {4:>11} {5:>12} {6:>11}".format(
+        "language", "lines", "cache", "key p50 ms", "key p99 ms",
+        "idle ms/key", "tags/key"))
+
+    for lang in sorted(highlighters):
+        highlighter = highlighters[lang]
+        for nb_lines in sizes:
+            for cached in (False, True):
+                # Same keystrokes in both modes
+                rand = random.Random(seed)
+                buf = TextBuffer(make_corpus(lang, nb_lines))
+                highlighter.gtk_highlight(buf)   # resets the cache of tags
+                if not cached:
+                    buf.tags_cache = make_uncached_tags_cache()
+                buf.tag_calls = 0
+
+                latencies = []
+                idle_time = 0
+                for _ in range(nb_keystrokes):
+                    line = rand.randrange(buf.get_line_count())
+                    line_len = (buf.get_iter_at_line(line + 1).offset -
+                                buf.line_starts[line])
+                    buf.insert(line, rand.randint(0, max(line_len - 1, 0)),
+                               rand.choice(KEYSTROKES))
+
+                    t = time.time()
+                    buf.dirty_lines.add(line)
+                    if min(buf.dirty_lines) == line:
+                        highlighter.highlight_lines(
+                            buf, line, line + VISIBLE_LINES)
+                    latencies.append(time.time() - t)
+
+                    t = time.time()
+                    while buf.dirty_lines:
+                        highlighter.idle_highlight(buf)
+                    idle_time += time.time() - t
+
+                print("{0:<10} {1:>7} {2:>8} {3:>11.3f} {4:>11.3f} "
+                      "{5:>12.3f} {6:>11.1f}".format(
+                          lang, buf.get_line_count(),
+                          "yes" if cached else "no",
+                          percentile(latencies, 0.5) * 1000,
+                          percentile(latencies, 0.99) * 1000,
+                          idle_time * 1000 / nb_keystrokes,
+                          buf.tag_calls / float(nb_keystrokes)))
+
+
+class TaggedTextBuffer(TextBuffer):
+    """
+    Stand-in for Gtk.TextBuffer that records the set of tags of each
+    character. Inserted characters have no tag.
+    """
+
+    def set_text(self, text):
+        if not hasattr(self, "tags"):
+            self.tags = [set() for _ in text]
+        TextBuffer.set_text(self, text)
+
+    def insert(self, line, column, text):
+        offset = self.line_starts[line] + column
+        self.tags[offset:offset] = [set() for _ in text]
+        TextBuffer.insert(self, line, column, text)
+
+    def apply_tag(self, tag, start, end):
+        for tags in self.tags[start.offset:end.offset]:
+            tags.add(tag)
+
+    def remove_tag(self, tag, start, end):
+        for tags in self.tags[start.offset:end.offset]:
+            tags.discard(tag)
+
+    def remove_all_tags(self, start, end):
+        for tags in self.tags[start.offset:end.offset]:
+            tags.clear()
+
+
+def check_tags(nb_lines, nb_keystrokes, seed=0):
+    """
+    Check that the tags applied after each simulated keystroke are the same
+    as those of a full rehighlighting of the buffer.
+
+    :return: the number of keystrokes after which the tags differed
+    :rtype: int
+    """
+    highlighters = load_highlighters()
+    errors = 0
+
+    for lang in sorted(highlighters):
+        highlighter = highlighters[lang]
+        rand = random.Random(seed)
+        buf = TaggedTextBuffer(make_corpus(lang, nb_lines))
+        highlighter.gtk_highlight(buf)
+        lang_errors = 0
+
+        for keystroke in range(nb_keystrokes):
+            line = rand.randrange(buf.get_line_count())
+            line_len = (buf.get_iter_at_line(line + 1).offset -
+                        buf.line_starts[line])
+            buf.insert(line, rand.randint(0, max(line_len - 1, 0)),
+                       rand.choice(KEYSTROKES))
+
+            buf.dirty_lines.add(line)
+            if min(buf.dirty_lines) == line:
+                highlighter.highlight_lines(buf, line, line + VISIBLE_LINES)
+            while buf.dirty_lines:
+                highlighter.idle_highlight(buf)
+
+            ref = TaggedTextBuffer(buf.text)
+            highlighter.gtk_highlight(ref)
+            diff = [i for i, tags in enumerate(ref.tags)
+                    if tags != buf.tags[i]]
+            if diff:
+                lang_errors += 1
+                print("{0}: keystroke {1} on line {2}: tags differ at "
+                      "offsets {3}".format(lang, keystroke, line, diff[:5]))
+
+                # Start again from the correct tags, to report the next
+                # errors independently
+                buf.tags = ref.tags
+                buf.stacks = ref.stacks
+                buf.tags_cache = ref.tags_cache
+
+        print("{0:<10} {1:>7} lines {2:>5} keystrokes: {3}".format(
+            lang, buf.get_line_count(), nb_keystrokes,
+            "ok" if not lang_errors else "FAILED"))
+        errors += lang_errors
+
+    return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the highlighters shipped with GPS")
+    parser.add_argument(
+        "--dispatch", action="store_true",
+        help="run the matcher dispatch micro-benchmark")
+    parser.add_argument(
+        "--tags", action="store_true",
+        help="also apply the tags, with and without the cache of tags")
+    parser.add_argument(
+        "--check", action="store_true",
+        help="compare the tags after each keystroke with a full"
+             " rehighlighting")
+    parser.add_argument(
+        "--lines", default="1000,10000,100000",
+        help="comma separated list of corpus sizes, in lines")
+    parser.add_argument(
+        "--keystrokes", type=int, default=200,
+        help="number of keystrokes simulated on each corpus")
+    args = parser.parse_args()
+
+    if args.dispatch:
+        bench_dispatch()
+    elif args.check:
+        if check_tags(int(args.lines.split(",")[0]), args.keystrokes):
+            sys.exit(1)
+    elif args.tags:
+        bench_tags([int(n) for n in args.lines.split(",")], args.keystrokes)
+    else:
+        bench_highlighting([int(n) for n in args.lines.split(",")],
+                           args.keystrokes)
@@ -4,11 +4,25 @@ from modules import Module
 try:
     # While building the doc, we might not have gi.repository
     from gi.repository import Gtk, GLib, Gdk, Pango
-    from pygps import get_gtk_buffer, is_editor_visible
+    from pygps import get_gtk_buffer, get_widgets_by_type, \
+        is_editor_visible
 except ImportError:
     pass
 
+import bisect
 import re
+import time
+
+# Maximum number of lines that are rehighlighted synchronously after a
+# modification of the buffer. Only the lines up to the end of the visible
+# range are highlighted synchronously, within that limit.
+SYNC_HIGHLIGHT_MAX_LINES = 1000
+
+# Number of lines rehighlighted at once in the background
+IDLE_HIGHLIGHT_CHUNK = 200
+
+# Time budget, in seconds, of a single idle slice of background highlighting
+IDLE_HIGHLIGHT_BUDGET = 0.01
 
 
 class HighlighterModule(Module):
@@ -352,6 +366,60 @@ class HighlighterStacks(object):
         )
 
 
+class HighlighterTagsCache(object):
+    """
+    Cache of the tags applied on each line of a buffer. Every entry is a
+    tuple (key, spans, end_stack), where key is the hash of the text of the
+    line, including its newline, combined with the stack of highlighters at
+    the start of the line, spans is the tuple of (tag, start, end) applied
+    on the line, with offsets relative to the start of the line, and
+    end_stack is the stack of highlighters at the start of the next line.
+    end_stack is None when a token continues on the next line, since the
+    tokens of the line then also depend on the text of the next one.
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def set(self, index, entry):
+        """
+        :type index: int
+        :type entry: ((int, tuple[Struct]), tuple[(Gtk.TextTag, int, int)],
+                      tuple[Struct]|None)
+        """
+        if index >= len(self.lines):
+            self.lines.extend([None] * (index + 1 - len(self.lines)))
+        self.lines[index] = entry
+
+    def get(self, index):
+        """
+        :type index: int
+        @rtype: ((int, tuple[Struct]), tuple[(Gtk.TextTag, int, int)],
+                 tuple[Struct]|None)|None
+        """
+        return self.lines[index] if index < len(self.lines) else None
+
+    def insert_newlines(self, nb_lines, after_line):
+        """
+        Called when text is inserted on after_line. The characters of that
+        line changed, even if its text might be the same, so its entry is
+        dropped too.
+
+        :type after_line: int
+        :type nb_lines:   int
+        """
+        self.lines[after_line:after_line + 1] = [None] * (nb_lines + 1)
+
+    def delete_lines(self, nb_deleted_lines, at_line):
+        """
+        Called when text is deleted on at_line, whose entry is dropped.
+
+        :param nb_deleted_lines: int
+        :param at_line: int
+        """
+        self.lines[at_line:at_line + nb_deleted_lines + 1] = [None]
+
+
 class SubHighlighter(object):
 
     def __init__(self, highlighter_spec, stop_pattern=None,
@@ -368,10 +436,20 @@ class SubHighlighter(object):
             self.matchers.append(None)
 
         self.pattern = re.compile(
-            "|".join("({0})".format(pat) for pat in patterns),
+            "|".join("(?P<m{0}>{1})".format(i, pat)
+                     for i, pat in enumerate(patterns)),
             flags=re.M + (re.S if matchall else 0) +
             (re.I if igncase else 0)
         )
+
+        # Map the number of the group of each matcher to the index of the
+        # matcher. The group of the matcher is the outermost group of its
+        # alternative, so it is always the match's lastindex.
+        self.group_index = {
+            self.pattern.groupindex["m{0}".format(i)]: i
+            for i in range(len(patterns))
+        }
+
         self.gtk_tag = None
         self.region_start = None
         self.parent_cat = None
@@ -382,6 +460,18 @@ class SubHighlighter(object):
         """
         return [m.init_tag(gtk_ed) if m else None for m in self.matchers]
 
+    def get_dispatch_table(self, gtk_ed):
+        """
+        Return a table mapping the lastindex of a match to the corresponding
+        matcher and tag.
+
+        :type gtk_ed: Gtk.TextBuffer
+        :rtype: dict[int, (Matcher, Gtk.TextTag)]
+        """
+        tags = self.get_tags_list(gtk_ed)
+        return {group: (self.matchers[i], tags[i])
+                for group, i in self.group_index.items()}
+
     def __str__(self):
         return "<{0}>".format((self.parent_cat.name if self.parent_cat.name
                                else "") if self.parent_cat else "Root")
@@ -399,6 +489,11 @@ class Highlighter(object):
         """
         self.root_highlighter = SubHighlighter(spec, igncase=igncase)
         self.sync_stop = False
+        self.sync_line = 0
+
+        # The lines whose newline is part of a token, as found by the last
+        # call to highlight_info
+        self.continued_lines = set()
 
     def highlight_info_gen(self, gtk_ed, start_line, end_line=0):
         """
@@ -408,7 +503,21 @@ class Highlighter(object):
         :type gtk_ed: Gtk.TextBuffer
         :type start_line: int
         """
+        return self.highlight_info(gtk_ed, start_line, end_line)[0]
+
+    def highlight_info(self, gtk_ed, start_line, end_line=0,
+                       min_sync_line=0):
+        """
+        Same as highlight_info_gen, but also returns the text that was
+        highlighted and its offset in the buffer. The highlighting does not
+        stop when the stacks converge before min_sync_line.
+
+        :type gtk_ed: Gtk.TextBuffer
+        :type start_line: int
+        :rtype: (list[(Gtk.TextTag, int, int)], unicode, int)
+        """
         self.sync_stop = False
+        self.continued_lines = set()
 
         start = gtk_ed.get_iter_at_line(start_line)
         ":type: Gtk.TextIter"
@@ -442,49 +551,62 @@ class Highlighter(object):
             matches = hl.pattern.finditer(strn, match_offset)
 
             # Cache tags
-            tags = hl_tags.get(hl, None)
-            if not tags:
-                tags = hl.get_tags_list(gtk_ed)
-                hl_tags[hl] = tags
+            dispatch = hl_tags.get(hl, None)
+            if not dispatch:
+                dispatch = hl.get_dispatch_table(gtk_ed)
+                hl_tags[hl] = dispatch
 
             pop_stack = True
             met_stop_pattern = False
 
             for m in matches:
 
-                # Get the index of the first matching category
-                i = [j for j in range(1, len(hl.matchers) + 1)
-                     if m.span(j) != null_span][0]
-
-                matcher, tag = hl.matchers[i - 1], tags[i - 1]
+                # Get the group of the matching category
+                i = m.lastindex
+                matcher, tag = dispatch[i]
                 start_line += strn.count("\n",
                                          last_start_offset, m.start(i))
                 last_start_offset = m.start(i)
                 tk_start_offset = start_offset + m.start(i)
                 tk_end_offset = start_offset + m.end(i)
 
+                # A token that includes a newline might depend on the text
+                # of the next line, for instance through a "$" after it.
+                nb_newlines = strn.count("\n", m.start(i), m.end(i))
+                if nb_newlines:
+                    self.continued_lines.update(
+                        range(start_line, start_line + nb_newlines))
+
                 if start_line > current_line:
                     for l in range(current_line + 1, start_line):
                         gtk_ed.stacks.set(l, subhl_stack)
                     current_line = start_line
 
                     # We exit because the stack we're setting is == to the
-                    # existing one, so the buffer is synced
-                    if gtk_ed.stacks.set(current_line, subhl_stack):
-                        endi = gtk_ed.get_iter_at_line(current_line)
-                        endi.backward_char()
-                        endo = endi.get_offset()
-                        rstart = rstarts.pop() if rstarts else start_offset
-                        results.append((subhl_stack[-1].gtk_tag, rstart,
-                                        endo))
+                    # existing one, so the buffer is synced. The region goes
+                    # on at current_line, so its tag covers the newline of
+                    # the previous line.
+                    if (gtk_ed.stacks.set(current_line, subhl_stack) and
+                            current_line >= min_sync_line):
+                        self.sync_line = current_line
+                        endo = gtk_ed.get_iter_at_line(
+                            current_line).get_offset()
+
+                        # All the regions of the stack go on, not only the
+                        # innermost one
+                        for region in reversed(subhl_stack[1:]):
+                            rstart = (rstarts.pop() if rstarts
+                                      else start_offset)
+                            results.append((region.gtk_tag, rstart, endo))
+                        results.append((None, endo, endo))
                         self.sync_stop = True
-                        return results
+                        return results, strn, start_offset
 
                 # Stop pattern, this is the end of the region, we want to
                 # return to the parent highlighter after having yielded the
                 # location of the region stop-pattern.
                 if not matcher:
-                    assert isinstance(hl.gtk_tag, Gtk.TextTag)
+                    assert hl.gtk_tag is not None
                     # If the region has no region start, we are
                     # rehighlighting a region that was previously created,
                     # and has no stored region start.
@@ -511,10 +633,11 @@ class Highlighter(object):
             # pattern, but yet exhausted the matcher, and we didn't just put
             # it on the stack, then it means this is an unfinished region,
             # so we can highlight to the end of the buffer with this region's
-            # tag
+            # tag, as well as the regions it is nested in
             if len(subhl_stack) > 1 and not met_stop_pattern and pop_stack:
-                rstart = rstarts.pop() if rstarts else start_offset
-                results.append((hl.gtk_tag, rstart, end_offset))
+                for region in reversed(subhl_stack[1:]):
+                    rstart = rstarts.pop() if rstarts else start_offset
+                    results.append((region.gtk_tag, rstart, end_offset))
                 # We break out of the while loop to keep the stack intact
                 break
 
@@ -532,65 +655,289 @@ class Highlighter(object):
             gtk_ed.stacks.set(l, subhl_stack)
 
         results.append((None, end_offset, end_offset))
-        return results
+        return results, strn, start_offset
 
-    def highlight_gen(self, gtk_ed, start_line=-1):
+    def highlight_gen(self, gtk_ed, start_line=-1, end_line=0):
         """
         :type gtk_ed: Gtk.TextBuffer
         :type start_line: int
+        :type end_line: int
         """
-        # t = time()
-        start_it = gtk_ed.get_start_iter()
-        end_it = gtk_ed.get_start_iter()
-
         if start_line == -1:
-            for tag, start, end in self.highlight_info_gen(gtk_ed, 0):
-                if tag:
-                    start_it.set_offset(start)
-                    end_it.set_offset(end)
-                    gtk_ed.apply_tag(tag, start_it, end_it)
+            gtk_ed.tags_cache = HighlighterTagsCache()
+            results, text, text_offset = self.highlight_info(gtk_ed, 0)
+            self.apply_tags(gtk_ed, 0, results, text, text_offset,
+                            clear=False)
         else:
-            st_iter = gtk_ed.get_iter_at_line(start_line)
-            actions_list = self.highlight_info_gen(gtk_ed, start_line,
-                                                   start_line + 1000)
+            end_line = end_line or start_line + SYNC_HIGHLIGHT_MAX_LINES
+            changed_line = self.first_changed_line(
+                gtk_ed, start_line, end_line)
+            if changed_line >= min(end_line, gtk_ed.get_line_count()):
+                # Nothing changed in the range, so the stacks are in sync
+                self.sync_stop = True
+                self.sync_line = changed_line
+                return
+
+            # A token that continues on changed_line has to be matched
+            # again from its start
+            start_line = changed_line
+            while start_line > 0:
+                cached = gtk_ed.tags_cache.get(start_line - 1)
+                if cached is None or cached[2] is not None:
+                    break
+                start_line -= 1
 
-            # if not self.sync_stop:
-            #     actions_list = self.highlight_info_gen(gtk_ed, start_line)
+            results, text, text_offset = self.highlight_info(
+                gtk_ed, start_line, end_line, min_sync_line=changed_line + 1)
+            self.apply_tags(gtk_ed, start_line, results, text, text_offset,
+                            clear=True)
 
-            end_it.set_offset(actions_list[-1][2])
-            gtk_ed.remove_all_tags(st_iter, end_it)
+    def first_changed_line(self, gtk_ed, start_line, end_line):
+        """
+        Return the first line in [start_line, end_line) whose text or entry
+        stack changed since its tags were cached, or end_line. The lines
+        before it are not tokenized again: their stacks are restored from
+        gtk_ed.tags_cache, so that highlighting can resume at that line.
 
-            for tag, start, end in actions_list:
-                start_it.set_offset(start)
-                end_it.set_offset(end)
-                if tag:
-                    gtk_ed.apply_tag(tag, start_it, end_it)
+        :type gtk_ed: Gtk.TextBuffer
+        :type start_line: int
+        :type end_line: int
+        :rtype: int
+        """
+        end_line = min(end_line, gtk_ed.get_line_count())
+        line = start_line
+        while line < end_line:
+            cached = gtk_ed.tags_cache.get(line)
+            stack = gtk_ed.stacks.get(line)
+            if (cached is None or stack is None or cached[2] is None or
+                    line + 1 > len(gtk_ed.stacks.stacks_list)):
+                break
+
+            start = gtk_ed.get_iter_at_line(line)
+            end = start.copy()
+            end.forward_line()
+            text = gtk_ed.get_text(start, end, True).decode('utf-8')
+            if cached[0] != (hash(text), stack):
+                break
+
+            gtk_ed.stacks.set(line + 1, cached[2])
+            line += 1
+        return line
+
+    def apply_tags(self, gtk_ed, start_line, results, text, text_offset,
+                   clear):
+        """
+        Apply the tags computed by highlight_info to the buffer, line by
+        line. On lines whose text and entry stack did not change since they
+        were last highlighted, only the difference between the old and new
+        tags is applied, so unchanged lines cost no call to GTK at all.
+
+        :param int start_line: The line at which text starts
+        :param list results: The list of (tag, start, end) offsets
+        :param unicode text: The text that was highlighted
+        :param int text_offset: The offset of text in the buffer
+        :param bool clear: Whether the existing tags need to be removed
+            from the lines that are not in the cache
+        """
+        range_end = results[-1][2] - text_offset
+
+        # Compute the bounds of the lines of the range, relative to text
+        line_starts = [0]
+        idx = text.find("\n")
+        while idx != -1 and idx + 1 < range_end:
+            line_starts.append(idx + 1)
+            idx = text.find("\n", idx + 1)
+        line_ends = line_starts[1:] + [range_end]
+
+        # Split the tags on line boundaries
+        spans = [[] for _ in line_starts]
+        for tag, start, end in results:
+            if not tag:
+                continue
+            start = max(start - text_offset, 0)
+            end -= text_offset
+            i = bisect.bisect_right(line_starts, start) - 1
+            while i < len(line_starts) and line_starts[i] < end:
+                ls, le = line_starts[i], line_ends[i]
+                lo, hi = max(start, ls), min(end, le)
+                if lo < hi:
+                    spans[i].append((tag, lo - ls, hi - ls))
+                i += 1
 
-        # print time() - t
+        start_it = gtk_ed.get_start_iter()
+        end_it = gtk_ed.get_start_iter()
+
+        def apply_span(tag, start, end):
+            start_it.set_offset(line_offset + start)
+            end_it.set_offset(line_offset + end)
+            gtk_ed.apply_tag(tag, start_it, end_it)
+
+        def remove_span(tag, start, end):
+            start_it.set_offset(line_offset + start)
+            end_it.set_offset(line_offset + end)
+            gtk_ed.remove_tag(tag, start_it, end_it)
+
+        for i, (ls, le) in enumerate(zip(line_starts, line_ends)):
+            line = start_line + i
+            line_offset = text_offset + ls
+
+            # The range may stop before the newline of its last line, but
+            # the key always includes it, see first_changed_line.
+            key_end = le
+            if (not text.endswith("\n", ls, le) and
+                    text.startswith("\n", le)):
+                key_end += 1
+            key = (hash(text[ls:key_end]), gtk_ed.stacks.get(line))
+            new_spans = tuple(spans[i])
+            cached = gtk_ed.tags_cache.get(line)
+            gtk_ed.tags_cache.set(
+                line, (key, new_spans,
+                       None if line in self.continued_lines
+                       else gtk_ed.stacks.get(line + 1)))
+
+            if cached and cached[0] == key:
+                if cached[1] == new_spans:
+                    continue
+
+                # The text of the line did not change, so its tags are
+                # exactly the cached ones: only apply the difference.
+                old_set, new_set = set(cached[1]), set(new_spans)
+                removed_tags = set()
+                for tag, start, end in old_set - new_set:
+                    remove_span(tag, start, end)
+                    removed_tags.add(tag)
+                for tag, start, end in new_spans:
+                    if (tag, start, end) not in old_set or \
+                            tag in removed_tags:
+                        apply_span(tag, start, end)
+            else:
+                if clear:
+                    start_it.set_offset(line_offset)
+                    end_it.set_offset(text_offset + le)
+                    gtk_ed.remove_all_tags(start_it, end_it)
+                for tag, start, end in new_spans:
+                    apply_span(tag, start, end)
 
     def gtk_highlight(self, gtk_ed):
         self.highlight_gen(gtk_ed, -1)
 
-    def gtk_highlight_region(self, gtk_ed, start_line):
-        self.highlight_gen(gtk_ed, start_line)
+    def gtk_highlight_region(self, gtk_ed, start_line, end_line=0):
+        self.highlight_gen(gtk_ed, start_line, end_line)
+
+    def highlight_lines(self, gtk_ed, start_line, end_line):
+        """
+        Rehighlight gtk_ed from start_line to at most end_line, and update
+        the set of lines that still need to be rehighlighted accordingly.
+
+        :type gtk_ed: Gtk.TextBuffer
+        :type start_line: int
+        :type end_line: int
+        """
+        line_count = gtk_ed.get_line_count()
+
+        if start_line < min(line_count, len(gtk_ed.stacks.stacks_list)):
+            self.gtk_highlight_region(gtk_ed, start_line, end_line)
+            done_line = (self.sync_line if self.sync_stop
+                         else min(end_line, line_count))
+        else:
+            done_line = max(start_line, line_count)
+
+        # Every line in [start_line, done_line] is now in sync with the
+        # buffer. If the stacks did not converge, the highlighting still has
+        # to be propagated from done_line.
+        gtk_ed.dirty_lines = set(
+            l for l in gtk_ed.dirty_lines
+            if not start_line <= l <= done_line)
+
+        if not self.sync_stop and done_line < line_count:
+            gtk_ed.dirty_lines.add(done_line)
+
+    def visible_end_line(self, gtk_ed):
+        """
+        Return the line following the last line visible in the current view
+        of gtk_ed, or None if it cannot be computed.
+
+        :type gtk_ed: Gtk.TextBuffer
+        :rtype: int|None
+        """
+        try:
+            view = get_widgets_by_type(
+                Gtk.TextView, gtk_ed.gps_buffer.current_view().pywidget())[0]
+            rect = view.get_visible_rect()
+            itr, _ = view.get_line_at_y(rect.y + rect.height)
+            return itr.get_line() + 1
+        except Exception:
+            return None
+
+    def rehighlight(self, gtk_ed, start_line):
+        """
+        Rehighlight gtk_ed after a modification at start_line. Only the
+        lines up to the end of the visible range are highlighted
+        synchronously, the rest of the buffer is highlighted in idle slices
+        of at most IDLE_HIGHLIGHT_BUDGET seconds, until the highlighter
+        stacks converge.
+
+        :type gtk_ed: Gtk.TextBuffer
+        :type start_line: int
+        """
+        if gtk_ed.idle_highlight_id:
+            GLib.source_remove(gtk_ed.idle_highlight_id)
+            gtk_ed.idle_highlight_id = None
+
+        gtk_ed.dirty_lines.add(start_line)
+
+        # If some lines before start_line are still waiting to be
+        # rehighlighted, the stack at start_line is not reliable yet: leave
+        # everything to the background highlighting.
+        if min(gtk_ed.dirty_lines) == start_line:
+            end_line = self.visible_end_line(gtk_ed)
+            if (end_line is None or
+                    end_line - start_line > SYNC_HIGHLIGHT_MAX_LINES):
+                end_line = start_line + SYNC_HIGHLIGHT_MAX_LINES
+            self.highlight_lines(gtk_ed, start_line,
+                                 max(end_line, start_line + 1))
+
+        if gtk_ed.dirty_lines:
+            gtk_ed.idle_highlight_id = GLib.idle_add(
+                self.idle_highlight, gtk_ed)
+
+    def idle_highlight(self, gtk_ed):
+        """
+        Idle callback highlighting the lines of gtk_ed that are still out of
+        date, chunk by chunk, until the time budget of the slice is spent.
+
+        :type gtk_ed: Gtk.TextBuffer
+        :rtype: bool
+        """
+        deadline = time.time() + IDLE_HIGHLIGHT_BUDGET
+
+        while gtk_ed.dirty_lines:
+            start_line = min(gtk_ed.dirty_lines)
+            self.highlight_lines(gtk_ed, start_line,
+                                 start_line + IDLE_HIGHLIGHT_CHUNK)
+            if time.time() > deadline:
+                return True
+
+        gtk_ed.idle_highlight_id = None
+        return False
 
     def init_highlighting(self, ed):
         gtk_ed = get_gtk_buffer(ed)
         gtk_ed.highlighting_initialized = True
         gtk_ed.stacks = HighlighterStacks()
+        gtk_ed.tags_cache = HighlighterTagsCache()
+        gtk_ed.gps_buffer = ed
+
+        # The set of lines from which the highlighting still needs to be
+        # propagated by the background highlighting
+        gtk_ed.dirty_lines = set()
 
         if not hasattr(gtk_ed, "idle_highlight_id"):
             gtk_ed.idle_highlight_id = None
 
         def action_handler(loc):
             """:type loc: Gtk.TextIter"""
-            if gtk_ed.idle_highlight_id:
-                GLib.source_remove(gtk_ed.idle_highlight_id)
-
-            # Highlight all the rest of the buffer
-            # TODO: Highlight N lines synchronously, and if there are any
-            # TODO: remaining, the rest in async
-            self.gtk_highlight_region(gtk_ed, loc.get_line())
+            self.rehighlight(gtk_ed, loc.get_line())
 
         # noinspection PyUnusedLocal
         def highlighting_insert_text_before(buf, loc, text, length):
@@ -601,6 +948,10 @@ class Highlighter(object):
             nb_new_lines = len(text.split("\n")) - 1
             itr = buf.iter_from_tuple(buf.insert_loc)
             buf.stacks.insert_newlines(nb_new_lines, itr.get_line())
+            buf.tags_cache.insert_newlines(nb_new_lines, itr.get_line())
+            buf.dirty_lines = set(
+                l + nb_new_lines if l > itr.get_line() else l
+                for l in buf.dirty_lines)
             action_handler(itr)
 
         def highlighting_delete_range_before(buf, loc, end):
@@ -610,7 +961,12 @@ class Highlighter(object):
 
         # noinspection PyUnusedLocal
         def highlighting_delete_range(buf, loc, end):
-            buf.stacks.delete_lines(buf.nb_deleted_lines, loc.get_line())
+            at_line = loc.get_line()
+            buf.stacks.delete_lines(buf.nb_deleted_lines, at_line)
+            buf.tags_cache.delete_lines(buf.nb_deleted_lines, at_line)
+            buf.dirty_lines = set(
+                max(l - buf.nb_deleted_lines, at_line) if l > at_line else l
+                for l in buf.dirty_lines)
             action_handler(loc)
 
         gtk_ed.connect_after("insert-text", highlighting_insert_text)
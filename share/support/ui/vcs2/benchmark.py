@@ -0,0 +1,240 @@
+"""
+Benchmarks for the parsing of the output of VCS commands, that can be run
+outside of GPS::
+
+    python share/support/ui/vcs2/benchmark.py
+    python share/support/ui/vcs2/benchmark.py --lines 1000,50000
+
+When the GPS module is not available, minimal stand-ins are installed for
+the GPS specific modules that workflows.promises imports. The output of
+"git blame --porcelain" and "git log" is simulated, and sent to
+ProcessWrapper in chunks, the same way GPS does for real processes.
+
+For each kind of output, the benchmark reports the number of lines parsed
+per second when the output is read one line at a time with
+ProcessWrapper.wait_line, and when it is read with ProcessWrapper.wait_lines.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import types
+
+# Size of the chunks of output sent to ProcessWrapper
+CHUNK_SIZE = 8192
+
+
+def install_stand_ins():
+    """
+    Install stand-ins for the modules only available inside GPS, if needed.
+    """
+    ui_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    core_dir = os.path.join(os.path.dirname(ui_dir), 'core')
+    for d in (ui_dir, core_dir):
+        if d not in sys.path:
+            sys.path.insert(0, d)
+
+    try:
+        import GPS  # noqa
+        return
+    except ImportError:
+        pass
+
+    class Process(object):
+        """
+        Stand-in for GPS.Process: the output is sent explicitly with `feed`
+        """
+
+        last = None   # the last process created
+
+        def __init__(self, command, on_match, on_exit, **kwargs):
+            self.on_match = on_match
+            self.on_exit = on_exit
+            Process.last = self
+
+        def feed(self, output):
+            for idx in range(0, len(output), CHUNK_SIZE):
+                self.on_match(self, output[idx:idx + CHUNK_SIZE], "")
+            self.on_exit(self, 0, "")
+
+    class Logger(object):
+        def __init__(self, name):
+            pass
+
+        def log(self, msg):
+            pass
+
+    gps = types.ModuleType("GPS")
+    gps.Process = Process
+    gps.Logger = Logger
+    sys.modules["GPS"] = gps
+
+    glib = types.ModuleType("GLib")
+    glib.timeout_add = lambda msecs, func: 0
+    glib.source_remove = lambda id: None
+    gi = types.ModuleType("gi")
+    repository = types.ModuleType("gi.repository")
+    repository.GLib = glib
+    gi.repository = repository
+    sys.modules["gi"] = gi
+    sys.modules["gi.repository"] = repository
+
+    pygps = types.ModuleType("pygps")
+    pygps.process_all_events = lambda: None
+    sys.modules["pygps"] = pygps
+
+
+###########
+# Outputs #
+###########
+
+def blame_output(nb_lines, rand):
+    """
+    Return an output similar to "git blame --porcelain" for a file of
+    nb_lines lines.
+    """
+    commits = ["%040x" % rand.getrandbits(160) for _ in range(50)]
+    seen = set()
+    result = []
+    for line in range(1, nb_lines + 1):
+        id = rand.choice(commits)
+        result.append("%s %d %d 1\n" % (id, line, line))
+        if id not in seen:
+            seen.add(id)
+            result.append(
+                "author Some Author\n"
+                "author-mail <author@example.com>\n"
+                "author-time 1500000000\n"
+                "author-tz +0200\n"
+                "committer Some Author\n"
+                "committer-mail <author@example.com>\n"
+                "committer-time 1500000000\n"
+                "committer-tz +0200\n"
+                "summary Some change\n"
+                "filename src/file.adb\n")
+        result.append("\t   X : Integer := %d;\n" % line)
+    return "".join(result)
+
+
+def log_output(nb_lines, rand):
+    """
+    Return an output similar to the "git log" run for the History view
+    """
+    ids = ["%040x" % rand.getrandbits(160) for _ in range(nb_lines + 1)]
+    return "".join(
+        "%s@@%s@@Some Author@@%s@@Mon, 17 Jul 2017 10:00:00 +0200@@"
+        "Some change %d\n" % (
+            ids[n], ids[n + 1], "tag: v%d" % n if n % 100 == 0 else "", n)
+        for n in range(nb_lines))
+
+
+###########
+# Parsers #
+###########
+
+class Blame_Parser(object):
+    """
+    Parses the output of "git blame --porcelain" the same way
+    vcs2.git.Git.async_annotations does.
+    """
+
+    def __init__(self):
+        self.info = {}
+        self.current_id = None
+        self.lines = []
+
+    def __call__(self, line):
+        if self.current_id is None:
+            self.current_id = line.split(' ', 1)[0]
+        elif line[0] == '\t':
+            self.lines.append(self.info[self.current_id])
+            self.current_id = None
+        elif line.startswith('author '):
+            self.info[self.current_id] = line[7:17]
+        elif line.startswith('committer-time '):
+            self.info[self.current_id] = '%s %10s %s' % (
+                line[15:], self.info[self.current_id], self.current_id[0:7])
+
+
+class Log_Parser(object):
+    """
+    Parses the output of "git log" the same way
+    vcs2.git.Git.async_fetch_history does.
+    """
+
+    def __init__(self):
+        self.commits = []
+
+    def __call__(self, line):
+        id, parents, author, branches, date, subject = line.split('@@')
+        self.commits.append(
+            (id, author, date, subject, parents.split(),
+             branches.split(',') if branches else None))
+
+
+def read_with_wait_line(p, parse):
+    while True:
+        line = yield p.wait_line()
+        if line is None:
+            break
+        parse(line)
+
+
+def read_with_wait_lines(p, parse):
+    while True:
+        lines = yield p.wait_lines()
+        if lines is None:
+            break
+        for line in lines:
+            parse(line)
+
+
+def bench_parsing(sizes, repeat=3, seed=0):
+    """
+    Parse outputs of the given sizes, in lines, with both ways of reading
+    the output of processes.
+    """
+    install_stand_ins()
+    import GPS
+    import workflows
+    from workflows.promises import ProcessWrapper
+
+    # Promises that are resolved immediately are chained recursively, which
+    # happens for each line available in a chunk with wait_line.
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 100000))
+
+    rand = random.Random(seed)
+    print("{0:<7} {1:>8} {2:>16} {3:>16} {4:>8}".format(
+        "output", "lines", "wait_line l/s", "wait_lines l/s", "speedup"))
+
+    for name, make_output, parser in (("blame", blame_output, Blame_Parser),
+                                      ("log", log_output, Log_Parser)):
+        for nb_lines in sizes:
+            output = make_output(nb_lines, rand)
+            count = output.count("\n")
+            rates = []
+            for read in (read_with_wait_line, read_with_wait_lines):
+                best = None
+                for _ in range(repeat):
+                    t = time.time()
+                    p = ProcessWrapper(['git'])
+                    workflows.driver(read(p, parser()))
+                    GPS.Process.last.feed(output)
+                    elapsed = time.time() - t
+                    best = elapsed if best is None else min(best, elapsed)
+                rates.append(count / best)
+
+            print("{0:<7} {1:>8} {2:>16.0f} {3:>16.0f} {4:>7.2f}x".format(
+                name, count, rates[0], rates[1], rates[1] / rates[0]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the parsing of the output of VCS commands")
+    parser.add_argument(
+        "--lines", default="1000,10000,50000",
+        help="comma separated list of output sizes, in lines")
+    args = parser.parse_args()
+    bench_parsing([int(n) for n in args.lines.split(",")])
@@ -27,28 +27,28 @@ class Clearcase(core_staging.Emulate_Staging,
         with self.set_status_for_all_files() as s:
             p = self._cleartool(['ls', '-short', '.'])
             while True:
-                line = yield p.wait_line()
-                if line is None:
+                lines = yield p.wait_lines()
+                if lines is None:
                     break
-
-                GPS.Logger("CLEARCASE").log(line)
-                m = _re.search(line)
-                if m:
-                    # ??? These are just (bad) guesses for now
-                    status = GPS.VCS2.Status.UNMODIFIED
-                    rev = m.group('rev')
-                    if rev.contains('CHECKEDOUT'):
-                        status = GPS.VCS2.Status.MODIFIED
-                    elif m.group('sep') == '':
-                        status = GPS.VCS2.Status.UNTRACKED
-                    elif rev == '':
-                        status = GPS.VCS2.Status.IGNORED
-
-                    s.set_status(
-                        GPS.File(m.group('file')),
-                        0,
-                        rev,
-                        '')  # repo revision
+                for line in lines:
+                    GPS.Logger("CLEARCASE").log(line)
+                    m = _re.search(line)
+                    if m:
+                        # ??? These are just (bad) guesses for now
+                        status = GPS.VCS2.Status.UNMODIFIED
+                        rev = m.group('rev')
+                        if rev.contains('CHECKEDOUT'):
+                            status = GPS.VCS2.Status.MODIFIED
+                        elif m.group('sep') == '':
+                            status = GPS.VCS2.Status.UNTRACKED
+                        elif rev == '':
+                            status = GPS.VCS2.Status.IGNORED
+
+                        s.set_status(
+                            GPS.File(m.group('file')),
+                            0,
+                            rev,
+                            '')  # repo revision
 
     def has_defined_activity(self, synchronous):
         """
@@ -127,12 +127,13 @@ class Clearcase(core_staging.Emulate_Staging,
     def async_fetch_history(self, visitor, filter):
         p = self._cleartool(['lshistory', '.'])
         while True:
-            line = yield p.wait_line()
-            if line is None:
+            lines = yield p.wait_lines()
+            if lines is None:
                 GPS.Logger("CLEARCASE").log("Done parsing lshistory")
                 break
-            GPS.Logger("CLEARCASE").log(line)
-            # ??? Should parse the output
+            for line in lines:
+                GPS.Logger("CLEARCASE").log(line)
+                # ??? Should parse the output
 
     @core.run_in_background
     def async_fetch_commit_details(self, ids, visitor):
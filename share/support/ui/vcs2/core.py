@@ -7,11 +7,15 @@ import os
 import gps_utils
 import workflows
 import time
-from workflows.promises import Promise
+from workflows.promises import Promise, ProcessWrapper, wait_idle, timeout
 import types
 import difflib
+import hashlib
 import io
+import json
 import platform
+import sys
+from collections import OrderedDict
 
 
 GPS.VCS2.Status = gps_utils.enum(
@@ -46,6 +50,36 @@ Traverse_Limit_Pref.create(
     "How much directories should GPS traverse when looking for " +
     "VCS root counting from project file directory.", 99, 0)
 
+Persist_Annotations_Pref = GPS.Preference(":VCS/Persist-Annotations")
+Persist_Annotations_Pref.create(
+    "Save annotations",
+    "boolean",
+    "Whether to save the annotations (blame) computed for files in the " +
+    "object directory of the root project, so that they can be reused " +
+    "in later sessions.", False)
+
+Profile_Pref = GPS.Preference(":VCS/Profile-Operations")
+Profile_Pref.create(
+    "Profile operations",
+    "boolean",
+    "Whether to record the operations of the VCS engines, with the " +
+    "processes they spawn and the number of lines and files they handle, " +
+    "in the file vcs2_trace.json of the GPS home directory. This file " +
+    "uses the trace event format of the Chrome browser " +
+    "(chrome://tracing).", False)
+
+ANNOTATIONS_CACHE_SIZE = 50
+# Number of files whose annotations are kept in memory, for each VCS
+
+PERSISTED_ANNOTATIONS_SIZE = 500
+PERSISTED_ANNOTATIONS_DAYS = 30
+# Maximum number of files whose annotations are saved on the disk, and
+# number of days after which unused saved annotations are deleted
+
+STATUS_CHUNK_SIZE = 5000
+# Number of files whose status is sent to GPS in each idle callback, see
+# `VCS._queue_file_status`
+
 
 class _Branch(list):
     """
@@ -149,6 +183,8 @@ def run_in_background(func):
             else:
                 vcs = self
             vcs.set_run_in_background(True)
+            if Profile_Pref.get():
+                r = _trace.operation(vcs, func.__name__, r)
             promise = workflows.driver(r)
             promise.then(lambda x: vcs.set_run_in_background(False),
                          lambda x: vcs.set_run_in_background(False))
@@ -159,6 +195,141 @@ def run_in_background(func):
     return __func
 
 
+def file_contents_hash(file):
+    """
+    Return a hash of the contents of file on the disk, or '' if the file
+    cannot be read. This is used to detect local changes in the keys of
+    `Annotations_Cache`.
+
+    :param GPS.File file:
+    :returntype: str
+    """
+    try:
+        with open(file.path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return ''
+
+
+class Annotations_Cache(object):
+    """
+    A cache for the annotations computed by `VCS.async_annotations`.
+    Entries are indexed by a key which must change whenever the annotations
+    of the file would change, typically a tuple built from the path of the
+    file, its revision and `file_contents_hash`::
+
+        key = (file.path, revision, file_contents_hash(file))
+        cached = self.annotations_cache.get(key)
+        if cached is not None:
+            visitor.annotations(file, *cached)
+        else:
+            ... compute first_line, ids and lines
+            self.annotations_cache.set(key, first_line, ids, lines)
+
+    The least recently used entries are discarded first. If the
+    preference :VCS/Persist-Annotations is set, entries are also saved in
+    the object directory of the root project. Only the latest entry is
+    saved for each file, as identified by the first element of the key. At
+    most PERSISTED_ANNOTATIONS_SIZE entries are saved, and those not used
+    for PERSISTED_ANNOTATIONS_DAYS days are deleted.
+    """
+
+    def __init__(self, max_entries=ANNOTATIONS_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.__entries = OrderedDict()   # most recently used last
+
+    def __dir(self):
+        """
+        The directory in which entries are saved, or None.
+        """
+        try:
+            objdir = GPS.Project.root().object_dirs()[0]
+        except Exception:
+            return None
+        return os.path.join(objdir, 'vcs_annotations')
+
+    def __file(self, key):
+        """
+        The file in which the entry for key is saved, or None.
+        """
+        d = self.__dir()
+        if d is None:
+            return None
+        return os.path.join(
+            d, '%s.json' % hashlib.sha1(repr(key[0])).hexdigest())
+
+    def __prune(self):
+        """
+        Delete the saved entries that are too old, then the least recently
+        used ones until at most PERSISTED_ANNOTATIONS_SIZE remain.
+        """
+        d = self.__dir()
+        try:
+            files = [os.path.join(d, f) for f in os.listdir(d)]
+            files = sorted((os.path.getmtime(f), f) for f in files)
+        except (IOError, OSError, TypeError):
+            return
+
+        limit = time.time() - PERSISTED_ANNOTATIONS_DAYS * 24 * 3600
+        for idx, (mtime, f) in enumerate(files):
+            if (mtime < limit or
+                    len(files) - idx > PERSISTED_ANNOTATIONS_SIZE):
+                try:
+                    os.unlink(f)
+                except OSError:
+                    pass
+
+    def get(self, key):
+        """
+        Return the annotations for key, or None if they are not known.
+
+        :returntype: a tuple (first_line, ids, lines), which are the
+           parameters for `GPS.VCS2_Task_Visitor.annotations`
+        """
+        value = self.__entries.pop(key, None)
+
+        if value is None and Persist_Annotations_Pref.get():
+            f = self.__file(key)
+            try:
+                if f is not None and os.path.isfile(f):
+                    with open(f) as fd:
+                        saved = json.load(fd)
+                    if saved.get('key') == repr(key):
+                        value = tuple(saved['value'])
+                        os.utime(f, None)   # recently used
+                    else:
+                        os.unlink(f)   # obsolete annotations for the file
+            except (IOError, OSError, ValueError, AttributeError, KeyError):
+                pass
+
+        if value is not None:
+            self.__add(key, value)
+        return value
+
+    def set(self, key, first_line, ids, lines):
+        """
+        Store the annotations for key.
+        """
+        value = (first_line, ids, lines)
+        self.__add(key, value)
+
+        f = self.__file(key) if Persist_Annotations_Pref.get() else None
+        if f is not None:
+            try:
+                if not os.path.isdir(os.path.dirname(f)):
+                    os.makedirs(os.path.dirname(f))
+                with open(f, 'w') as fd:
+                    json.dump({'key': repr(key), 'value': value}, fd)
+            except (IOError, OSError):
+                GPS.Logger("VCS2").log("Could not save annotations in %s" % f)
+            self.__prune()
+
+    def __add(self, key, value):
+        self.__entries[key] = value
+        while len(self.__entries) > self.max_entries:
+            self.__entries.popitem(last=False)
+
+
 class Profile:
     """
     A Context that runs the function inside the profiler, and display
@@ -196,6 +367,157 @@ class Profile:
             GPS.Logger("GIT").log(s.getvalue())
 
 
+class _Operation(object):
+    """
+    An operation of a VCS engine, as recorded by `_Trace`
+    """
+
+    def __init__(self, vcs, name):
+        self.vcs = vcs
+        self.name = name
+        self.start = time.time()
+        self.processes = 0
+        self.process_time = 0.0
+        self.lines = 0   # lines output by the processes
+        self.files = 0   # files whose status was sent to GPS
+
+
+class _Trace(object):
+    """
+    Records the operations run in the background by the VCS engines, when
+    Profile_Pref is set, in the trace event format of Chrome. Each working
+    directory is shown as a separate thread.
+
+    The events are written as soon as they complete, and the file is never
+    closed, which the format allows, so that the trace can be loaded while
+    GPS is running.
+    """
+
+    def __init__(self):
+        self.current = None   # the _Operation being executed
+        self.__file = None
+        self.__tids = {}      # working dir -> thread id in the trace
+
+    def __write(self, event):
+        if self.__file is None:
+            self.__file = open(
+                os.path.join(GPS.get_home_dir(), 'vcs2_trace.json'), 'w')
+            self.__file.write('[\n')
+        json.dump(event, self.__file)
+        self.__file.write(',\n')
+        self.__file.flush()
+
+    def __tid(self, vcs):
+        path = vcs.working_dir.path
+        tid = self.__tids.get(path)
+        if tid is None:
+            tid = self.__tids[path] = len(self.__tids) + 1
+            self.__write({'name': 'thread_name', 'ph': 'M',
+                          'pid': os.getpid(), 'tid': tid,
+                          'args': {'name': '%s %s' % (vcs.name, path)}})
+        return tid
+
+    def complete(self, vcs, name, start, args):
+        """
+        Record an event that started at `start` and just completed.
+
+        :param VCS vcs:
+        :param str name:
+        :param float start: as returned by time.time()
+        :param dict args: extra information displayed for the event
+        """
+        self.__write({'name': name, 'cat': 'vcs2', 'ph': 'X',
+                      'ts': start * 1e6,
+                      'dur': (time.time() - start) * 1e6,
+                      'pid': os.getpid(), 'tid': self.__tid(vcs),
+                      'args': args})
+
+    def operation(self, vcs, name, gen):
+        """
+        Return a generator that executes `gen`, and records it as an
+        operation when it terminates.
+
+        :param VCS vcs:
+        :param str name:
+        :param generator gen:
+        """
+        op = _Operation(vcs, name)
+        try:
+            result = yield self.__run(gen, op)
+        finally:
+            self.complete(vcs, name, op.start, {
+                'processes': op.processes,
+                'process_time': op.process_time,
+                'lines': op.lines,
+                'files': op.files})
+        yield result
+
+    def __run(self, gen, op):
+        """
+        Execute `gen`, and the generators it yields, with `op` as the
+        current operation.
+        """
+        value = None
+        exc_info = None
+        while True:
+            previous = self.current
+            self.current = op
+            try:
+                if exc_info is not None:
+                    r = gen.throw(*exc_info)
+                else:
+                    r = gen.send(value)
+            except StopIteration:
+                return
+            finally:
+                self.current = previous
+
+            if isinstance(r, types.GeneratorType):
+                r = self.__run(r, op)
+
+            try:
+                value = yield r
+                exc_info = None
+            except BaseException:
+                value = None
+                exc_info = sys.exc_info()
+
+    def on_process(self, command):
+        """
+        Called for every process spawned (see ProcessWrapper.monitor). The
+        processes spawned by an operation are recorded.
+        """
+        op = self.current
+        if op is None:
+            return None
+
+        start = time.time()
+
+        def _on_exit(status, lines):
+            op.processes += 1
+            op.process_time += time.time() - start
+            op.lines += lines
+            self.complete(op.vcs, ' '.join(command[0:2]), start, {
+                'command': ' '.join(command),
+                'status': status,
+                'lines': lines})
+        return _on_exit
+
+    def files(self, vcs, count, start):
+        """
+        Record that the status of `count` files was sent to GPS, which took
+        from `start` until now.
+        """
+        if self.current is not None:
+            self.current.files += count
+        else:
+            self.complete(vcs, 'set file status', start, {'files': count})
+
+
+_trace = _Trace()
+ProcessWrapper.monitor = _trace.on_process
+
+
 class Extension(object):
     """
     A class similar to core.VCS, which is used to decorate an existing VCS
@@ -249,6 +571,18 @@ class VCS(GPS.VCS2):
         self.default_status = default_status
         self._extensions = []   # the decorators that apply to self
 
+        self.annotations_cache = Annotations_Cache()
+        # The annotations already computed, see async_annotations
+
+        self.__emitted = {}   # GPS.File -> (status, version, repo_version)
+        self.__pending = {}   # statuses not sent yet, same format
+        self.__emitting = False
+
+        self._deferred_emissions = None
+        # While `refresh_all_status` refreshes self, the statuses computed
+        # through `set_status_for_all_files`, as a list of
+        # (proxy, default files)
+
         # Check which decorators apply
         for d in self._class_extensions:
             inst = d(base_vcs=self)
@@ -425,6 +759,8 @@ class VCS(GPS.VCS2):
         Compute the information to display on the side of editors for
         the given file. This information should include last commit date,
         author, commit id,...
+        Use `self.annotations_cache` to avoid computing it again for the
+        same version of the file.
 
         :param GPS.VCS2_Task_Visitor visitor: the object used to report
            the information, via its `annotation` method.
@@ -528,17 +864,26 @@ class VCS(GPS.VCS2):
 
                 :param set(GPS.File)|list(GPS.File) files:
                 """
+                seen = self._seen
+                to_set = [f for f in files if f not in seen]
+
+                if vcs._deferred_emissions is not None:
+                    # Sent when `refresh_all_status` completes
+                    vcs._deferred_emissions.append((self, to_set))
+                else:
+                    self._emit(to_set)
+
+            def _emit(self, to_set):
+                """
+                Send the statuses to GPS, in the background.
+
+                :param list(GPS.File) to_set: the files that get the
+                   default status.
+                """
                 GPS.Logger("VCS2").log("Emit file statuses")
                 for s, s_files in self._cache.iteritems():
-                    vcs._set_file_status(s_files, s[0], s[1], s[2])
-                GPS.Logger("VCS2").log("Done emit file statuses")
-
-                to_set = []
-                for f in files:
-                    if f not in self._seen:
-                        to_set.append(f)
-                vcs._set_file_status(to_set, vcs.default_status)
-                GPS.Logger("VCS2").log("Done emit default statuses")
+                    vcs._queue_file_status(s_files, s[0], s[1], s[2])
+                vcs._queue_file_status(to_set, vcs.default_status)
 
             def __exit__(self, exc_type=None, exc_val=None, exc_tb=None):
                 self.set_status_for_remaining_files(files)
@@ -546,6 +891,84 @@ class VCS(GPS.VCS2):
 
         return _CM()
 
+    def _set_file_status(self, files, status, version="", repo_version=""):
+        """
+        Override Ada behavior: only send to GPS the files whose status is
+        different from the one last sent.
+
+        :param List(GPS.File) files:
+        :param GPS.VCS2.Status status:
+        :param str version:
+        :param str repo_version:
+        """
+        if isinstance(files, GPS.File):
+            files = [files]
+
+        props = (status, version, repo_version)
+        emitted = self.__emitted
+        pending = self.__pending
+        changed = []
+        for f in files:
+            if pending:
+                pending.pop(f, None)   # older status, not sent yet
+            if emitted.get(f) != props:
+                emitted[f] = props
+                changed.append(f)
+
+        if changed:
+            start = time.time()
+            super(VCS, self)._set_file_status(
+                changed, status, version, repo_version)
+            if Profile_Pref.get():
+                _trace.files(self, len(changed), start)
+
+    def _queue_file_status(self, files, status, version="", repo_version=""):
+        """
+        Similar to `_set_file_status`, but the statuses are sent to GPS from
+        idle callbacks, STATUS_CHUNK_SIZE files at a time, so that the
+        refresh of large working directories doesn't freeze the interface.
+        The first chunk is sent immediately.
+
+        :param List(GPS.File) files:
+        :param GPS.VCS2.Status status:
+        :param str version:
+        :param str repo_version:
+        """
+        props = (status, version, repo_version)
+        emitted = self.__emitted
+        pending = self.__pending
+        for f in files:
+            if emitted.get(f) != props:
+                pending[f] = props
+            elif pending:
+                pending.pop(f, None)
+
+        if pending and not self.__emitting:
+            self.__emitting = True
+            self.__emit_pending()
+
+    @workflows.run_as_workflow
+    def __emit_pending(self):
+        """
+        Send the statuses queued by `_queue_file_status`
+        """
+        pending = self.__pending
+        try:
+            while pending:
+                groups = {}   # (status, version, repo_version) -> [File]
+                for _ in range(min(STATUS_CHUNK_SIZE, len(pending))):
+                    f, props = pending.popitem()
+                    groups.setdefault(props, []).append(f)
+
+                for props, files in groups.iteritems():
+                    self._set_file_status(files, *props)
+
+                if pending:
+                    yield wait_idle()
+        finally:
+            self.__emitting = False
+        GPS.Logger("VCS2").log("Done emit file statuses")
+
     def _relpath(self, path):
         """
         Return a relative filepath to path from the working dir.
@@ -590,11 +1013,31 @@ class VCS(GPS.VCS2):
         return result
 
 
+DIRTY_FILES_DELAY_MS = 500
+# How long File_Based_VCS accumulates the files modified on the disk,
+# before running the status command.
+
+MAX_COMMAND_LENGTH = 30000
+# Maximum number of characters in the file names passed to a single status
+# command (command lines are limited to 32767 characters on Windows)
+
+
 class File_Based_VCS(VCS):
     """
     Abstract base class for file-based vcs systems.
+
+    The files that are modified on the disk are accumulated for
+    DIRTY_FILES_DELAY_MS milliseconds, and their status is then computed
+    with a single call to `_compute_status`. Saved files are already
+    handled by GPS, which invalidates their status and calls
+    `async_fetch_status_for_files`.
     """
 
+    def __init__(self, *args, **kwargs):
+        super(File_Based_VCS, self).__init__(*args, **kwargs)
+        self.__dirty = set()   # files whose status must be computed
+        self.__dirty_timeout = None
+
     def _compute_status(self, all_files, args=[]):
         """
         Run a "status" command with extra args
@@ -604,18 +1047,248 @@ class File_Based_VCS(VCS):
         :param List(str) args: extra arguments to 'cvs/svn/... status'
         """
 
+    def _mark_dirty(self, files):
+        """
+        Compute the status of files after a short delay. This is used for
+        the files modified on the disk, which often come in bursts.
+
+        :param List(GPS.File) files:
+        """
+        self.__dirty.update(files)
+        if self.__dirty_timeout is None:
+            self.__dirty_timeout = GPS.Timeout(
+                DIRTY_FILES_DELAY_MS, self.__on_dirty_timeout)
+
+    def __on_dirty_timeout(self, timeout):
+        timeout.remove()
+        self.__dirty_timeout = None
+        files = self.__dirty
+        self.__dirty = set()
+        self.__compute_status_for_files(sorted(files, key=lambda f: f.path))
+        return False
+
+    @workflows.run_as_workflow
+    def __compute_status_for_files(self, files):
+        """
+        Compute the status of files, with a single status command unless
+        the names of the files do not fit in MAX_COMMAND_LENGTH.
+
+        :param List(GPS.File) files:
+        """
+        chunk = []
+        length = 0
+        for f in files:
+            if chunk and length + len(f.path) > MAX_COMMAND_LENGTH:
+                yield self._compute_status(
+                    all_files=chunk, args=[c.path for c in chunk])
+                chunk = []
+                length = 0
+            chunk.append(f)
+            length += len(f.path) + 1
+
+        if chunk:
+            yield self._compute_status(
+                all_files=chunk, args=[c.path for c in chunk])
+
     def async_fetch_status_for_files(self, files):
-        self._compute_status(
-            all_files=files,
-            args=[f.path for f in files])
+        return self.__compute_status_for_files(files)
 
     def async_fetch_status_for_project(self, project):
-        self._compute_status(
+        return self._compute_status(
             all_files=project.sources(recursive=False),
             args=[d for d in project.source_dirs(recursive=False)])
 
     def async_fetch_status_for_all_files(self, from_user):
-        self._compute_status([])  # all files
+        return self._compute_status([])  # all files
+
+
+def _on_file_changed(hook, file):
+    """
+    Called when a file is modified on the disk, to compute its new
+    status in the background with `File_Based_VCS`.
+    VCS with a global status command (like git) are refreshed by GPS.
+    """
+    # Directories are modified by VCS operations, after which GPS refreshes
+    # the status of all files anyway.
+    if os.path.isdir(file.path):
+        return
+
+    for vcs in GPS.VCS2.vcs_in_use():
+        if isinstance(vcs, File_Based_VCS) and file.path.startswith(
+                os.path.join(vcs.working_dir.path, '')):
+            vcs._mark_dirty([file])
+
+
+GPS.Hook("file_changed_on_disk").add(_on_file_changed)
+
+
+MAX_PARALLEL_REFRESH = 4
+# Maximum number of working directories whose status is computed at the
+# same time by `refresh_all_status`
+
+REFRESH_TIMEOUT_MS = 30000
+# How long `refresh_all_status` waits for all working directories before
+# sending the statuses already computed. The working directories that are
+# still being refreshed then send their statuses as soon as they are known.
+
+_batch = None
+# The calls to `async_fetch_status_for_all_files` received since GPS was
+# last idle, as a list of [vcs, from_user, promise]. They are run together
+# by `_run_batch`.
+
+
+def batched_refresh(func):
+    """
+    A decorator for `async_fetch_status_for_all_files`, applied by
+    `register_vcs`. GPS requests the status of all files from each engine
+    in turn, for instance after switching branches. These requests are
+    collected until GPS is idle, then run concurrently by
+    `refresh_all_status`. The engine is marked as busy in the meantime.
+    Calls with extra arguments are run immediately.
+
+    :return: a function that returns a promise resolved when the status
+       has been computed.
+    """
+    if getattr(func, '_batched', False):
+        return func
+
+    def __func(self, from_user, *args, **kwargs):
+        global _batch
+
+        if args or kwargs:
+            return func(self, from_user, *args, **kwargs)
+
+        if _batch is None:
+            _batch = []
+            _run_batch()
+
+        for request in _batch:
+            if request[0] is self:
+                request[1] = request[1] or from_user
+                return request[2]
+
+        self.set_run_in_background(True)
+        request = [self, from_user, Promise()]
+        _batch.append(request)
+        return request[2]
+
+    __func._batched = True
+    __func._unbatched = func
+    return __func
+
+
+@workflows.run_as_workflow
+def _run_batch():
+    """
+    Run the requests collected in `_batch`
+    """
+    global _batch
+
+    yield timeout(0)   # let GPS send the requests for the other engines
+    batch = _batch
+    _batch = None
+    yield _refresh(batch)
+
+
+@workflows.run_as_workflow
+def _refresh(requests, max_parallel=MAX_PARALLEL_REFRESH):
+    """
+    Compute the status of all files for each of the requests, as collected
+    by `batched_refresh`. Up to `max_parallel` status commands run
+    concurrently. The statuses of the engines taking part are sent to GPS
+    all at once, when every engine has been refreshed or after
+    REFRESH_TIMEOUT_MS, whichever comes first.
+
+    :param list requests: a list of [vcs, from_user, promise]
+    :param int max_parallel: maximum number of concurrent refreshes
+    """
+    log = GPS.Logger("VCS2")
+    queue = list(requests)
+    running = [0]
+    done = Promise()
+
+    # An engine might already be deferring its emissions for an earlier
+    # refresh, which will send them.
+    deferring = [vcs for vcs, _, _ in requests
+                 if vcs._deferred_emissions is None]
+    for vcs in deferring:
+        vcs._deferred_emissions = []
+
+    def flush():
+        for vcs in deferring:
+            emissions = vcs._deferred_emissions
+            vcs._deferred_emissions = None
+            for cm, to_set in emissions or []:
+                cm._emit(to_set)
+
+    def on_timeout(_):
+        if running[0] or queue:
+            log.log("Status refresh still running after %dms" % (
+                REFRESH_TIMEOUT_MS, ))
+            flush()
+
+    def on_refreshed(vcs, promise, start):
+        def cb(result):
+            log.log("Status of %s (%s) computed in %.3fs" % (
+                vcs.name, vcs.working_dir.path, time.time() - start))
+            running[0] -= 1
+            vcs.set_run_in_background(False)
+            promise.resolve(result)
+            start_next()
+        return cb
+
+    def start_next():
+        while queue and running[0] < max_parallel:
+            vcs, from_user, promise = queue.pop(0)
+            running[0] += 1
+            cb = on_refreshed(vcs, promise, time.time())
+            try:
+                p = vcs.async_fetch_status_for_all_files._unbatched(
+                    vcs, from_user)
+            except Exception:
+                log.log("Could not refresh %s (%s)" % (
+                    vcs.name, vcs.working_dir.path))
+                p = None
+
+            if isinstance(p, Promise):
+                p.then(cb, cb)
+            else:
+                cb(p)
+        if not queue and running[0] == 0:
+            done.resolve()
+
+    start = time.time()
+    timeout(REFRESH_TIMEOUT_MS).then(on_timeout)
+    try:
+        start_next()
+        yield done
+    finally:
+        flush()
+
+    log.log("Status of %d working directories computed in %.3fs" % (
+        len(requests), time.time() - start))
+
+
+@workflows.run_as_workflow
+def refresh_all_status(from_user=False):
+    """
+    Compute the status of all files in all the working directories in use,
+    concurrently (see `batched_refresh`).
+
+    :param bool from_user: passed to `async_fetch_status_for_all_files`
+    """
+    promises = [vcs.async_fetch_status_for_all_files(from_user=from_user)
+                for vcs in GPS.VCS2.vcs_in_use()]
+    for p in promises:
+        yield p
+
+
+gps_utils.make_interactive(
+    lambda: refresh_all_status(from_user=True),
+    category='VCS2',
+    name='vcs refresh status of all repositories',
+    description='Compute the status of all files in all the working' +
+                ' directories used by the project, in parallel')
 
 
 class register_vcs:
@@ -629,6 +1302,9 @@ class register_vcs:
        files.
     :param args: passed to the class constructor
     :param kwargs: pass to the class constructor
+
+    The class's `async_fetch_status_for_all_files` is decorated with
+    `batched_refresh`.
     """
 
     def __init__(self, default_status, name="", *args, **kwargs):
@@ -638,6 +1314,8 @@ class register_vcs:
         self.kwargs = kwargs
 
     def __call__(self, klass):
+        klass.async_fetch_status_for_all_files = batched_refresh(
+            klass.async_fetch_status_for_all_files)
         GPS.VCS2._register(
             self.name or klass.__name__,
             construct=lambda working_dir: klass(
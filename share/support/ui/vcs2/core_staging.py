@@ -37,23 +37,22 @@ class Emulate_Staging(object):
     def _set_file_status(self, files, status, version="", repo_version=""):
         """Override Ada behavior"""
         if isinstance(files, GPS.File):
-            files = set([files])
-        elif not isinstance(files, set):
-            files = set(files)
-
-        s = files.intersection(self._staged)
-        if s:
-            # One file from the set, at random
-            f = next(iter(s))
-            super(Emulate_Staging, self)._set_file_status(
-                list(s),
-                self._override_status_for_file(f, status),
-                version,
-                repo_version)
-
-        files.difference_update(s)
+            files = [files]
+
+        staged = self._staged
+        if staged:
+            s = [f for f in files if f in staged]
+            if s:
+                # All staged files get the same status
+                super(Emulate_Staging, self)._set_file_status(
+                    s,
+                    self._override_status_for_file(s[0], status),
+                    version,
+                    repo_version)
+                files = [f for f in files if f not in staged]
+
         super(Emulate_Staging, self)._set_file_status(
-            list(files), status, version, repo_version)
+            files, status, version, repo_version)
 
     def __load_staged_files(self):
         """
@@ -71,45 +71,45 @@ class CVS(core_staging.Emulate_Staging,
             rev = None
             repo_rev = None
             while True:
-                line = yield p.wait_line()
-                if line is None:
+                lines = yield p.wait_lines()
+                if lines is None:
                     break
-
-                m = self.__re_status.search(line)
-                if m is None:
-                    pass
-                elif m.group('dir'):
-                    dir = m.group('dir')
-                elif m.group('file'):
-                    if current_file is not None:
-                        s.set_status(current_file, status, rev, repo_rev)
-                        current_file = None
-
-                    # CVS doesn't show path information when a list of files is
-                    # given. However, it seems to query the status in the same
-                    # order as on the command line, so we take advantage of
-                    # that.
-
-                    f = m.group('file')
-                    if dir is not None:
-                        current_file = GPS.File(os.path.join(dir, f))
-                    elif all_files and all_files[0].path.endswith(f):
-                        current_file = all_files[0]
-                    if all_files:
-                        all_files.pop(0)
-
-                    if m.group('deleted'):
-                        status = GPS.VCS2.Status.DELETED
-                    else:
-                        status = STATUSES.get(
-                            m.group('status').lower(),
-                            GPS.VCS2.Status.UNMODIFIED)
-                    rev = None
-                    repo_rev = None
-                elif m.group('rev'):
-                    rev = m.group('rev')
-                elif m.group('rrev'):
-                    repo_rev = m.group('rrev')
+                for line in lines:
+                    m = self.__re_status.search(line)
+                    if m is None:
+                        pass
+                    elif m.group('dir'):
+                        dir = m.group('dir')
+                    elif m.group('file'):
+                        if current_file is not None:
+                            s.set_status(current_file, status, rev, repo_rev)
+                            current_file = None
+
+                        # CVS doesn't show path information when a list of
+                        # files is given. However, it seems to query the
+                        # status in the same order as on the command line,
+                        # so we take advantage of that.
+
+                        f = m.group('file')
+                        if dir is not None:
+                            current_file = GPS.File(os.path.join(dir, f))
+                        elif all_files and all_files[0].path.endswith(f):
+                            current_file = all_files[0]
+                        if all_files:
+                            all_files.pop(0)
+
+                        if m.group('deleted'):
+                            status = GPS.VCS2.Status.DELETED
+                        else:
+                            status = STATUSES.get(
+                                m.group('status').lower(),
+                                GPS.VCS2.Status.UNMODIFIED)
+                        rev = None
+                        repo_rev = None
+                    elif m.group('rev'):
+                        rev = m.group('rev')
+                    elif m.group('rrev'):
+                        repo_rev = m.group('rrev')
 
             if current_file is not None:
                 s.set_status(current_file, status, rev, repo_rev)
@@ -272,23 +272,31 @@ class CVS(core_staging.Emulate_Staging,
             "(?P<author>\S+)"
             "\s+"
             "(?P<date>[^)]+)")
+        key = (file.path, self.get_file_status(file)[1],
+               core.file_contents_hash(file))
+        cached = self.annotations_cache.get(key)
+        if cached is not None:
+            visitor.annotations(file, *cached)
+            return
+
         lines = []
         ids = []
 
         p = self._cvs(['annotate', self._relpath(file.path)])
         while True:
-            line = yield p.wait_line()
-            if line is None:
+            output = yield p.wait_lines()
+            if output is None:
+                self.annotations_cache.set(key, 1, ids, lines)
                 visitor.annotations(file, 1, ids, lines)
                 break
-
-            m = r.search(line)
-            if m:
-                lines.append('%s %10s %s' % (
-                    m.group('date'),
-                    m.group('author')[:10],
-                    m.group('rev')))
-                ids.append(m.group('rev'))
+            for line in output:
+                m = r.search(line)
+                if m:
+                    lines.append('%s %10s %s' % (
+                        m.group('date'),
+                        m.group('author')[:10],
+                        m.group('rev')))
+                    ids.append(m.group('rev'))
 
     @core.run_in_background
     def async_branches(self, visitor):
@@ -297,27 +305,27 @@ class CVS(core_staging.Emulate_Staging,
         sticky = set()
         in_tags = False
         while True:
-            line = yield p.wait_line()
-            if line is None:
+            lines = yield p.wait_lines()
+            if lines is None:
                 visitor.branches(
                     CAT_TAGS, 'vcs-tag-symbolic', not CAN_RENAME,
                     [GPS.VCS2.Branch(
                         name=t, active=t in sticky, annotation='', id=t)
                      for t in tags])
                 break
-
-            if line.startswith('   Existing Tags:'):
-                in_tags = True
-            elif in_tags and not line:
-                in_tags = False
-            elif in_tags and line != '\tNo Tags Exist':
-                tags.add(line.lstrip().split(' ')[0])
-            elif not in_tags and line.startswith('   Sticky Tag:'):
-                s = line.split()[2]
-                if s == '(none)':
-                    sticky.add('HEAD')
-                else:
-                    sticky.add(s)
+            for line in lines:
+                if line.startswith('   Existing Tags:'):
+                    in_tags = True
+                elif in_tags and not line:
+                    in_tags = False
+                elif in_tags and line != '\tNo Tags Exist':
+                    tags.add(line.lstrip().split(' ')[0])
+                elif not in_tags and line.startswith('   Sticky Tag:'):
+                    s = line.split()[2]
+                    if s == '(none)':
+                        sticky.add('HEAD')
+                    else:
+                        sticky.add(s)
 
     @core.run_in_background
     def async_action_on_branch(self, visitor, action, category, id, text=''):
@@ -1,6 +1,8 @@
 import json
 import os
-from workflows.promises import ProcessWrapper
+import time
+import workflows
+from workflows.promises import ProcessWrapper, Promise
 import GPS
 from . import core
 from . import git
@@ -9,12 +11,58 @@ CAT_REVIEWS = 'REVIEWS'
 
 CAN_RENAME = True
 
+REVIEWS_TTL = 120
+# Number of seconds during which the list of reviews is reused as is. After
+# that, the Branches view still shows it, but it is refreshed in the
+# background.
+
+CONTROL_PERSIST = 600
+# Number of seconds during which the ssh connection to Gerrit is kept open
+# after the last query, so that later queries do not need to connect again
+
+MAX_SOCKET_PATH = 100
+# Unix sockets paths are limited to 104 or 108 bytes depending on the system.
+# When the path of the ssh control socket would be longer, each query uses
+# its own connection.
+
+
+def control_path():
+    """
+    The path of the socket used to share the ssh connection to Gerrit, or
+    None when it cannot be shared.
+    """
+    if os.name == 'nt':
+        return None   # not supported by ssh
+
+    # %C is a hash of the user, host and port, which keeps the path short:
+    # it expands to 40 characters.
+    control = os.path.join(GPS.get_tmp_dir(), 'gps-ssh-%C')
+    if len(control) + 38 > MAX_SOCKET_PATH:
+        return None
+    return control
+
 
 class Gerrit(core.Extension):
+
+    ssh = 'ssh'
+    # The ssh executable. It receives the same arguments as ssh, so it can
+    # be replaced by a script that emulates a Gerrit server.
+
     def __init__(self, base_vcs):
         super(Gerrit, self).__init__(base_vcs)
         self.gerrit_accessible = True
 
+        self.__reviews = None
+        self.__reviews_time = 0
+        # The reviews last received from Gerrit, and when
+
+        self.__refresh = None
+        # The promise for the query being run, if any
+
+        self.__control = control_path()
+        # The path of the ssh control socket, or None when the connection
+        # is not shared between queries
+
     def applies(self):
         gitreview = os.path.join(self.base.working_dir.path, '.gitreview')
 
@@ -36,22 +84,42 @@ class Gerrit(core.Extension):
         else:
             return False
 
-    def async_branches(self, visitor):
+    def __ssh_args(self, multiplex):
+        """
+        The arguments to connect to Gerrit with ssh.
+
+        :param bool multiplex: whether to share the connection between
+           successive queries
+        """
         # We use -q to hide warnings which could for instance occur
         # when redirecting ports if ~/.ssh/config contains
         #   Host ...
         #      RemoteForward 3142 localhost:22
 
-        if not self.gerrit_accessible:
-            return
+        args = [self.ssh,
+                '-x',
+                '-q',  # Hide warnings
+                '-p' if self.port else '', self.port]
+        if multiplex:
+            args += ['-o', 'ControlMaster=auto',
+                     '-o', 'ControlPath=%s' % self.__control,
+                     '-o', 'ControlPersist=%d' % CONTROL_PERSIST]
+        return args + [self.host]
 
+    @workflows.run_as_workflow
+    def __query_reviews(self, multiplex=True):
+        """
+        Fetch the list of open reviews from Gerrit, parsing the reviews as
+        they are output. On success, the reviews are cached.
+        If the query fails with a shared ssh connection, it is run again
+        with its own connection. The connection is no longer shared only
+        if that second query succeeds, since both fail when Gerrit cannot
+        be reached.
+        """
+        multiplex = multiplex and self.__control is not None
         p = ProcessWrapper(
-            ['ssh',
-             '-x',
-             '-q',  # Hide warnings
-             '-p' if self.port else '', self.port,
-             self.host,
-             'gerrit',
+            self.__ssh_args(multiplex) +
+            ['gerrit',
              'query',
              '--format=json',
              '--current-patch-set',
@@ -59,43 +127,99 @@ class Gerrit(core.Extension):
              'status:open'], block_exit=False)
 
         reviews = []
+        received = False
         while True:
-            line = yield p.wait_line()
-            if line is None:
-                if reviews:
-                    visitor.branches(
-                        CAT_REVIEWS, 'vcs-gerrit-symbolic',
-                        not CAN_RENAME, reviews)
+            lines = yield p.wait_lines()
+            if lines is None:
                 break
+            received = received or bool(lines)
+            for line in lines:
+                if line.startswith('Bad port'):
+                    # Seems like Gerrit can't be accessed
+                    GPS.Console().write('Can\'t access Gerrit %s:%s\n' % (
+                        self.host, self.port))
+                    self.gerrit_accessible = False
+                    return
 
-            if line.startswith('Bad port'):
-                # Seems like Gerrit can't be accessed
-                GPS.Console().write('Can\'t access Gerrit %s:%s\n' % (
-                    self.host, self.port))
-                self.gerrit_accessible = False
-                break
+                try:
+                    patch = json.loads(line)
+                except ValueError:
+                    GPS.Logger("VCS2").log(
+                        "Unexpected output from Gerrit: %s" % line)
+                    continue
+
+                if patch and patch.get(u'subject', None) is not None:
+                    review = '0'
+                    workflow = ''
+                    patchset = patch[u'currentPatchSet']
+                    if patchset.get(u'approvals', None) is not None:
+                        for a in patchset[u'approvals']:
+                            if a[u'type'] == u'Workflow':
+                                workflow = '|%s' % a['value']
+                            elif a[u'type'] == u'Code-Review':
+                                review = a['value']
+
+                    id = {'url': patch.get(u'url', ''),
+                          'number': patch.get(u'number', '')}
+
+                    reviews.append(
+                        ('%s: %s' % (patchset[u'author'][u'username'],
+                                     patch[u'subject']),
+                         False,   # not active
+                         '%s%s' % (review, workflow),
+                         json.dumps(id)))
+
+        if not received and multiplex:
+            # Gerrit always outputs statistics, so ssh failed to connect
+            yield self.__query_reviews(multiplex=False)
+            return
+
+        if received and not multiplex and self.__control is not None:
+            GPS.Logger("VCS2").log(
+                "Could not share the ssh connection to %s" % self.host)
+            self.__control = None
+
+        self.__reviews = reviews
+        self.__reviews_time = time.time()
+
+    def __refresh_reviews(self):
+        """
+        Start fetching the reviews in the background, unless this is
+        already being done.
+
+        :returntype: a promise resolved when the reviews have been fetched,
+           or when the query failed
+        """
+        refresh = self.__refresh
+        if refresh is None:
+            refresh = self.__refresh = Promise()
+
+            def _done(result):
+                self.__refresh = None
+                refresh.resolve(None)
+
+            self.__query_reviews().then(_done, _done)
+        return refresh
+
+    def invalidate_reviews(self):
+        """
+        Force a query to Gerrit the next time the reviews are needed
+        """
+        self.__reviews_time = 0
+
+    def async_branches(self, visitor):
+        if not self.gerrit_accessible:
+            return
+
+        if self.__reviews is None:
+            yield self.__refresh_reviews()
+        elif time.time() - self.__reviews_time > REVIEWS_TTL:
+            self.__refresh_reviews()   # used on the next update of the view
 
-            patch = json.loads(line)
-            if patch and patch.get(u'subject', None) is not None:
-                review = '0'
-                workflow = ''
-                patchset = patch[u'currentPatchSet']
-                if patchset.get(u'approvals', None) is not None:
-                    for a in patchset[u'approvals']:
-                        if a[u'type'] == u'Workflow':
-                            workflow = '|%s' % a['value']
-                        elif a[u'type'] == u'Code-Review':
-                            review = a['value']
-
-                id = {'url': patch.get(u'url', ''),
-                      'number': patch.get(u'number', '')}
-
-                reviews.append(
-                    ('%s: %s' % (patchset[u'author'][u'username'],
-                                 patch[u'subject']),
-                     False,   # not active
-                     '%s%s' % (review, workflow),
-                     json.dumps(id)))
+        if self.gerrit_accessible and self.__reviews:
+            visitor.branches(
+                CAT_REVIEWS, 'vcs-gerrit-symbolic',
+                not CAN_RENAME, self.__reviews)
 
     def async_action_on_branch(self, visitor, action, category, id, text=''):
         if not self.gerrit_accessible:
@@ -137,6 +261,7 @@ class Gerrit(core.Extension):
             spawn_console='')
         status, _ = yield p.wait_until_terminate()
         if status == 0:
+            self.invalidate_reviews()
             GPS.MDI.information_popup(
                 'Pushed to review', 'vcs-cloud-symbolic')
 
@@ -3,7 +3,8 @@ from . import core
 import os
 import re
 import workflows
-from workflows.promises import ProcessWrapper, join, Promise
+from workflows.promises import ProcessWrapper, join, Promise, timeout
+from collections import OrderedDict
 import datetime
 
 
@@ -22,6 +23,116 @@ LOCAL_CHANGES_ID = 'localchanges'
 _version = None
 # Git version
 
+HISTORY_CHUNK_SIZE = 1000
+# Number of commits sent at once to the History view
+
+HISTORY_CACHE_SIZE = 8
+# Number of histories (for various sets of refs and filters) kept in memory
+
+DETAILS_CACHE_SIZE = 16 * 1024 * 1024
+# Maximum total size, in characters, of the commit details kept in memory
+
+DETAILS_PREFETCH = 2
+# Number of commits, before and after the one selected in the History view,
+# whose details are computed in advance
+
+DETAILS_PREFETCH_DELAY_MS = 300
+# How long a commit must stay selected before its neighbours are prefetched
+
+
+class _History(object):
+    """
+    The commits already parsed from "git log", for a given state of the
+    refs and a given filter.
+    """
+
+    def __init__(self):
+        self.commits = []
+        # The GPS.VCS2.Commit parsed so far, in the order output by git.
+        # Their flags are computed when they are sent to the History view.
+
+        self.complete = False
+        # Whether all the commits have been parsed
+
+        self.__positions = {}
+        # The index of each commit in self.commits, computed on demand
+
+    def neighbours(self, id, count):
+        """
+        Return the ids of the `count` commits before and after commit `id`.
+
+        :param str id:
+        :param int count:
+        :returntype: a list of commit ids
+        """
+        for idx in range(len(self.__positions), len(self.commits)):
+            self.__positions[self.commits[idx][0]] = idx
+
+        idx = self.__positions.get(id)
+        if idx is None:
+            return []
+        return [c[0] for c in self.commits[max(idx - count, 0):idx + count + 1]
+                if c[0] != id]
+
+
+class _Branches_Recorder(object):
+    """
+    A visitor for async_branches, that records the branches it receives
+    before forwarding them to the actual visitor.
+    """
+
+    def __init__(self, visitor):
+        self.visitor = visitor
+        self.calls = []
+
+    def branches(self, *args):
+        self.calls.append(args)
+        self.visitor.branches(*args)
+
+
+class _Details_Cache(object):
+    """
+    The details of commits, as sent to the History view, indexed by commit
+    id. The least recently used are discarded when their total size exceeds
+    `max_size` characters, since some patches are very large.
+    """
+
+    def __init__(self, max_size=DETAILS_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.__entries = OrderedDict()   # id -> (header, message)
+
+    def __contains__(self, id):
+        return id in self.__entries
+
+    def get(self, id):
+        """
+        :returntype: a tuple (header, message), or None
+        """
+        value = self.__entries.pop(id, None)
+        if value is not None:
+            self.__entries[id] = value   # now the most recently used
+        return value
+
+    def set(self, id, header, message):
+        old = self.__entries.pop(id, None)
+        if old is not None:
+            self.size -= len(old[0]) + len(old[1])
+
+        size = len(header) + len(message)
+        if size > self.max_size:
+            return
+
+        self.__entries[id] = (header, message)
+        self.size += size
+        while self.size > self.max_size:
+            _, (h, m) = self.__entries.popitem(last=False)
+            self.size -= len(h) + len(m)
+
+    def clear(self):
+        self.__entries.clear()
+        self.size = 0
+
 
 @core.register_vcs(default_status=GPS.VCS2.Status.UNMODIFIED)
 class Git(core.VCS):
@@ -35,7 +146,38 @@ class Git(core.VCS):
         super(Git, self).__init__(*args, **kwargs)
 
         self._non_default_files = None
-        # Files with a non-default status
+        # The status of the files with a non-default status, indexed by
+        # their path relative to the working directory.
+
+        self.__tracked_files = None
+        self.__tracked_head = None
+        # The files under version control in commit __tracked_head, as
+        # computed by "git ls-tree"
+
+        self.__index_mtime = None
+        # The modification time of git's index when the status of all files
+        # was last computed.
+
+        self.__histories = OrderedDict()
+        # The _History already computed, indexed by refs and filter. The
+        # most recently used is last.
+
+        self.__details = _Details_Cache()
+        self.__details_refs = None
+        # The details of single commits, for the refs __details_refs
+
+        self.__prefetch_id = None
+        # The commit whose neighbours should be prefetched
+
+        self.__refs_key_mtimes = None
+        self.__refs_key_value = None
+        # The result of _refs_key, and the __refs_mtimes it was computed for
+
+        self.__branches_mtimes = None
+        self.__branches = []
+        # The branches, tags, stashes and worktrees last sent to the
+        # Branches view, and the __refs_mtimes they were computed for
+
         self.__set_git_version()
 
     def _git(self, args, block_exit=False, **kwargs):
@@ -63,52 +205,203 @@ class Git(core.VCS):
         p = self._git(['ls-tree', '-r', 'HEAD', '--name-only'])
         yield p.lines.subscribe(on_line)   # wait until p terminates
 
-    def __git_status(self, s):
+    def __git_head(self):
+        """
+        A generator that returns the id of the current HEAD commit, or None
+        """
+        p = self._git(['rev-parse', '--verify', '--quiet', 'HEAD'])
+        status, output = yield p.wait_until_terminate()
+        yield output.strip() if status == 0 else None
+
+    def __tracked(self):
+        """
+        A generator that returns the list of files under version control.
+        "git ls-tree" is only run again when HEAD has changed.
+        """
+        head = yield self.__git_head()
+        if head is None or head != self.__tracked_head:
+            all_files = []   # faster to update than a set
+            yield self.__git_ls_tree(all_files)
+            self.__tracked_files = all_files
+            self.__tracked_head = head
+        yield self.__tracked_files
+
+    def __git_dirs(self):
+        """
+        Return the git directory for the working directory, and the
+        directory where the refs are stored (they are different when using
+        "git worktree"), or None if they cannot be found.
+
+        :returntype: a tuple (str, str), or None
+        """
+        git = os.path.join(self.working_dir.path, '.git')
+        try:
+            if os.path.isfile(git):
+                # When using "git worktree", ".git" is a file that points to
+                # the actual git directory
+                with open(git) as f:
+                    content = f.read().strip()
+                if not content.startswith('gitdir:'):
+                    return None
+                git = os.path.join(self.working_dir.path, content[7:].strip())
+
+            common = git
+            if os.path.isfile(os.path.join(git, 'commondir')):
+                with open(os.path.join(git, 'commondir')) as f:
+                    common = os.path.join(git, f.read().strip())
+            return (git, common)
+        except (IOError, OSError):
+            return None
+
+    def __git_index_mtime(self):
+        """
+        Return the modification time of git's index, or None if it cannot
+        be found.
+        """
+        dirs = self.__git_dirs()
+        try:
+            return os.stat(os.path.join(dirs[0], 'index')).st_mtime
+        except (TypeError, OSError):
+            return None
+
+    def __refs_mtimes(self):
+        """
+        Return a value that changes whenever a ref (branch, tag, HEAD,...),
+        a stash or a worktree is modified, without running git, or None if
+        it cannot be computed.
+
+        Git updates refs by renaming a new file over the old one, so it is
+        enough to check the modification time of the directories for loose
+        refs.
+        """
+        dirs = self.__git_dirs()
+        if dirs is None:
+            return None
+        git, common = dirs
+        result = []
+
+        def _add(path):
+            try:
+                st = os.stat(path)
+                result.append((path, st.st_mtime, st.st_size))
+            except OSError:
+                result.append((path, None, None))  # e.g. no packed-refs
+
+        _add(os.path.join(git, 'HEAD'))
+        _add(os.path.join(common, 'packed-refs'))
+        _add(os.path.join(common, 'logs', 'refs', 'stash'))
+        for root, _, _ in os.walk(os.path.join(common, 'refs')):
+            _add(root)
+
+        worktrees = os.path.join(common, 'worktrees')
+        _add(worktrees)
+        if os.path.isdir(worktrees):
+            for name in sorted(os.listdir(worktrees)):
+                _add(os.path.join(worktrees, name, 'HEAD'))
+
+        return result
+
+    def __head_ref(self):
+        """
+        Return the contents of HEAD: "ref: refs/heads/<branch>", or the
+        id of the commit when HEAD is detached, or None if unknown.
+        """
+        dirs = self.__git_dirs()
+        try:
+            with open(os.path.join(dirs[0], 'HEAD')) as f:
+                return f.read().strip()
+        except (TypeError, IOError):
+            return None
+
+    @staticmethod
+    def __status_from_xy(xy):
+        """
+        Convert the two letters status of "git status --porcelain" to a
+        GPS.VCS2.Status.
+        """
+        if xy in ('DD', 'AU', 'UD', 'UA', 'DU', 'AA', 'UU'):
+            return GPS.VCS2.Status.CONFLICT
+
+        status = 0
+        if xy[0] == 'M':
+            status = GPS.VCS2.Status.STAGED_MODIFIED
+        elif xy[0] == 'A':
+            status = GPS.VCS2.Status.STAGED_ADDED
+        elif xy[0] == 'D':
+            status = GPS.VCS2.Status.STAGED_DELETED
+        elif xy[0] == 'R':
+            status = GPS.VCS2.Status.STAGED_RENAMED
+        elif xy[0] == 'C':
+            status = GPS.VCS2.Status.STAGED_COPIED
+        elif xy[0] == '?':
+            status = GPS.VCS2.Status.UNTRACKED
+        elif xy[0] == '!':
+            status = GPS.VCS2.Status.IGNORED
+
+        if xy[1] == 'M':
+            status = status | GPS.VCS2.Status.MODIFIED
+        elif xy[1] == 'D':
+            status = status | GPS.VCS2.Status.DELETED
+
+        return status
+
+    def __git_status(self, statuses, files=None):
         """
         Run and parse "git status"
-        :param s: the result of calling self.set_status_for_all_files
+        :param dict statuses: will be modified to include the status of
+           each file with a non-default status, indexed by their path
+           relative to the working directory.
+        :param List(GPS.File) files: if specified, only compute the status
+           of these files.
         """
-        def on_line(line):
-            if len(line) > 3:
-                if line[0:2] in ('DD', 'AU', 'UD', 'UA', 'DU', 'AA', 'UU'):
-                    status = GPS.VCS2.Status.CONFLICT
-                else:
-                    status = 0
-
-                    if line[0] == 'M':
-                        status = GPS.VCS2.Status.STAGED_MODIFIED
-                    elif line[0] == 'A':
-                        status = GPS.VCS2.Status.STAGED_ADDED
-                    elif line[0] == 'D':
-                        status = GPS.VCS2.Status.STAGED_DELETED
-                    elif line[0] == 'R':
-                        status = GPS.VCS2.Status.STAGED_RENAMED
-                    elif line[0] == 'C':
-                        status = GPS.VCS2.Status.STAGED_COPIED
-                    elif line[0] == '?':
-                        status = GPS.VCS2.Status.UNTRACKED
-                    elif line[0] == '!':
-                        status = GPS.VCS2.Status.IGNORED
-
-                    if line[1] == 'M':
-                        status = status | GPS.VCS2.Status.MODIFIED
-                    elif line[1] == 'D':
-                        status = status | GPS.VCS2.Status.DELETED
-
-                # Filter some obvious files to speed things up
-                if line[-3:] != '.o' and line[-5:] != '.ali':
-                    s.set_status(
-                        GPS.File(
-                            os.path.join(self.working_dir.path, line[3:])),
-                        status)
+        paths = ['--'] + [self._relpath(f.path) for f in files] \
+            if files else []
 
         if _version < [1, 7, 2]:
             ignored = []
         else:
             ignored = ['--ignored']
 
-        p = self._git(['status', '--porcelain'] + ignored)
-        yield p.lines.subscribe(on_line)   # wait until p terminates
+        if _version < [2, 11, 0]:
+            def on_line(line):
+                if len(line) > 3:
+                    statuses[line[3:]] = self.__status_from_xy(line[0:2])
+
+            p = self._git(['status', '--porcelain'] + ignored + paths)
+            yield p.lines.subscribe(on_line)   # wait until p terminates
+            return
+
+        # With version 2 of the format, paths are never quoted, and records
+        # are separated with NUL characters, so the whole output can be
+        # split at once.
+        p = self._git(['status', '--porcelain=v2', '-z'] + ignored + paths)
+        _, output = yield p.wait_until_terminate()
+
+        records = output.split('\0')
+        idx = 0
+        while idx < len(records):
+            r = records[idx]
+            idx += 1
+            if not r:
+                continue
+
+            kind = r[0]
+            if kind == '1':
+                # 1 XY sub mH mI mW hH hI path
+                statuses[r.split(' ', 8)[8]] = \
+                    self.__status_from_xy(r[2:4])
+            elif kind == '2':
+                # 2 XY sub mH mI mW hH hI score path, followed by the
+                # original path in the next record
+                statuses[r.split(' ', 9)[9]] = \
+                    self.__status_from_xy(r[2:4])
+                idx += 1
+            elif kind == 'u':
+                statuses[r.split(' ', 10)[10]] = GPS.VCS2.Status.CONFLICT
+            elif kind == '?':
+                statuses[r[2:]] = GPS.VCS2.Status.UNTRACKED
+            elif kind == '!':
+                statuses[r[2:]] = GPS.VCS2.Status.IGNORED
 
     @workflows.run_as_workflow
     def __set_git_version(self):
@@ -131,6 +424,16 @@ class Git(core.VCS):
             from_user=False,
             extra_files=files)
 
+    def __set_status(self, s, path, status):
+        """
+        Set the status of the file at path, relative to the working directory
+        :param s: the result of calling self.set_status_for_all_files
+        """
+        # Filter some obvious files to speed things up
+        if path[-2:] != '.o' and path[-4:] != '.ali':
+            s.set_status(
+                GPS.File(os.path.join(self.working_dir.path, path)), status)
+
     @core.run_in_background
     def async_fetch_status_for_all_files(self, from_user, extra_files=[]):
         """
@@ -140,33 +443,56 @@ class Git(core.VCS):
 
         s = self.set_status_for_all_files()
         files = set(extra_files)
+        requested = set(self._relpath(f.path) for f in extra_files)
+        statuses = {}
+        index_mtime = self.__git_index_mtime()
 
-        # Do we need to reset the "ls-tree" cache ? After the initial
-        # loading, this list no longer changes without also impacting the
-        # output of "git status", so we do not need to execute it again.
         if from_user or self._non_default_files is None:
-            all_files = []   # faster to update than a set
-            yield join(self.__git_ls_tree(all_files), self.__git_status(s))
-            self._non_default_files = s.files_with_explicit_status
+            # Set the status of all files. The list of files under version
+            # control only changes when HEAD changes.
+            all_files, _ = yield join(
+                self.__tracked(), self.__git_status(statuses))
+            for path, status in statuses.iteritems():
+                self.__set_status(s, path, status)
             files.update(all_files)
 
-        else:
-            # Reuse caches: we do not need to recompute the full list of files
-            # for git, since this will not change without also changing the
-            # output of "git status". We also do not reset the default status
-            # for all the files not in the git status output: that might be a
-            # slow operation that is blocking GPS. Instead, we only reset the
-            # default status for files that used to be in "git status" (for
-            # instance modified files), and are no longer there (either after
-            # a "reset" or a "commit").
-
-            yield self.__git_status(s)
-            nondefault = s.files_with_explicit_status
-            now_default = self._non_default_files.difference(nondefault)
-            self._non_default_files = nondefault
-            for f in now_default:
-                s.set_status(f, self.default_status)
+        elif extra_files and index_mtime is not None \
+                and index_mtime == self.__index_mtime:
+            # The index has not changed since the last full status, so only
+            # the status of the files that were modified on the disk might
+            # have changed.
+            yield self.__git_status(statuses, files=extra_files)
+            for path, status in statuses.iteritems():
+                self.__set_status(s, path, status)
+
+            for path, status in self._non_default_files.iteritems():
+                if path not in statuses and path not in requested:
+                    statuses[path] = status
+
+            self._non_default_files = statuses
+            s.set_status_for_remaining_files(files)
+            return
 
+        else:
+            # Only report the files whose status has changed since the last
+            # run. We do not reset the default status for all the files not
+            # in the git status output: that might be a slow operation that
+            # is blocking GPS. Instead, we only reset the default status for
+            # files that used to be in "git status" (for instance modified
+            # files), and are no longer there (either after a "reset" or a
+            # "commit").
+
+            yield self.__git_status(statuses)
+            previous = self._non_default_files
+            for path, status in statuses.iteritems():
+                if previous.get(path) != status or path in requested:
+                    self.__set_status(s, path, status)
+            for path in previous:
+                if path not in statuses:
+                    self.__set_status(s, path, self.default_status)
+
+        self._non_default_files = statuses
+        self.__index_mtime = index_mtime
         s.set_status_for_remaining_files(files)
 
     @core.run_in_background
@@ -243,10 +569,10 @@ class Git(core.VCS):
         unpushed = set()
         p = self._git(['cherry'])
         while True:
-            line = yield p.wait_line()
-            if line is None:
+            lines = yield p.wait_lines()
+            if lines is None:
                 break
-            unpushed.add(line[2:])
+            unpushed.update(line[2:] for line in lines)
         yield unpushed
 
     def _has_local_changes(self):
@@ -257,14 +583,58 @@ class Git(core.VCS):
         status, _ = yield p.wait_until_terminate()
         yield status != 0
 
+    def _refs_key(self):
+        """
+        A generator that returns a value that changes whenever one of the
+        refs (branches, tags, HEAD,...) is moved.
+        "git show-ref" is only run when the refs might have changed.
+        """
+        mtimes = self.__refs_mtimes()
+        if mtimes is None or mtimes != self.__refs_key_mtimes:
+            p = self._git(['show-ref', '--head'])
+            _, output = yield p.wait_until_terminate()
+            self.__refs_key_value = hash(output)
+            self.__refs_key_mtimes = mtimes
+        yield self.__refs_key_value
+
+    def __parse_log_line(self, line):
+        """
+        Parse one line of the output of "git log" (see async_fetch_history)
+
+        :returntype: a GPS.VCS2.Commit, with no flags
+        """
+        id, parents, author, branches, date, subject = line.split('@@')
+        parents = parents.split()
+
+        if not branches:
+            branch_descr = None
+        else:
+            branch_descr = []
+            for b in branches.split(','):
+                b = b.strip()
+
+                # ??? How do we detect other remotes
+                if b.startswith('origin/'):
+                    f = (b, GPS.VCS2.Commit.Kind.REMOTE)
+                elif b.startswith("HEAD"):
+                    f = (b, GPS.VCS2.Commit.Kind.HEAD)
+                elif b.startswith("tag: "):
+                    f = (b[5:], GPS.VCS2.Commit.Kind.TAG)
+                else:
+                    f = (b, GPS.VCS2.Commit.Kind.LOCAL)
+
+                branch_descr.append(f)
+
+        return GPS.VCS2.Commit(
+            id, author, date, subject, parents, branch_descr)
+
     @core.run_in_background
     def async_fetch_history(self, visitor, filter):
         # Compute, in parallel, needed pieces of information
-        (unpushed, has_local) = yield join(
+        (unpushed, has_local, refs) = yield join(
             self._unpushed_local_changes(),
-            self._has_local_changes())
-
-        # Then fetch the history
+            self._has_local_changes(),
+            self._refs_key())
 
         max_lines = filter[0]
         for_file = filter[1]
@@ -272,6 +642,58 @@ class Git(core.VCS):
         current_branch_only = filter[3]
         branch_commits_only = filter[4]
 
+        # The commits parsed for the same refs and filter are reused, and
+        # "git log" is only run for the ones that were never parsed. When
+        # only branching points are shown, the whole log needs to be
+        # parsed to count the children of each commit, so nothing is kept.
+
+        if branch_commits_only:
+            history = _History()
+        else:
+            key = (refs, for_file.path if for_file else '', pattern,
+                   current_branch_only)
+            history = self.__histories.pop(key, None) or _History()
+            self.__histories[key] = history
+            if len(self.__histories) > HISTORY_CACHE_SIZE:
+                self.__histories.popitem(last=False)
+
+        chunk = []
+        need_local_changes = [has_local]
+
+        def _emit():
+            # Compute flags, and append a dummy entry before the HEAD
+            # commit if we have local changes.
+            result = []
+            for c in chunk:
+                c[6] = GPS.VCS2.Commit.Flags.UNPUSHED if c[0] in unpushed \
+                    else 0
+                if need_local_changes[0] and c[5] and any(
+                        k == GPS.VCS2.Commit.Kind.HEAD for _, k in c[5]):
+                    need_local_changes[0] = False
+                    result.insert(0, GPS.VCS2.Commit(
+                        LOCAL_CHANGES_ID,
+                        '',
+                        '',
+                        '<uncommitted changes>',
+                        parents=[c[0]],
+                        flags=GPS.VCS2.Commit.Flags.UNCOMMITTED |
+                        GPS.VCS2.Commit.Flags.UNPUSHED))
+                result.append(c)
+            del chunk[:]
+            visitor.history_lines(result)
+
+        for c in history.commits[:max_lines]:
+            chunk.append(c)
+            if len(chunk) >= HISTORY_CHUNK_SIZE:
+                _emit()
+
+        count = len(history.commits)
+        if count >= max_lines or history.complete:
+            _emit()
+            return
+
+        # Then fetch the missing part of the history
+
         filter_switch = ''
         if pattern:
             if pattern.startswith('author:'):
@@ -293,83 +715,57 @@ class Git(core.VCS):
         git_cmd += [
             '--topo-order',  # children before parents
             filter_switch,
-            '--max-count=%d' % max_lines if not branch_commits_only else '',
+            '--skip=%d' % count if count else '',
+            '--max-count=%d' % (max_lines - count)
+            if not branch_commits_only else '',
             '%s' % for_file.path if for_file else '']
         p = self._git(git_cmd)
 
         children = {}   # number of children for each sha1
-        result = []
         count = 0
+        done = False
+
+        while not done:
+            lines = yield p.wait_lines()
+            if lines is None:
+                lines = ['']   # end of the log
+
+            for line in lines:
+                if '@@' not in line:
+                    GPS.Logger("GIT").log("finished git-log")
+                    history.complete = True
+                    done = True
+                    break
+
+                current = self.__parse_log_line(line)
+                history.commits.append(current)
+                chunk.append(current)
+                if len(chunk) >= HISTORY_CHUNK_SIZE:
+                    _emit()
+
+                if branch_commits_only:
+                    id, parents = current[0], current[4]
+                    for pa in parents:
+                        children[pa] = children.setdefault(pa, 0) + 1
+
+                    # Count only relevant commits
+                    if (len(parents) > 1 or
+                            current[5] is not None or
+                            id not in children or
+                            children[id] > 1):
+                        count += 1
+
+                    done = count >= max_lines
 
-        while True:
-            line = yield p.wait_line()
-            if line is None or '@@' not in line:
-                GPS.Logger("GIT").log("finished git-status")
-                break
-
-            id, parents, author, branches, date, subject = line.split('@@')
-            parents = parents.split()
-            branches = None if not branches else branches.split(',')
-
-            has_head = None
-
-            flags = 0
-            if id in unpushed:
-                flags |= GPS.VCS2.Commit.Flags.UNPUSHED
-
-            if branches is None:
-                branch_descr = None
-            else:
-                branch_descr = []
-                for b in branches:
-                    b = b.strip()
-
-                    # ??? How do we detect other remotes
-                    if b.startswith('origin/'):
-                        f = (b, GPS.VCS2.Commit.Kind.REMOTE)
-                    elif b.startswith("HEAD"):
-                        has_head = id
-                        f = (b, GPS.VCS2.Commit.Kind.HEAD)
-                    elif b.startswith("tag: "):
-                        f = (b[5:], GPS.VCS2.Commit.Kind.TAG)
-                    else:
-                        f = (b, GPS.VCS2.Commit.Kind.LOCAL)
-
-                    branch_descr.append(f)
+                else:
+                    done = len(history.commits) >= max_lines
 
-            # Append a dummy entry if we have local changes, and
-            # we have the HEAD
-            if has_head is not None and has_local:
-                result.insert(0, GPS.VCS2.Commit(
-                    LOCAL_CHANGES_ID,
-                    '',
-                    '',
-                    '<uncommitted changes>',
-                    parents=[has_head],
-                    flags=GPS.VCS2.Commit.Flags.UNCOMMITTED |
-                    GPS.VCS2.Commit.Flags.UNPUSHED))
-
-            current = GPS.VCS2.Commit(
-                id, author, date, subject, parents, branch_descr, flags=flags)
-
-            if branch_commits_only:
-                for pa in parents:
-                    children[pa] = children.setdefault(pa, 0) + 1
-
-                # Count only relevant commits
-                if (len(parents) > 1 or
-                        branches is not None or
-                        id not in children or
-                        children[id] > 1):
-                    count += 1
-
-            result.append(current)
-            if count >= max_lines:
-                break
+                if done:
+                    break
 
         GPS.Logger("GIT").log(
-            "done parsing git-log (%s lines)" % (len(result), ))
-        visitor.history_lines(result)
+            "done parsing git-log (%s lines)" % (len(history.commits), ))
+        _emit()
 
     @core.run_in_background
     def async_fetch_commit_details(self, ids, visitor):
@@ -394,10 +790,63 @@ class Git(core.VCS):
                     output)
             return
 
-        # If there is a single commit, show the full patch (use
-        # --stat to also show the list of files).
-        # Otherwise, show the list of modified files
-        #
+        # The details of a single commit include the refnames, so they
+        # are only reused while the refs are unchanged. The details of
+        # multiple commits are small, and never cached.
+
+        if len(ids) > 1:
+            yield self.__parse_details(
+                self.__show(ids, patch=False), visitor.set_details)
+            return
+
+        refs = yield self._refs_key()
+        if refs != self.__details_refs:
+            self.__details.clear()
+            self.__details_refs = refs
+
+        cached = self.__details.get(ids[0])
+        if cached is not None:
+            visitor.set_details(ids[0], *cached)
+        else:
+            def _on_details(id, header, message):
+                self.__details.set(id, header, message)
+                visitor.set_details(id, header, message)
+
+            yield self.__parse_details(
+                self.__show(ids, patch=True), _on_details)
+
+        self.__prefetch_details(ids[0], refs)
+
+    @workflows.run_as_workflow
+    def __prefetch_details(self, id, refs):
+        """
+        Compute the details of the neighbours of commit `id` in the History
+        view, unless another commit is selected in the meantime.
+        """
+        self.__prefetch_id = id
+        yield timeout(DETAILS_PREFETCH_DELAY_MS)
+        if self.__prefetch_id != id or not self.__histories:
+            return
+
+        history = self.__histories.values()[-1]   # the most recent one
+        ids = [n for n in history.neighbours(id, DETAILS_PREFETCH)
+               if n not in self.__details]
+        if ids:
+            def _on_details(id, header, message):
+                if refs == self.__details_refs:
+                    self.__details.set(id, header, message)
+
+            yield self.__parse_details(
+                self.__show(ids, patch=True), _on_details)
+
+    def __show(self, ids, patch):
+        """
+        Return "git show" for the given commits.
+
+        :param bool patch: if True, show the full patch (with --stat to also
+           show the list of files). Otherwise, show the list of modified
+           files.
+        """
         # We use a custom format to be able to display the refnames, which
         # are not displayed otherwise by git.
 
@@ -409,12 +858,18 @@ class Git(core.VCS):
                   'Refnames:  %d%n%n'
                   '%B')
 
-        p = self._git(
+        return self._git(
             ['show',
-             '-p' if len(ids) == 1 else '--name-only',
-             '--stat' if len(ids) == 1 else '',
+             '-p' if patch else '--name-only',
+             '--stat' if patch else '',
              '--notes',   # show notes
              '--pretty=format:%s' % format] + ids)
+
+    def __parse_details(self, p, on_details):
+        """
+        A generator that parses the output of `__show`, and calls
+        on_details(id, header, message) for each commit.
+        """
         id = ""
         message = []
         header = []
@@ -422,31 +877,30 @@ class Git(core.VCS):
 
         def _emit():
             if id:
-                visitor.set_details(
-                    id, '\n'.join(header), '\n'.join(message))
+                on_details(id, '\n'.join(header), '\n'.join(message))
 
         while True:
-            line = yield p.wait_line()
-            if line is None:
+            lines = yield p.wait_lines()
+            if lines is None:
                 _emit()
                 break
+            for line in lines:
+                if line.startswith('commit '):
+                    _emit()
+                    id = line[7:]
+                    message = []
+                    header = [line]
+                    in_header = True
+
+                elif in_header:
+                    if not line:
+                        in_header = False
+                        message = ['']
+                    else:
+                        header.append(line)
 
-            if line.startswith('commit '):
-                _emit()
-                id = line[7:]
-                message = []
-                header = [line]
-                in_header = True
-
-            elif in_header:
-                if not line:
-                    in_header = False
-                    message = ['']
                 else:
-                    header.append(line)
-
-            else:
-                message.append(line)
+                    message.append(line)
 
     @core.run_in_background
     def async_view_file(self, visitor, ref, file):
@@ -468,6 +922,17 @@ class Git(core.VCS):
 
     @core.run_in_background
     def async_annotations(self, visitor, file):
+        # The annotations only change when the version of the file in HEAD
+        # or the local changes change.
+        p = self._git(['rev-parse', '--verify', '--quiet',
+                       'HEAD:%s' % self._relpath(file.path)])
+        _, blob = yield p.wait_until_terminate()
+        key = (file.path, blob.strip(), core.file_contents_hash(file))
+        cached = self.annotations_cache.get(key)
+        if cached is not None:
+            visitor.annotations(file, *cached)
+            return
+
         info = {}   # for each commit id, the annotation
         current_id = None
         first_line = 1
@@ -476,106 +941,101 @@ class Git(core.VCS):
 
         p = self._git(['blame', '--porcelain', file.path])
         while True:
-            line = yield p.wait_line()
-            if line is None:
+            output = yield p.wait_lines()
+            if output is None:
                 break
-
-            if current_id is None:
-                current_id = line.split(' ', 1)[0]
-
-            elif line[0] == '\t':
-                # The line of code, which we ignore
-                lines.append(info[current_id])
-                ids.append(current_id)
-                current_id = None
-
-            elif line.startswith('author '):
-                info[current_id] = line[7:17]  # at most 10 chars
-
-            elif line.startswith('committer-time '):
-                d = datetime.datetime.fromtimestamp(
-                    int(line[15:])).strftime('%Y%m%d')
-                info[current_id] = '%s %10s %s' % (
-                    d, info[current_id], current_id[0:7])
-
+            for line in output:
+                if current_id is None:
+                    current_id = line.split(' ', 1)[0]
+
+                elif line[0] == '\t':
+                    # The line of code, which we ignore
+                    lines.append(info[current_id])
+                    ids.append(current_id)
+                    current_id = None
+
+                elif line.startswith('author '):
+                    info[current_id] = line[7:17]  # at most 10 chars
+
+                elif line.startswith('committer-time '):
+                    d = datetime.datetime.fromtimestamp(
+                        int(line[15:])).strftime('%Y%m%d')
+                    info[current_id] = '%s %10s %s' % (
+                        d, info[current_id], current_id[0:7])
+
+        self.annotations_cache.set(key, first_line, ids, lines)
         visitor.annotations(file, first_line, ids, lines)
 
     def _branches(self, visitor):
         """
         A generator that returns via `visitor.branches` the list of all
-        known branches
+        known branches, remote branches and tags
         """
         branches = []
         remotes = []
-        r = re.compile(
-            "^(?P<current>\*)?\s+"
-            "(?P<name>[^(]\S+|\([^)]+\))"   # "(HEAD detached at ...)"
-            "\s+"
-            "(?P<id>[a-z0-9]+)"
-            "\s+"
-            "(\[(?P<tracking>.*\]))?")
-        emblem_r = re.compile(
-            "^(?P<tracking>.*):\s"
-            "(ahead (?P<ahead>\d+),?)?\s*"
-            "(behind (?P<behind>\d+))?")
-
-        p = self._git(['branch', '-a', '--list', '--no-color', '-vv'])
+        tags = []
+        ahead_r = re.compile("ahead (\d+)")
+        behind_r = re.compile("behind (\d+)")
+
+        head = self.__head_ref()
+        if head and not head.startswith('ref:'):
+            name = '(HEAD detached at %s)' % head[0:7]
+            branches.append(GPS.VCS2.Branch(
+                name=name, active=True, annotation='', id=name))
+
+        p = self._git(
+            ['for-each-ref',
+             # refnames cannot contain spaces
+             '--format=%(refname) %(upstream:short) %(upstream:track)',
+             'refs/heads', 'refs/remotes', 'refs/tags'])
         while True:
-            line = yield p.wait_line()
-            if line is None:
+            lines = yield p.wait_lines()
+            if lines is None:
                 visitor.branches(
                     CAT_BRANCHES, 'vcs-branch-symbolic', CAN_RENAME, branches)
                 visitor.branches(
                     CAT_REMOTES, 'vcs-cloud-symbolic', not CAN_RENAME, remotes)
+                visitor.branches(
+                    CAT_TAGS, 'vcs-tag-symbolic', CAN_RENAME, tags)
                 break
-            m = r.search(line)
-            if m:
-                n = m.group('name')
-                emblem = []
-                m2 = emblem_r.search(m.group('tracking') or '')
-                if m2:
-                    n = '%s (%s)' % (n, m2.group('tracking'))
-                    if m2.group('ahead'):
-                        emblem.append("%s%s%s%s" % (
-                            chr(226), chr(134), chr(145),
-                            m2.group('ahead')))
-                    if m2.group('behind'):
-                        emblem.append("%s%s%s%s" % (
-                            chr(226), chr(134), chr(147),
-                            m2.group('behind')))
-
-                emblem = ' '.join(emblem)
-
-                if n.startswith('remotes/'):
-                    remotes.append(
-                        GPS.VCS2.Branch(
-                            name=n[8:],
-                            active=m.group('current') is not None,
-                            annotation=emblem,
-                            id=m.group('name')))
-                else:
+            for line in lines:
+                refname, upstream, track = line.split(' ', 2)
+
+                if refname.startswith('refs/heads/'):
+                    n = refname[11:]
+                    emblem = []
+                    if track:   # "[ahead 1, behind 2]" or "[gone]"
+                        n = '%s (%s)' % (n, upstream)
+                        m = ahead_r.search(track)
+                        if m:
+                            emblem.append("%s%s%s%s" % (
+                                chr(226), chr(134), chr(145), m.group(1)))
+                        m = behind_r.search(track)
+                        if m:
+                            emblem.append("%s%s%s%s" % (
+                                chr(226), chr(134), chr(147), m.group(1)))
+
                     branches.append(
                         GPS.VCS2.Branch(
                             name=n,
-                            active=m.group('current') is not None,
-                            annotation=emblem,
-                            id=m.group('name')))
-
-    def _tags(self, visitor):
-        """
-        A generator that returns the list of all known tags
-        via `visitor.branches`
-        """
-        p = self._git(['tag'])
-        tags = []
-        while True:
-            line = yield p.wait_line()
-            if line is None:
-                visitor.branches(
-                    CAT_TAGS, 'vcs-tag-symbolic', CAN_RENAME, tags)
-                break
-            tags.append(GPS.VCS2.Branch(
-                name=line, active=False, annotation='', id=line))
+                            active=head == 'ref: %s' % refname,
+                            annotation=' '.join(emblem),
+                            id=refname[11:]))
+
+                elif refname.startswith('refs/remotes/'):
+                    n = refname[13:]
+                    if not n.endswith('/HEAD'):   # symbolic ref
+                        remotes.append(
+                            GPS.VCS2.Branch(
+                                name=n,
+                                active=False,
+                                annotation='',
+                                id='remotes/%s' % n))
+
+                elif refname.startswith('refs/tags/'):
+                    tags.append(GPS.VCS2.Branch(
+                        name=refname[10:], active=False, annotation='',
+                        id=refname[10:]))
 
     def _stashes(self, visitor):
         """
@@ -585,18 +1045,19 @@ class Git(core.VCS):
         p = self._git(['stash', 'list'])
         stashes = []
         while True:
-            line = yield p.wait_line()
-            if line is None:
+            lines = yield p.wait_lines()
+            if lines is None:
                 visitor.branches(
                     'stashes', 'vcs-stash-symbolic', not CAN_RENAME, stashes)
                 break
-            name, branch, descr = line.split(':', 2)
-            stashes.append(
-                GPS.VCS2.Branch(
-                    name='%s: %s' % (name, descr),
-                    active=False,
-                    annotation=branch,
-                    id=name))
+            for line in lines:
+                name, branch, descr = line.split(':', 2)
+                stashes.append(
+                    GPS.VCS2.Branch(
+                        name='%s: %s' % (name, descr),
+                        active=False,
+                        annotation=branch,
+                        id=name))
 
     def _worktrees(self, visitor):
         """
@@ -609,8 +1070,8 @@ class Git(core.VCS):
         trees = []
         current = []
         while True:
-            line = yield p.wait_line()
-            if line is None:
+            lines = yield p.wait_lines()
+            if lines is None:
                 # Do not report if we only have the current directory
                 if len(trees) > 1:
                     visitor.branches(
@@ -619,20 +1080,21 @@ class Git(core.VCS):
                         not CAN_RENAME,
                         trees)
                 break
-            elif not line:
-                trees.append(current)
-            elif line.startswith('worktree '):
-                current = GPS.VCS2.Branch(
-                    name='"%s"' % line[9:],   # quoted not to expand '/'
-                    active=self.working_dir == GPS.File(line[9:]),
-                    annotation='',
-                    id='')   # unique id
-            elif line.startswith('HEAD '):
-                current[3] = line[5:]   # unique id
-            elif line.startswith('branch '):
-                current[2] = line[7:]   # details
-            elif line.startswith('detached'):
-                current[2] = 'detached'  # details
+            for line in lines:
+                if not line:
+                    trees.append(current)
+                elif line.startswith('worktree '):
+                    current = GPS.VCS2.Branch(
+                        name='"%s"' % line[9:],   # quoted not to expand '/'
+                        active=self.working_dir == GPS.File(line[9:]),
+                        annotation='',
+                        id='')   # unique id
+                elif line.startswith('HEAD '):
+                    current[3] = line[5:]   # unique id
+                elif line.startswith('branch '):
+                    current[2] = line[7:]   # details
+                elif line.startswith('detached'):
+                    current[2] = 'detached'  # details
 
     def _submodules(self, visitor):
         """
@@ -641,8 +1103,8 @@ class Git(core.VCS):
         p = self._git(['submodule', 'status', '--recursive'])
         modules = []
         while True:
-            line = yield p.wait_line()
-            if line is None:
+            lines = yield p.wait_lines()
+            if lines is None:
                 if len(modules) != 0:
                     visitor.branches(
                         CAT_SUBMODULES,
@@ -650,19 +1112,40 @@ class Git(core.VCS):
                         not CAN_RENAME,
                         modules)
                 break
-            _, sha1, name, _ = line.split(' ', 3)
-            modules.append(
-                GPS.VCS2.Branch(
-                    name=name, active=False, annotation='', id=sha1))
+            for line in lines:
+                _, sha1, name, _ = line.split(' ', 3)
+                modules.append(
+                    GPS.VCS2.Branch(
+                        name=name, active=False, annotation='', id=sha1))
 
     @core.run_in_background
     def async_branches(self, visitor):
-        yield join(self._branches(visitor),
-                   self._tags(visitor),
-                   self._stashes(visitor),
-                   self._worktrees(visitor),
-                   self._submodules(visitor),
-                   *self.extensions('async_branches', visitor))
+        # The branches, tags, stashes and worktrees are only computed again
+        # when the files where git stores them have changed. The status of
+        # submodules is always computed, when there are submodules.
+
+        mtimes = self.__refs_mtimes()
+        if mtimes is not None and mtimes == self.__branches_mtimes:
+            for args in self.__branches:
+                visitor.branches(*args)
+            recorder = None
+            gens = []
+        else:
+            recorder = _Branches_Recorder(visitor)
+            gens = [self._branches(recorder),
+                    self._stashes(recorder),
+                    self._worktrees(recorder)]
+
+        if os.path.isfile(os.path.join(self.working_dir.path, '.gitmodules')):
+            gens.append(self._submodules(visitor))
+
+        gens.extend(self.extensions('async_branches', visitor))
+        if gens:
+            yield join(*gens)   # join() with no argument never resolves
+
+        if recorder is not None:
+            self.__branches = recorder.calls
+            self.__branches_mtimes = mtimes
 
     def _current_branch(self):
         """
@@ -51,60 +51,61 @@ class SVN(core_staging.Emulate_Staging,
                 ['status', '-v', '-u'] + list)
 
             while True:
-                line = yield p.wait_line()
-                if line is None:
+                lines = yield p.wait_lines()
+                if lines is None:
                     break
+                for line in lines:
+                    m = self.__re_status.search(line)
+                    if m:
+                        f = os.path.join(
+                            self.working_dir.path, m.group('file'))
+                        rev = m.group('rev')   # current checkout
+                        rrev = m.group('lastcommit')  # only if we use '-u'
+
+                        if line[0] == ' ':
+                            status = GPS.VCS2.Status.UNMODIFIED
+                        elif line[0] == 'A':
+                            status = GPS.VCS2.Status.STAGED_ADDED
+                        elif line[0] == 'D':
+                            status = GPS.VCS2.Status.STAGED_DELETED
+                        elif line[0] == 'M':
+                            status = GPS.VCS2.Status.MODIFIED
+                        elif line[0] == 'C':
+                            status = GPS.VCS2.Status.CONFLICT
+                        elif line[0] == 'X':
+                            status = GPS.VCS2.Status.UNTRACKED
+                        elif line[0] == 'I':
+                            status = GPS.VCS2.Status.IGNORED
+                        elif line[0] == '?':
+                            status = GPS.VCS2.Status.UNTRACKED
+                        elif line[0] == '!':
+                            status = GPS.VCS2.Status.DELETED
+                        elif line[0] == '-':
+                            status = GPS.VCS2.Status.CONFLICT
+                        else:
+                            status = 0
 
-                m = self.__re_status.search(line)
-                if m:
-                    f = os.path.join(self.working_dir.path, m.group('file'))
-                    rev = m.group('rev')   # current checkout
-                    rrev = m.group('lastcommit')  # only if we use '-u'
-
-                    if line[0] == ' ':
-                        status = GPS.VCS2.Status.UNMODIFIED
-                    elif line[0] == 'A':
-                        status = GPS.VCS2.Status.STAGED_ADDED
-                    elif line[0] == 'D':
-                        status = GPS.VCS2.Status.STAGED_DELETED
-                    elif line[0] == 'M':
-                        status = GPS.VCS2.Status.MODIFIED
-                    elif line[0] == 'C':
-                        status = GPS.VCS2.Status.CONFLICT
-                    elif line[0] == 'X':
-                        status = GPS.VCS2.Status.UNTRACKED
-                    elif line[0] == 'I':
-                        status = GPS.VCS2.Status.IGNORED
-                    elif line[0] == '?':
-                        status = GPS.VCS2.Status.UNTRACKED
-                    elif line[0] == '!':
-                        status = GPS.VCS2.Status.DELETED
-                    elif line[0] == '-':
-                        status = GPS.VCS2.Status.CONFLICT
-                    else:
-                        status = 0
-
-                    # Properties
-                    if line[1] == 'M':
-                        status = status | GPS.VCS2.Status.MODIFIED
-                    elif line[1] == 'C':
-                        status = status | GPS.VCS2.Status.CONFLICT
-
-                    if line[2] == 'L':
-                        status = status | GPS.VCS2.Status.LOCAL_LOCKED
-
-                    if line[5] == 'K':
-                        status = status | GPS.VCS2.Status.LOCAL_LOCKED
-                    elif line[5] in ('O', 'T'):
-                        status = status | GPS.VCS2.Status.LOCKED_BY_OTHER
-
-                    if line[6] == 'C':
-                        status = status | GPS.VCS2.Status.CONFLICT
-
-                    if line[7] == '*':   # Only if we use -u
-                        status = status | GPS.VCS2.Status.NEEDS_UPDATE
-
-                    s.set_status(GPS.File(f), status, rev, rrev)
+                        # Properties
+                        if line[1] == 'M':
+                            status = status | GPS.VCS2.Status.MODIFIED
+                        elif line[1] == 'C':
+                            status = status | GPS.VCS2.Status.CONFLICT
+
+                        if line[2] == 'L':
+                            status = status | GPS.VCS2.Status.LOCAL_LOCKED
+
+                        if line[5] == 'K':
+                            status = status | GPS.VCS2.Status.LOCAL_LOCKED
+                        elif line[5] in ('O', 'T'):
+                            status = status | GPS.VCS2.Status.LOCKED_BY_OTHER
+
+                        if line[6] == 'C':
+                            status = status | GPS.VCS2.Status.CONFLICT
+
+                        if line[7] == '*':   # Only if we use -u
+                            status = status | GPS.VCS2.Status.NEEDS_UPDATE
+
+                        s.set_status(GPS.File(f), status, rev, rrev)
 
     @core.run_in_background
     def async_commit_staged_files(self, visitor, message):
@@ -219,22 +220,30 @@ class SVN(core_staging.Emulate_Staging,
             "(?P<author>\S+)"
             "\s+"
             "(?P<date>....-..-..)")
+        key = (file.path, self.get_file_status(file)[1],
+               core.file_contents_hash(file))
+        cached = self.annotations_cache.get(key)
+        if cached is not None:
+            visitor.annotations(file, *cached)
+            return
+
         lines = []
         ids = []
         p = self._svn(['annotate', '-v', self._relpath(file.path)])
         while True:
-            line = yield p.wait_line()
-            if line is None:
+            output = yield p.wait_lines()
+            if output is None:
+                self.annotations_cache.set(key, 1, ids, lines)
                 visitor.annotations(file, 1, ids, lines)
                 break
-
-            m = r.search(line)
-            if m:
-                lines.append('%s %10s r%s' % (
-                    m.group('date'),
-                    m.group('author')[:10],
-                    m.group('rev')))
-                ids.append(m.group('rev'))
+            for line in output:
+                m = r.search(line)
+                if m:
+                    lines.append('%s %10s r%s' % (
+                        m.group('date'),
+                        m.group('author')[:10],
+                        m.group('rev')))
+                    ids.append(m.group('rev'))
 
     def _branches(self, visitor, parent_url):
         """
@@ -245,16 +254,17 @@ class SVN(core_staging.Emulate_Staging,
         base = parent_url + '/branches'
         p = self._svn(['list', base])
         while True:
-            line = yield p.wait_line()
-            if line is None:
+            lines = yield p.wait_lines()
+            if lines is None:
                 visitor.branches(
                     CAT_BRANCHES, 'vcs-branch-symbolic',
                     not CAN_RENAME, branches)
                 break
-            line = line.rstrip('/')
-            b = os.path.join(base, line)
-            branches.append(GPS.VCS2.Branch(
-                name=line, active=b == parent_url, annotation='', id=b))
+            for line in lines:
+                line = line.rstrip('/')
+                b = os.path.join(base, line)
+                branches.append(GPS.VCS2.Branch(
+                    name=line, active=b == parent_url, annotation='', id=b))
 
     def _tags(self, visitor, parent_url):
         """
@@ -264,28 +274,30 @@ class SVN(core_staging.Emulate_Staging,
         base = parent_url + 'tags'
         p = self._svn(['list', base])
         while True:
-            line = yield p.wait_line()
-            if line is None:
+            lines = yield p.wait_lines()
+            if lines is None:
                 visitor.branches(
                     CAT_TAGS, 'vcs-tag-symbolic', not CAN_RENAME, tags)
                 break
-            line = line.rstrip('/')
-            b = os.path.join(base, line)
-            tags.append(GPS.VCS2.Branch(
-                name=line, active=b == parent_url, annotation='', id=b))
+            for line in lines:
+                line = line.rstrip('/')
+                b = os.path.join(base, line)
+                tags.append(GPS.VCS2.Branch(
+                    name=line, active=b == parent_url, annotation='', id=b))
 
     @core.run_in_background
     def async_branches(self, visitor):
         url = ''
 
         p = self._svn(['info'])
-        while True:
-            line = yield p.wait_line()
-            if line is None:
-                break
-            if line.startswith('URL: '):
-                url = line[5:]
+        while not url:
+            lines = yield p.wait_lines()
+            if lines is None:
                 break
+            for line in lines:
+                if line.startswith('URL: '):
+                    url = line[5:]
+                    break
 
         if url:
             # Assume the standard 'trunk', 'branches' and 'tags' naming
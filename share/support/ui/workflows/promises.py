@@ -453,6 +453,12 @@ class ProcessWrapper(object):
 
     """
 
+    monitor = None
+    # When set, a function called with the command line of every process
+    # spawned, for instance to profile them. It returns either None, or a
+    # function called with the exit status and the number of lines of
+    # output when the process terminates.
+
     def __init__(self, cmdargs=[], spawn_console=False,
                  directory=None, regexp='.+',
                  single_line_regexp=True, block_exit=True,
@@ -495,6 +501,16 @@ class ProcessWrapper(object):
         # __output = a buffer for current output of self.__process
         self.__output = ""
 
+        # __lines_promise = the promise returned by wait_lines, and its
+        # parameters
+        self.__lines_promise = None
+        self.__lines_max = 0
+        self.__lines_timeout = None
+
+        # __lines = the complete lines of output not returned by wait_lines
+        # yet
+        self.__lines = []
+
         # __whether process has finished
         self.finished = False
 
@@ -510,6 +526,12 @@ class ProcessWrapper(object):
         # Created only if spawn_console is set to True.
         self.__console = None
 
+        # See ProcessWrapper.monitor
+        self.__on_monitor_exit = None
+        self.__monitor_lines = 0
+        if ProcessWrapper.monitor is not None:
+            self.__on_monitor_exit = ProcessWrapper.monitor(self.__command)
+
         # Launch the command
         try:
             self.__process = GPS.Process(
@@ -582,10 +604,14 @@ class ProcessWrapper(object):
         """
         Called by GPS everytime there's output coming
         """
-        if self.__current_promise is not None:
+        if self.__on_monitor_exit is not None:
+            self.__monitor_lines += match.count('\n') + unmatch.count('\n')
+        if self.__current_promise is not None or \
+                self.__lines_promise is not None:
             self.__output += unmatch
             self.__output += match
             self.__check_pattern_and_resolve()
+            self.__check_lines_and_resolve()
         if self.__stream is not None:
             self.__stream.emit(unmatch)
             self.__stream.emit(match)
@@ -620,9 +646,17 @@ class ProcessWrapper(object):
            Current_promise will be solved with False
         """
         self.finished = True
-        if self.__current_promise is not None:
+        if self.__on_monitor_exit is not None:
+            self.__on_monitor_exit(
+                status,
+                self.__monitor_lines + remaining_output.count('\n'))
+            self.__on_monitor_exit = None
+
+        if self.__current_promise is not None or \
+                self.__lines_promise is not None:
             self.__output += remaining_output
             self.__check_pattern_and_resolve()
+            self.__check_lines_and_resolve()
 
         if self.__stream is not None:
             self.__stream.emit(remaining_output)
@@ -692,6 +726,97 @@ class ProcessWrapper(object):
 
         return p
 
+    def __check_lines_and_resolve(self):
+        """
+        Check whether enough lines are available to resolve the promise
+        returned by wait_lines.
+        """
+        if self.__lines_promise is None:
+            return
+
+        idx = self.__output.rfind("\n")
+        if idx != -1:
+            self.__lines.extend(self.__output[:idx].split("\n"))
+            self.__output = self.__output[idx + 1:]
+
+        if self.finished and self.__output:
+            self.__lines.append(self.__output)
+            self.__output = ""
+
+        if not self.__lines:
+            if self.finished:
+                self.__resolve_lines(None)
+
+        elif (self.finished or
+              self.__lines_timeout is None or
+              (self.__lines_max and len(self.__lines) >= self.__lines_max)):
+
+            if self.__lines_max:
+                lines = self.__lines[:self.__lines_max]
+                del self.__lines[:self.__lines_max]
+            else:
+                lines = self.__lines
+                self.__lines = []
+            self.__resolve_lines(lines)
+
+    def __resolve_lines(self, value):
+        """
+        Resolve the promise returned by wait_lines with the given value.
+        """
+        p = self.__lines_promise
+        self.__lines_promise = None
+        if self.__lines_timeout is not None:
+            GLib.source_remove(self.__lines_timeout)
+            self.__lines_timeout = None
+        p.resolve(value)
+
+    def __on_lines_timeout(self):
+        """
+        Called by GPS when the delay given to wait_lines has expired.
+        """
+        self.__lines_timeout = None
+        self.__check_lines_and_resolve()
+        return False
+
+    def wait_lines(self, max_lines=0, max_ms=0):
+        """
+        Wait for one or more lines to be available, and return them as a
+        list. The lines do not include the trailing \n.
+        This is much more efficient than calling `wait_line` repeatedly on
+        large outputs, since a single promise is resolved for all the lines
+        received at once::
+
+            p = ProcessWrapper(...)
+            while True:
+                lines = yield p.wait_lines()
+                if lines is None:
+                    break
+                for line in lines:
+                    pass   # do something with the line
+
+        This should not be mixed with calls to `wait_until_match` or
+        `wait_line` on the same process.
+
+        :param int max_lines: if not 0, at most this number of lines is
+           returned, and the promise is resolved as soon as that many lines
+           are available.
+        :param int max_ms: if not 0, wait for this many milliseconds (or
+           until max_lines lines are available) to gather more lines before
+           resolving the promise. Otherwise, the promise is resolved as soon
+           as at least one line is available.
+        :return: a promise, resolved with a list of lines, or None when the
+           process has terminated and all its output has been returned.
+        """
+        p = self.__lines_promise = Promise()
+        self.__lines_max = max_lines
+        if max_ms > 0:
+            self.__lines_timeout = GLib.timeout_add(
+                max_ms, self.__on_lines_timeout)
+
+        # Can we resolve immediately ?
+        self.__check_lines_and_resolve()
+        return p
+
     @property
     def stream(self):
         """
@@ -751,25 +876,59 @@ class ProcessWrapper(object):
            the output.
         """
 
-        class map_to_line:
+        def emit_lines(out_stream, lines):
+            for line in lines:
+                out_stream.emit(line)
+
+        return self.lines_batched.flatMap(emit_lines)
+
+    @property
+    def lines_batched(self):
+        """
+        A stream that emits one event every time one or more complete lines
+        are available in the output. Each event is a list of lines, which
+        do not include the trailing \n. This is more efficient than `lines`
+        when the output is large::
+
+            def onlines(lines):
+                for line in lines:
+                    pass   # do something with the line
+
+            @run_as_workflow
+            def execute():
+                p = ProcessWrapper(...)
+                yield p.lines_batched.subscribe(onlines)
+
+        :returntype: a stream, see `lines`.
+        """
+
+        class split_lines:
             def __init__(self):
-                self.buffer = ""
-                self.__re = re.compile('^.*\n')
+                self.partial = []   # pieces of the current incomplete line
 
             def __call__(self, out_stream, output):
-                self.buffer += output
-                while True:
-                    p = self.__re.search(self.buffer)
-                    if not p:
-                        break
-                    out_stream.emit(p.group(0)[:-1])
-                    self.buffer = self.buffer[p.end(0):]
+                if "\n" not in output:
+                    if output:
+                        self.partial.append(output)
+                    return
+
+                # Each chunk of output is only split once, and we only keep
+                # the last incomplete line for the next chunk.
+                lines = output.split("\n")
+                if self.partial:
+                    self.partial.append(lines[0])
+                    lines[0] = "".join(self.partial)
+
+                last = lines.pop()
+                self.partial = [last] if last else []
+                out_stream.emit(lines)
 
             def oncompleted(self, out_stream, status):
-                if self.buffer:
-                    out_stream.emit(self.buffer)
+                if self.partial:
+                    out_stream.emit(["".join(self.partial)])
+                    self.partial = []
 
-        return self.stream.flatMap(map_to_line())
+        return self.stream.flatMap(split_lines())
 
     def wait_until_terminate(self, show_if_error=False):
         """